@@ -4,15 +4,22 @@
 # This script is called to build and install gtest static libraries
 # from the previously installed source code.
 # The default destination is /usr/lib and the package is built in
-# /tmp/gtestbuild.$$.
+# /var/cache/tuffix/gtestbuild, which is kept between runs.
+# The build runs through ccache when it is installed, with one job per
+# CPU but no more than available memory allows (JOBMEM KiB per job).
+# A stamp records the libgtest-dev version and compiler that were last
+# installed; if neither changed and the libraries are still installed,
+# nothing is rebuilt.
 #
 
-BUILDDIR=${BUILDDIR:-"/tmp/gtestbuild.$$"}
+BUILDDIR=${BUILDDIR:-"/var/cache/tuffix/gtestbuild"}
 DESTROOT=${DESTROOT:-"/usr"}
 # Be aware that /usr/src/gtest is a symlink to /usr/src/googletest.
 SRC=${SRC:-"/usr/src/googletest"}
+JOBMEM=${JOBMEM:-524288}
 PKGNAME="libgtest-dev"
 PKGEXISTS=`dpkg-query -W -f '${binary:Package}\n' --no-pager ${PKGNAME}`
+LIBS="libgtest.a libgtest_main.a libgmock.a libgmock_main.a"
 
 if [ ${PKGEXISTS}"x" = "x" ]; then
   echo "${PKGNAME} is not installed. Exiting."
@@ -24,12 +31,41 @@ if [ ! -d ${SRC} ]; then
   exit 1
 fi
 
+PKGVERSION=`dpkg-query -W -f '${Version}' --no-pager ${PKGNAME}`
+COMPILER=`c++ --version | head -n 1`
+STAMP="${PKGNAME} ${PKGVERSION}; ${COMPILER}"
+
+INSTALLED=yes
+for LIB in ${LIBS}; do
+  if [ ! -f ${DESTROOT}/lib/${LIB} ]; then
+    INSTALLED=no
+  fi
+done
+if [ ${INSTALLED} = yes ] && [ "`cat ${BUILDDIR}/stamp 2>/dev/null`" = "${STAMP}" ]; then
+  echo "gtest ${PKGVERSION} is already built with ${COMPILER}."
+  exit 0
+fi
+
+CPUS=`nproc`
+MEMAVAILABLE=`awk '/^MemAvailable:/ { print $2 }' /proc/meminfo`
+JOBS=${CPUS}
+if [ ${MEMAVAILABLE}"x" != "x" ] && [ $((MEMAVAILABLE / JOBMEM)) -lt ${JOBS} ]; then
+  JOBS=$((MEMAVAILABLE / JOBMEM))
+fi
+if [ ${JOBS} -lt 1 ]; then
+  JOBS=1
+fi
+
+LAUNCHER=""
+if command -v ccache > /dev/null; then
+  LAUNCHER="-DCMAKE_CXX_COMPILER_LAUNCHER=ccache"
+fi
+
 mkdir -p ${BUILDDIR}
 cd ${BUILDDIR}
-cmake -DCMAKE_BUILD_TYPE=RELEASE /usr/src/gtest/
-make
-sudo install -o root -g root -m 644 lib/libgtest.a ${DESTROOT}/lib
-sudo install -o root -g root -m 644 lib/libgtest_main.a ${DESTROOT}/lib
-sudo install -o root -g root -m 644 lib/libgmock.a ${DESTROOT}/lib
-sudo install -o root -g root -m 644 lib/libgmock_main.a ${DESTROOT}/lib
-
+cmake -DCMAKE_BUILD_TYPE=RELEASE ${LAUNCHER} /usr/src/gtest/
+make -j ${JOBS}
+for LIB in ${LIBS}; do
+  sudo install -o root -g root -m 644 lib/${LIB} ${DESTROOT}/lib
+done
+echo "${STAMP}" > stamp
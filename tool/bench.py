@@ -0,0 +1,271 @@
+"""
+Micro-benchmarks for the Tuffix command line hot paths
+
+Runs without root or network: state files live in a pyfakefs file system and
+plan resolution runs against a stub apt cache. Results can be saved as JSON
+and compared with an earlier run, failing when something got slower.
+
+usage:
+    python3 bench.py [--only SUBSTRING] [--output FILE] [--compare FILE]
+                     [--tolerance FRACTION] [--network]
+"""
+
+import argparse, contextlib, io, json, os, pathlib, platform, statistics, sys, tempfile, time
+
+import packaging.version
+from pyfakefs.fake_filesystem_unittest import Patcher
+
+from tuffixlib import *
+
+# version of the JSON results format
+RESULTS_FORMAT = 1
+
+# Each benchmark is timed in REPEAT rounds of as many calls as fit in about
+# ROUND_SECONDS; the fastest round is the least disturbed by the rest of the
+# machine.
+REPEAT = 5
+ROUND_SECONDS = 0.1
+
+# package counts of the synthetic keyword sets that plan resolution runs on
+PLAN_SIZES = [10, 100, 1000, 10000]
+
+# A package in StubCache. Marking it for install also marks its
+# dependencies, the way apt's resolver does.
+class StubPackage:
+    def __init__(self, cache, name, size, is_installed, depends):
+        self.cache = cache
+        self.name = name
+        self.size = size
+        self.is_installed = is_installed
+        self.depends = depends
+        self.is_auto_installed = False
+        self.marked_install = self.marked_upgrade = self.marked_delete = False
+
+    def mark_auto(self, auto=True):
+        self.is_auto_installed = auto
+
+    def mark_install(self):
+        pending = [self]
+        while pending:
+            package = pending.pop()
+            if package.is_installed or package.marked_install:
+                continue
+            package.marked_install = True
+            self.cache.required_download += package.size
+            self.cache.required_space += package.size * 3
+            pending.extend(self.cache[name] for name in package.depends)
+
+    def mark_delete(self):
+        if self.is_installed and not self.marked_delete:
+            self.marked_delete = True
+            self.cache.required_space -= self.size * 3
+
+# Just enough of apt.cache.Cache for Transaction.plan and estimate.
+class StubCache(dict):
+    # names: package names; every tenth one is installed already, and each
+    #   depends on the two packages after it
+    def __init__(self, names):
+        super().__init__()
+        self.required_download = 0
+        self.required_space = 0
+        for i, name in enumerate(names):
+            self[name] = StubPackage(self, name, 100000 + i, i % 10 == 0, names[i + 1:i + 3])
+
+    def actiongroup(self):
+        return contextlib.nullcontext()
+
+    def get_changes(self):
+        return [package for package in self.values()
+                if package.marked_install or package.marked_upgrade or package.marked_delete]
+
+    def clear(self):
+        for package in self.values():
+            package.marked_install = package.marked_upgrade = package.marked_delete = False
+        self.required_download = self.required_space = 0
+
+# Keywords with count packages in total, ten packages each.
+def synthetic_keywords(build_config, count):
+    names = [f'package{i}' for i in range(count)]
+    return [ManifestKeyword(build_config,
+                            {'name': f'syn{start // 10}',
+                             'description': 'synthetic keyword',
+                             'packages': names[start:start + 10],
+                             'repositories': [],
+                             'artifacts': [],
+                             'post_install': []})
+            for start in range(0, count, 10)], names
+
+# Time function, called with no arguments. Returns a dict of seconds per
+# call: min and median over the rounds, and the calls per round.
+def measure(function):
+    start = time.perf_counter()
+    function()
+    once = time.perf_counter() - start
+    calls = max(1, int(ROUND_SECONDS / once)) if once > 0 else 1000
+    # slow calls, e.g. probes that time out, are only timed once more
+    repeat = REPEAT if once * calls * REPEAT < 5 else 1
+    rounds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        rounds.append((time.perf_counter() - start) / calls)
+    return {'min': min(rounds), 'median': statistics.median(rounds), 'calls': calls}
+
+# Yield (name, function) for every benchmark.
+# tmp: pathlib.Path of a scratch directory on the real file system
+# network: whether to include probes that need the network
+def benchmarks(tmp, network):
+    build_config = BuildConfig(VERSION, tmp / 'state.json', cache_path=tmp / 'cache')
+    (tmp / 'cache').mkdir()
+    # compile the keyword index once, as any earlier run would have
+    KEYWORDS.names()
+
+    def dispatch():
+        with contextlib.redirect_stdout(io.StringIO()):
+            main(build_config, ['tuffix', 'describe', 'base'])
+    yield 'main: describe base', dispatch
+    yield 'find_keyword: base', lambda: find_keyword(build_config, 'base')
+    yield 'find_keyword: alias', lambda: find_keyword(build_config, 'cpsc484')
+
+    for count in [10, 1000]:
+        state = State(build_config, VERSION, [f'syn{i}' for i in range(count // 10)],
+                      {f'package{i}': [f'syn{i // 10}'] for i in range(count)})
+        # the state file lives in a fake file system while these run
+        with Patcher() as patcher:
+            patcher.fs.create_dir(str(tmp))
+            state.write()
+            yield f'State.write: {count} packages', state.write
+            yield f'read_state: {count} packages', lambda: read_state(build_config)
+            # a journal append, with a compaction every JOURNAL_COMPACT_RECORDS
+            yield f'State.added: {count} packages', lambda: state.added('syn0', ['package0'])
+
+    # the probes read a real state file, as on an installed machine
+    State(build_config, VERSION, ['base', 'C484'],
+          {'gcc': ['base'], 'freeglut3-dev': ['C484']}).write()
+    for probe in STATUS_PROBES:
+        if probe.name == 'internet' and not network:
+            continue
+        yield f'status probe: {probe.name}', lambda probe=probe: probe.run(build_config)
+    fields = [probe.name for probe in STATUS_PROBES if network or probe.name != 'internet']
+    yield 'status_data: cached', lambda: status_data(build_config, fields)
+
+    if DPKG_STATUS_PATH.is_file():
+        yield 'DpkgStatusIndex: this host', DpkgStatusIndex
+
+    for count in PLAN_SIZES:
+        keywords, names = synthetic_keywords(build_config, count)
+        cache = StubCache(names)
+        transaction = Transaction(keywords, True, AptSession(60))
+        def plan(transaction=transaction, cache=cache):
+            transaction.plan(cache)
+            cache.clear()
+        yield f'Transaction.plan: {count} packages', plan
+
+# Names of the benchmarks in baseline that are missing from results, e.g.
+# because they were renamed or failed, among those that only selects.
+# only: the --only substring, or None
+def missing(results, baseline, only=None):
+    return [name for name in baseline['results']
+            if (only is None or only in name) and name not in results['results']]
+
+# Compare results with baseline, both dicts as written by --output. Returns
+# the names of the benchmarks that got slower by more than tolerance, a
+# fraction of the baseline time.
+def regressions(results, baseline, tolerance):
+    slower = []
+    for name, result in results['results'].items():
+        before = baseline['results'].get(name)
+        if before and result['min'] > before['min'] * (1 + tolerance):
+            slower.append(name)
+    return slower
+
+def format_seconds(seconds):
+    if seconds < 1e-3:
+        return f'{seconds * 1e6:.1f} us'
+    if seconds < 1:
+        return f'{seconds * 1e3:.2f} ms'
+    return f'{seconds:.2f} s'
+
+def main_bench(argv):
+    parser = argparse.ArgumentParser(description='Time the Tuffix command line hot paths.')
+    parser.add_argument('--only', help='run only benchmarks whose name contains this')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='slowdown, as a fraction, that counts as a regression (default 0.25)')
+    parser.add_argument('--network', action='store_true', help='also time probes that use the network')
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('format') != RESULTS_FORMAT:
+            print(f'error: {args.compare} is not in results format {RESULTS_FORMAT}')
+            return 2
+
+    results = {'format': RESULTS_FORMAT,
+               'tuffix': str(VERSION),
+               'python': platform.python_version(),
+               'host': platform.node(),
+               'time': time.time(),
+               'results': {},
+               # name -> error of the benchmarks that raised; timing an
+               # error path says nothing about the hot path
+               'failed': {}}
+    # what the code under test prints, e.g. probes running missing commands,
+    # goes to /dev/null; the results go to the real stdout
+    sys.stdout.flush()
+    out = os.fdopen(os.dup(1), 'w')
+    saved = [os.dup(1), os.dup(2)]
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, function in benchmarks(pathlib.Path(tmp), args.network):
+                if args.only and args.only not in name:
+                    continue
+                try:
+                    result = measure(function)
+                except Exception as e:
+                    results['failed'][name] = f'{type(e).__name__}: {e}'
+                    print(f'{name:<40} failed: {results["failed"][name]}', file=out, flush=True)
+                    continue
+                results['results'][name] = result
+                line = f'{name:<40} {format_seconds(result["min"]):>10} {format_seconds(result["median"]):>10}'
+                if baseline and name in baseline['results']:
+                    line += f'  {result["min"] / baseline["results"][name]["min"]:6.2f}x'
+                print(line, file=out, flush=True)
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in saved + [devnull]:
+            os.close(fd)
+        out.close()
+
+    if not results['results']:
+        if results['failed']:
+            print('error: every benchmark failed')
+        else:
+            print(f'error: no benchmark name contains "{args.only}"' if args.only else 'error: no benchmarks ran')
+        return 2
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    status = 0
+    if baseline:
+        gone = missing(results, baseline, args.only)
+        if gone:
+            print(f'error: not run, but in {args.compare}: {", ".join(gone)}')
+            status = 1
+        slower = regressions(results, baseline, args.tolerance)
+        if slower:
+            print(f'regressions beyond {args.tolerance:.0%}: {", ".join(slower)}')
+            status = 1
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main_bench(sys.argv[1:]))
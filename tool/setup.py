@@ -12,7 +12,8 @@ setuptools.setup(
                       'termcolor', 
                       'Crypto',
                       'pycryptodome',
-                      'python-gnupg']
+                      'python-gnupg',
+                      'PyYAML']
                       # 'sudo_execute @ git+https://github.com/JaredDyreson/sudo_execute']
 )
 
@@ -3,9 +3,11 @@ Unit tests for Tuffix utility
 AUTHOR: Kevin Wortman
 """
 
-import io, pathlib, unittest
+import contextlib, hashlib, http.client, http.server, io, json, os, pathlib, pwd, shlex, shutil, signal, subprocess, sys, tarfile, tempfile, threading, time, unittest, urllib.request
 
-import packaging.version, pyfakefs
+import packaging.version, pyfakefs, pyfakefs.fake_filesystem_unittest
+
+import tuffixlib
 
 from tuffixlib import *
 
@@ -66,6 +68,108 @@ class TestExceptionClasses(unittest.TestCase):
         self.assertTrue(isinstance(e, MessageException))
         self.assertEqual(self.MESSAGE, e.message)
 
+class TestStartup(unittest.TestCase):
+    # Read-only commands must not import any of these...
+    HEAVY_MODULES = ['apt', 'apt_pkg', 'requests', 'Crypto', 'gnupg', 'yaml']
+    # ...and, as a smoke check, must take less than this many times as long
+    # as starting a bare interpreter on the same machine in the same run.
+    BUDGET_FACTOR = 3
+
+    # Run code in a fresh interpreter under -X importtime and return a dict
+    # mapping each imported module name to its cumulative import time in us.
+    def import_times(self, code):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdin=subprocess.DEVNULL,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE,
+                                encoding='utf-8')
+        times = {}
+        for line in result.stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                _, cumulative, name = line[len('import time:'):].split('|')
+                if cumulative.strip().isdigit():
+                    times[name.strip()] = int(cumulative)
+        return times
+
+    # Fastest of a few runs of code in a fresh interpreter, in seconds.
+    def wall_time(self, code, runs=3):
+        best = None
+        for _ in range(runs):
+            start = time.monotonic()
+            subprocess.run([sys.executable, '-c', code],
+                           cwd=os.path.dirname(os.path.abspath(__file__)),
+                           stdin=subprocess.DEVNULL,
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+            seconds = time.monotonic() - start
+            best = seconds if best is None else min(best, seconds)
+        return best
+
+    def test_read_only_commands(self):
+        # compile the keyword index first, as any earlier run would have
+        KEYWORDS.names()
+        budget = self.BUDGET_FACTOR * self.wall_time('pass')
+        for arguments in [['list'], ['describe', 'base'], ['installed'], ['verify']]:
+            code = ('import tuffixlib; '
+                    f'tuffixlib.main(tuffixlib.DEFAULT_BUILD_CONFIG, {["tuffix"] + arguments!r})')
+            times = self.import_times(code)
+            self.assertIn('tuffixlib', times)
+            imported = {name.split('.')[0] for name in times}
+            for module in self.HEAVY_MODULES:
+                self.assertNotIn(module, imported, f'tuffix {arguments[0]} imported {module}')
+            self.assertLess(self.wall_time(code), budget, f'tuffix {arguments[0]} starts slowly')
+
+class TestTracing(unittest.TestCase):
+    def tearDown(self):
+        stop_tracing()
+
+    def test_off(self):
+        self.assertIs(NULL_SPAN, trace('step'))
+        with trace('step', bytes=1) as span:
+            span['changes'] = 2
+
+    def test_spans(self):
+        tracer = start_tracing()
+        with trace('outer', 'command', arguments=['base']) as span:
+            with trace('inner', 'apt'):
+                pass
+            span['exit_code'] = 0
+        with self.assertRaises(EnvironmentError):
+            with trace('failing'):
+                raise EnvironmentError('no network')
+        self.assertIs(tracer, stop_tracing())
+        self.assertIs(NULL_SPAN, trace('after'))
+        document = tracer.document()
+        events = {event['name']: event for event in document['traceEvents'] if event['ph'] == 'X'}
+        self.assertEqual({'outer', 'inner', 'failing'}, set(events))
+        outer, inner = events['outer'], events['inner']
+        self.assertEqual({'arguments': ['base'], 'exit_code': 0}, outer['args'])
+        self.assertEqual('apt', inner['cat'])
+        # inner is nested in outer on the same thread
+        self.assertEqual(outer['tid'], inner['tid'])
+        self.assertLessEqual(outer['ts'], inner['ts'])
+        self.assertLessEqual(inner['ts'] + inner['dur'], outer['ts'] + outer['dur'])
+        self.assertEqual('no network', events['failing']['args']['error'])
+        self.assertIn({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                       'tid': threading.get_ident(), 'args': {'name': threading.current_thread().name}},
+                      document['traceEvents'])
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp, 'trace.json')
+            with contextlib.redirect_stdout(io.StringIO()):
+                main(DEFAULT_BUILD_CONFIG, ['tuffix', '--trace', str(path), 'describe', 'base'])
+            with open(path) as f:
+                events = json.load(f)['traceEvents']
+            self.assertIn('tuffix describe', [event['name'] for event in events])
+            with contextlib.redirect_stdout(io.StringIO()):
+                main(DEFAULT_BUILD_CONFIG, ['tuffix', f'--trace={path}', 'describe', 'nonsense'])
+            with open(path) as f:
+                event = json.load(f)['traceEvents'][-1]
+            self.assertEqual(1, event['args']['exit_code'])
+            self.assertIsNone(stop_tracing())
+
 class TestBuildConfig(unittest.TestCase):
     def test_constructor(self):
         with self.assertRaises(ValueError):
@@ -99,8 +203,1515 @@ class TestState(unittest.TestCase):
 
     def test_write(self):
         obj = State(self.build_config, self.version, self.installed)
+        with pyfakefs.fake_filesystem_unittest.Patcher() as patcher:
+            patcher.fs.create_dir(str(self.build_config.state_path.parent))
+            obj.write()
+            self.assertFalse(self.build_config.state_path.with_name('state.json.tmp').exists())
+            self.assertEqual('', state_journal_path(self.build_config).read_text())
+            state = read_state(self.build_config)
+            self.assertEqual(self.version, state.version)
+            self.assertEqual(self.installed, state.installed)
+
+    def test_journal(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            build_config = BuildConfig(VERSION, pathlib.Path(tmp, 'state.json'))
+            State(build_config, VERSION, []).write()
+            state = read_state(build_config)
+            state.added('general', ['curl', 'gthumb'], ['curl'], 1.5)
+            state.added('C223J', ['gthumb', 'netbeans'])
+            state.removed('general')
+            # the snapshot is untouched until compaction, the journal has it all
+            self.assertIn('"installed": []', build_config.state_path.read_text())
+            self.assertEqual(3, len(state_journal_path(build_config).read_text().splitlines()))
+            state = read_state(build_config)
+            self.assertEqual(['C223J'], state.installed)
+            self.assertEqual({'curl': [SYSTEM_OWNER], 'gthumb': ['C223J'], 'netbeans': ['C223J']},
+                             state.owners)
+            self.assertEqual(['C223J'], list(state.keywords))
+            metadata = state.keywords['C223J']
+            self.assertEqual(package_set_hash(['netbeans', 'gthumb']), metadata['packages_sha256'])
+            self.assertEqual(str(VERSION), metadata['tuffix'])
+            self.assertEqual(3, state.journal_seq)
+            # compaction folds the journal into the snapshot
+            state.write()
+            self.assertEqual('', state_journal_path(build_config).read_text())
+            state = read_state(build_config)
+            self.assertEqual(['C223J'], state.installed)
+            self.assertEqual(3, state.journal_seq)
+            # records the snapshot already includes are not applied again
+            with open(state_journal_path(build_config), 'w') as f:
+                f.write(json.dumps({'seq': 3, 'op': 'remove', 'keyword': 'C223J'}) + '\n')
+            self.assertEqual(['C223J'], read_state(build_config).installed)
+
+    def test_compaction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            build_config = BuildConfig(VERSION, pathlib.Path(tmp, 'state.json'))
+            State(build_config, VERSION, []).write()
+            state = read_state(build_config)
+            for i in range(JOURNAL_COMPACT_RECORDS):
+                state.added(f'k{i}', [])
+            self.assertEqual('', state_journal_path(build_config).read_text())
+            self.assertEqual(JOURNAL_COMPACT_RECORDS,
+                             len(json.loads(build_config.state_path.read_text())['installed']))
+
+    def test_recovery(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            build_config = BuildConfig(VERSION, pathlib.Path(tmp, 'state.json'))
+            State(build_config, VERSION, []).write()
+            read_state(build_config).added('general', ['curl'])
+            # interrupted while appending a record, and while writing a snapshot
+            with open(state_journal_path(build_config), 'a') as f:
+                f.write('{"seq": 2, "op": "add", "keyw')
+            tmp_path = pathlib.Path(tmp, 'state.json.tmp')
+            tmp_path.write_text('{"version": "0.1')
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                state = read_state(build_config)
+            self.assertIn('1 damaged record', output.getvalue())
+            self.assertEqual(['general'], state.installed)
+            # recovered into a fresh snapshot
+            self.assertFalse(tmp_path.exists())
+            self.assertEqual('', state_journal_path(build_config).read_text())
+            self.assertEqual(['general'], json.loads(build_config.state_path.read_text())['installed'])
+
+    def test_owners(self):
+        with self.assertRaises(ValueError):
+            State(self.build_config, self.version, self.installed, {'gthumb': 'general'})
+        obj = State(self.build_config, self.version, [])
+        obj.claim('general', ['curl', 'gthumb'], preinstalled=['curl'])
+        obj.claim('C223J', ['gthumb', 'netbeans'], preinstalled=['gthumb'])
+        self.assertEqual([SYSTEM_OWNER, 'general'], obj.owners['curl'])
+        self.assertEqual(['general', 'C223J'], obj.owners['gthumb'])
+        self.assertEqual(['gthumb'], obj.shared(['gthumb', 'netbeans'], ['C223J']))
+        self.assertEqual(['curl'], obj.shared(['curl', 'gthumb'], ['general', 'C223J']))
+        # gthumb is still needed by general, curl was there before tuffix
+        self.assertEqual(['netbeans'], obj.release('C223J'))
+        self.assertEqual(['gthumb'], obj.release('general'))
+        self.assertEqual({'curl': [SYSTEM_OWNER]}, obj.owners)
+
+    def test_read_without_owners(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            build_config = BuildConfig(VERSION, pathlib.Path(tmp, 'state.json'))
+            build_config.state_path.write_text('{"version": "0.1.0", "installed": ["latex", "gone"]}')
+            state = read_state(build_config)
+            self.assertEqual({'texlive-full': ['latex']}, state.owners)
+            state.write()
+            self.assertEqual(state.owners, read_state(build_config).owners)
+
+class TestUserWorker(unittest.TestCase):
+    me = pwd.getpwuid(os.getuid()).pw_name
+
+    def test_lookup_user(self):
+        self.assertEqual(os.getuid(), lookup_user(self.me).pw_uid)
+        with self.assertRaises(UnknownUserException):
+            lookup_user('no-such-user')
+        self.assertFalse(sudo_run().check_user('no-such-user'))
+
+    def test_run(self):
+        worker = UserWorker(self.me)
+        with self.assertRaises(ValueError):
+            worker.run('echo hi')
+        result = worker.run(['echo', 'hi'])
+        self.assertEqual(0, result.returncode)
+        self.assertEqual(['hi'], result.lines())
+        # there is no shell
+        result = worker.run(['echo', '$HOME;', 'false'])
+        self.assertEqual(['$HOME; false'], result.lines())
+        self.assertEqual(1, worker.run(['false']).returncode)
+        with self.assertRaises(subprocess.CalledProcessError):
+            worker.run(['false']).check()
+        self.assertEqual(127, worker.run(['no-such-command']).returncode)
+        self.assertEqual([tempfile.gettempdir()], worker.run(['pwd'], cwd=tempfile.gettempdir()).lines())
+
+    @unittest.skipUnless(os.getuid() == 0, 'dropping privileges needs root')
+    def test_drop_privileges(self):
+        nobody = lookup_user('nobody')
+        worker = UserWorker('nobody')
+        self.assertEqual([str(nobody.pw_uid)], worker.run(['id', '-u']).lines())
+        self.assertEqual([str(nobody.pw_gid)], worker.run(['id', '-g']).lines())
+        groups = os.getgrouplist(nobody.pw_name, nobody.pw_gid)
+        self.assertEqual(sorted(map(str, groups)), sorted(worker.run(['id', '-G']).lines()[0].split()))
+        # none of this process's descriptors reach the command
+        read, write = os.pipe()
+        try:
+            self.assertEqual(['0', '1', '2', '3'], worker.run(['ls', '/proc/self/fd']).lines())
+        finally:
+            os.close(read)
+            os.close(write)
+
+class TestRegistry(unittest.TestCase):
+    build_config = DEFAULT_BUILD_CONFIG
+
+    def test_register(self):
+        registry = Registry('keyword')
+        with self.assertRaises(ValueError):
+            registry.register(None, BaseKeyword)
+        with self.assertRaises(ValueError):
+            registry.register('base', 'BaseKeyword')
+        registry.register('C481', C481Keyword, ['481'])
+        with self.assertRaises(ValueError):
+            registry.register('c481', C481Keyword)
+        self.assertEqual(['C481'], registry.names())
+
+    def test_lookup(self):
+        self.assertEqual('C484', KEYWORDS.resolve('c484'))
+        self.assertEqual('C484', KEYWORDS.resolve('CPSC484'))
+        self.assertEqual('C484', find_keyword(self.build_config, '484').name)
+        self.assertIsNone(KEYWORDS.resolve('C999'))
+        with self.assertRaises(UsageError):
+            find_keyword(self.build_config, 'C999')
+        with self.assertRaises(UsageError):
+            COMMANDS.create(self.build_config, 'frobnicate')
+
+    def test_names_match(self):
+        # the registered name must be the name the object reports
+        for registry in [KEYWORDS, COMMANDS]:
+            for name in registry.names():
+                self.assertEqual(name, registry.create(self.build_config, name).name)
+
+    def test_command_order(self):
+        # usage lists the original commands as it always did, newer ones after
+        self.assertEqual(['add', 'describe', 'init', 'installed', 'list', 'status', 'remove', 'rekey',
+                          'bundle', 'fleet', 'plan', 'proxy', 'verify'],
+                         COMMANDS.names())
+
+class TestCompileJobs(unittest.TestCase):
+    GIB = 1024 ** 3
+
+    def test_compile_jobs(self):
+        # a 2-core VM with little memory free
+        self.assertEqual(1, compile_jobs(2, self.GIB // 4))
+        self.assertEqual(2, compile_jobs(2, 8 * self.GIB))
+        # a big build host is limited by memory, not CPUs
+        self.assertEqual(32, compile_jobs(32, 64 * self.GIB))
+        self.assertEqual(8, compile_jobs(32, 4 * self.GIB))
+        self.assertGreaterEqual(compile_jobs(), 1)
+
+class TestDpkgStatusIndex(unittest.TestCase):
+    STATUS = ('Package: bash\n'
+              'Status: install ok installed\n'
+              'Version: 5.0-6ubuntu1\n'
+              'Description: GNU Bourne Again SHell\n'
+              ' Bash is an sh-compatible command language interpreter.\n'
+              '\n'
+              'Package: libc6\n'
+              'Status: install ok installed\n'
+              'Architecture: amd64\n'
+              'Version: 2.31-0ubuntu9\n'
+              '\n'
+              'Package: libc6\n'
+              'Status: deinstall ok config-files\n'
+              'Architecture: i386\n'
+              'Version: 2.31-0ubuntu8\n'
+              '\n'
+              'Package: clang\n'
+              'Status: install ok half-configured\n'
+              'Version: 1:10.0-50~exp1\n'
+              '\n'
+              'Package: nasm\n'
+              'Status: deinstall ok config-files\n'
+              'Version: 2.14.02-1\n')
+
+    def test_parse(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp, 'status')
+            path.write_text(self.STATUS)
+            index = DpkgStatusIndex(path)
+            self.assertEqual(4, len(index))
+            self.assertEqual('5.0-6ubuntu1', index.version('bash'))
+            # the installed architecture wins
+            self.assertEqual('2.31-0ubuntu9', index.version('libc6'))
+            self.assertTrue(index.is_installed('libc6'))
+            self.assertEqual('half-configured', index.state('clang'))
+            self.assertFalse(index.is_installed('clang'))
+            self.assertIsNone(index.version('nasm'))
+            self.assertIsNone(index.state('gdb'))
+            self.assertEqual((['nasm', 'gdb'], [('clang', 'half-configured')]),
+                             package_problems(index, ['bash', 'nasm', 'clang', 'gdb', 'libc6']))
+            with self.assertRaises(EnvironmentError):
+                DpkgStatusIndex(pathlib.Path(tmp, 'missing'))
+
+    def test_shared(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp, 'status')
+            path.write_text(self.STATUS)
+            index = dpkg_status(path)
+            self.assertIs(index, dpkg_status(path))
+            # read again once dpkg changed the file
+            path.write_text(self.STATUS.replace('half-configured', 'installed'))
+            self.assertTrue(dpkg_status(path).is_installed('clang'))
+
+    def test_verify(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            build_config = BuildConfig(VERSION, pathlib.Path(tmp, 'state.json'))
+            # keywords that are no longer defined are checked by what they installed
+            State(build_config, VERSION, ['shell', 'broken'],
+                  {'dpkg': ['shell', 'broken'], 'no-such-package': ['broken']}).write()
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                with self.assertRaises(EnvironmentError) as raised:
+                    VerifyCommand(build_config).execute([])
+            self.assertIn('shell: ok (1 packages)', output.getvalue())
+            self.assertIn('broken: partly installed', output.getvalue())
+            self.assertIn('missing: no-such-package', output.getvalue())
+            self.assertIn('tuffix add --reconcile broken', raised.exception.message)
+            with contextlib.redirect_stdout(io.StringIO()):
+                VerifyCommand(build_config).execute(['shell'])
+                with self.assertRaises(UsageError):
+                    VerifyCommand(build_config).execute(['nonsense'])
+
+class TestAptSession(unittest.TestCase):
+    def test_constructor(self):
+        with self.assertRaises(ValueError):
+            AptSession(-1)
+        with self.assertRaises(ValueError):
+            AptSession(60, lists_path='/var/lib/apt/lists')
+        with self.assertRaises(ValueError):
+            AptSession(60, sources_paths=['/etc/apt/sources.list'])
+        obj = AptSession(60)
+        self.assertEqual(60, obj.index_ttl)
+        self.assertFalse(obj.updated)
+
+    def test_needs_refresh(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            lists = pathlib.Path(tmp, 'lists')
+            sources = pathlib.Path(tmp, 'sources.list')
+            lists.mkdir()
+            sources.write_text('deb http://archive.ubuntu.com/ubuntu focal main\n')
+            session = AptSession(60, lists, [sources])
+            # no indexes at all
+            self.assertTrue(session.needs_refresh())
+            index = lists / 'archive.ubuntu.com_ubuntu_dists_focal_InRelease'
+            index.write_text('')
+            past = time.time() - 30
+            os.utime(sources, (past, past))
+            self.assertFalse(session.needs_refresh())
+            # indexes older than the TTL
+            os.utime(index, (past - 60, past - 60))
+            self.assertTrue(session.needs_refresh())
+            # a sources file changed after the indexes were downloaded
+            os.utime(index, (past, past))
+            os.utime(sources, None)
+            self.assertTrue(session.needs_refresh())
+            self.assertEqual([sources], session.changed_sources())
+            os.utime(sources, (past, past))
+            self.assertEqual([], session.changed_sources())
+
+# Construct the manifest keywords called names, even if they are disabled.
+def manifest_keywords(build_config, names):
+    with tempfile.TemporaryDirectory() as tmp:
+        index = KeywordIndex(build_config.manifest_path, pathlib.Path(tmp, 'keywords.json'))
+        manifests = {manifest['name']: manifest for manifest in index.load()}
+    return [ManifestKeyword(build_config, manifests[name]) for name in names]
+
+class TestKeywordIndex(unittest.TestCase):
+    MANIFEST = 'name: C999\ndescription: CPSC 999\npackages: [cowsay]\n'
+
+    def test_constructor(self):
+        with self.assertRaises(ValueError):
+            KeywordIndex('keywords', pathlib.Path('keywords.json'))
+        with self.assertRaises(ValueError):
+            KeywordIndex(KEYWORD_MANIFEST_PATH, None)
+
+    def test_repository_manifests(self):
+        # every manifest shipped with tuffix compiles
+        with tempfile.TemporaryDirectory() as tmp:
+            index = KeywordIndex(KEYWORD_MANIFEST_PATH, pathlib.Path(tmp, 'keywords.json'))
+            names = [manifest['name'] for manifest in index.load()]
+        self.assertIn('C484', names)
+        self.assertIn('latex', names)
+
+    def test_invalidation(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            manifests = pathlib.Path(tmp, 'keywords')
+            manifests.mkdir()
+            manifest = manifests / 'C999.yml'
+            manifest.write_text(self.MANIFEST)
+            index = KeywordIndex(manifests, pathlib.Path(tmp, 'keywords.json'))
+            self.assertEqual(['cowsay'], index.load()[0]['packages'])
+            self.assertTrue(index.compiled)
+            # unchanged
+            self.assertEqual(['cowsay'], index.load()[0]['packages'])
+            self.assertFalse(index.compiled)
+            # touched but the same content
+            past = time.time() - 60
+            os.utime(manifest, (past, past))
+            index.load()
+            self.assertFalse(index.compiled)
+            # changed
+            manifest.write_text(self.MANIFEST.replace('cowsay', 'fortune'))
+            os.utime(manifest, (past, past))
+            self.assertEqual(['fortune'], index.load()[0]['packages'])
+            self.assertTrue(index.compiled)
+            # removed
+            manifest.unlink()
+            self.assertEqual([], index.load())
+            self.assertTrue(index.compiled)
+
+    def test_malformed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            manifests = pathlib.Path(tmp, 'keywords')
+            manifests.mkdir()
+            index = KeywordIndex(manifests, pathlib.Path(tmp, 'keywords.json'))
+            for text in ['- just a list',
+                         'name: C999\n',
+                         'name: toolongname\ndescription: x\n',
+                         self.MANIFEST + 'packages: cowsay\n',
+                         self.MANIFEST + 'extra: 1\n',
+                         self.MANIFEST + 'artifacts: [{url: http://example.com}]\n']:
+                (manifests / 'C999.yml').write_text(text)
+                with self.assertRaises(EnvironmentError):
+                    index.load()
+
+# Just enough of apt.cache.Cache and apt.package.Package for Transaction.plan.
+class FakePackage:
+    # size: bytes both downloaded and installed for the package
+    def __init__(self, is_installed, size=0, is_auto_installed=False):
+        self.is_installed = is_installed
+        self.size = size
+        self.is_auto_installed = is_auto_installed
+        self.marked_install = self.marked_upgrade = self.marked_delete = False
+
+    def mark_auto(self, auto=True):
+        self.is_auto_installed = auto
+
+    def mark_install(self):
+        self.marked_install = not self.is_installed
+
+    def mark_delete(self):
+        self.marked_delete = self.is_installed
+
+class FakeCache(dict):
+    fetched = None
+
+    @property
+    def required_download(self):
+        return sum(package.size for package in self.values() if package.marked_install)
+
+    @property
+    def required_space(self):
+        return (sum(package.size for package in self.values() if package.marked_install) -
+                sum(package.size for package in self.values() if package.marked_delete))
+
+    def get_changes(self):
+        return [package for package in self.values()
+                if package.marked_install or package.marked_delete]
+
+    def actiongroup(self):
+        return contextlib.nullcontext()
+
+    def fetch_archives(self):
+        self.fetched = sorted(name for name, package in self.items() if package.marked_install)
+
+    def clear(self):
+        for package in self.values():
+            package.marked_install = package.marked_upgrade = package.marked_delete = False
+
+class TestBundle(unittest.TestCase):
+    def make_tar(self, path, names):
+        with tarfile.open(path, 'w') as tar:
+            for name in names:
+                info = tarfile.TarInfo(name)
+                info.size = 1
+                tar.addfile(info, io.BytesIO(b'x'))
+
+    def test_members(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp, 'bundle.tar')
+            self.make_tar(path, ['bundle.json', 'debs/nasm_2.14.deb'])
+            with tarfile.open(path) as tar:
+                self.assertEqual(['bundle.json', 'debs/nasm_2.14.deb'],
+                                 [member.name for member in bundle_members(tar)])
+            for name in ['../evil', '/etc/passwd', 'debs/../../evil']:
+                self.make_tar(path, ['bundle.json', name])
+                with tarfile.open(path) as tar:
+                    with self.assertRaises(EnvironmentError):
+                        bundle_members(tar)
+
+    def test_open_bundle(self):
+        # records what apt would have been shown, without apt
+        class FakeSession:
+            @contextlib.contextmanager
+            def only_sources(self, sources_list, lists_path):
+                self.sources = sources_list.read_text()
+                yield self
+
+        session = FakeSession()
+        build_config = BuildConfig(VERSION, pathlib.Path('/var/lib/tuffix/state.json'),
+                                   cache_path=pathlib.Path('/var/cache/tuffix'))
+        engine = DownloadEngine(cache=ArtifactCache(build_config.cache_path / 'artifacts'))
+        saved = tuffixlib._apt_session, tuffixlib._download_engine
+        try:
+            with pyfakefs.fake_filesystem_unittest.Patcher() as patcher:
+                patcher.fs.create_file('/etc/lsb-release', contents='DISTRIB_CODENAME=focal\n')
+                tuffixlib._apt_session, tuffixlib._download_engine = session, engine
+                clone = pathlib.Path('/tmp/clones/0.tar')
+                clone.parent.mkdir()
+                self.make_tar(clone, ['0.git/HEAD'])
+                url = 'https://example.com/project.git'
+                manifest = {'format': BUNDLE_FORMAT, 'codename': 'focal', 'keywords': ['base'],
+                            'packages': [], 'artifacts': [],
+                            'clones': [{'url': url, 'file': 'clones/0.tar', 'sha256': file_sha256(clone)}]}
+                path = pathlib.Path('/tmp/bundle.tar')
+                with tarfile.open(path, 'w') as tar:
+                    data = json.dumps(manifest).encode('utf-8')
+                    info = tarfile.TarInfo('bundle.json')
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+                    tar.add(clone, 'clones/0.tar')
+                with open_bundle(build_config, path) as opened:
+                    self.assertEqual(['base'], opened['keywords'])
+                    self.assertTrue(engine.offline)
+                    # the bundle's copy is cloned instead of the url
+                    repository = pathlib.Path('/var/cache/tuffix/bundles/bundle/clones/0.git')
+                    self.assertEqual({url: str(repository)},
+                                     {key: str(value) for key, value in tuffixlib._bundle_clones.items()})
+                    self.assertTrue((repository / 'HEAD').is_file())
+                self.assertEqual('deb [trusted=yes] file:/var/cache/tuffix/bundles/bundle ./\n',
+                                 session.sources)
+                # nothing is left for later apt runs to trust
+                self.assertEqual([], list(pathlib.Path('/var/cache/tuffix').rglob('*.list')))
+                self.assertFalse(BUNDLE_SOURCES_PATH.exists())
+                self.assertFalse(engine.offline)
+                self.assertEqual({}, tuffixlib._bundle_clones)
+        finally:
+            tuffixlib._apt_session, tuffixlib._download_engine = saved
+
+    def test_git_clone(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            git = ['git', '-c', 'user.name=t', '-c', 'user.email=t@example.com']
+            source = pathlib.Path(tmp, 'source')
+            subprocess.run(git + ['init', '-q', str(source)], check=True)
+            subprocess.run(git + ['commit', '-q', '--allow-empty', '-m', 'v1'], cwd=source, check=True)
+            repository = pathlib.Path(tmp, 'clones', '0.git')
+            subprocess.run(['git', 'clone', '-q', '--bare', str(source), str(repository)], check=True)
+            url = 'https://example.com/project.git'
+            with self.assertRaises(EnvironmentError):
+                git_clone(str(pathlib.Path(tmp, 'missing')), pathlib.Path(tmp, 'missing-clone'))
+            try:
+                tuffixlib._bundle_clones[url] = repository
+                dest = pathlib.Path(tmp, 'dest')
+                git_clone(url, dest, depth=1)
+            finally:
+                tuffixlib._bundle_clones.clear()
+            self.assertEqual(url, subprocess.check_output(['git', 'remote', 'get-url', 'origin'], cwd=dest,
+                                                          encoding='utf-8').strip())
+            self.assertEqual(subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=source),
+                             subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=dest))
+
+    def test_packages_stanza(self):
+        control = 'Package: nasm\nVersion: 2.14\nArchitecture: amd64\n'
+        self.assertEqual('Package: nasm\nVersion: 2.14\nArchitecture: amd64\n'
+                         'Filename: debs/nasm.deb\nSize: 3\nSHA256: abc\n\n',
+                         packages_stanza(control, 'debs/nasm.deb', 3, 'abc'))
+
+class TestTransaction(unittest.TestCase):
+    build_config = DEFAULT_BUILD_CONFIG
+
+    def test_constructor(self):
+        keywords = manifest_keywords(self.build_config, ['C223J', 'C223N'])
+        with self.assertRaises(ValueError):
+            Transaction(None, True)
+        with self.assertRaises(ValueError):
+            Transaction(['C223J'], True)
+        with self.assertRaises(ValueError):
+            Transaction(keywords, None)
+        obj = Transaction(keywords, True)
+        self.assertEqual(keywords, obj.keywords)
+        self.assertEqual(2, len(obj.reports))
+
+    def test_package_names(self):
+        # netbeans is shared between the two keywords, but only marked once
+        keywords = manifest_keywords(self.build_config, ['C223J', 'C223N'])
+        names = Transaction(keywords, True).package_names()
+        self.assertEqual(1, names.count('netbeans'))
+        self.assertEqual(set(keywords[0].packages) | set(keywords[1].packages),
+                         set(names))
+
+    def test_steps(self):
+        keywords = manifest_keywords(self.build_config, ['C223J', 'C223N'])
+        steps = {step.name: step for step in Transaction(keywords, True, AptSession(60)).steps()}
+        self.assertEqual([APT_PREFETCH_STEP, APT_STEP, 'C223J:pre_add', 'C223J:post_add',
+                          'C223N:pre_add', 'C223N:post_add'],
+                         list(steps))
+        # the prefetch runs alongside the keyword steps, the commit after it
+        self.assertEqual([], steps[APT_PREFETCH_STEP].requires)
+        self.assertEqual([], steps[APT_PREFETCH_STEP].resources)
+        self.assertEqual([APT_PREFETCH_STEP], steps[APT_STEP].requires)
+        # keyword steps keep their satisfied checks
+        self.assertIsNotNone(steps['C223N:post_add'].satisfied)
+        base = {step.name: step for step in BaseKeyword(self.build_config).steps()}
+        self.assertTrue(all(step.satisfied for step in base.values()))
+        # the sample project is built against the Google Test just built
+        self.assertEqual([APT_STEP], base['gtest_build'].requires)
+        self.assertIn('gtest_build', base['gtest'].requires)
+        self.assertEqual([APT_STEP], steps['C223N:pre_add'].before)
+        self.assertEqual([APT_STEP], steps['C223N:post_add'].requires)
+        self.assertEqual([APT_STEP], [step.name for step in Transaction(keywords, False, AptSession(60)).steps()])
+        # every step of the base keyword refers to steps that exist
+        StepRunner(Transaction([BaseKeyword(self.build_config)], True, AptSession(60)).steps())
+
+    def test_clone_waits_for_git(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.environ['PATH']
+            os.environ['PATH'] = tmp
+            try:
+                steps = Transaction([BaseKeyword(self.build_config)], True, AptSession(60)).steps()
+                # git only appears once the apt commit has run
+                def commit():
+                    git = pathlib.Path(tmp) / 'git'
+                    git.touch()
+                    git.chmod(0o755)
+                found = {}
+                functions = {APT_STEP: commit,
+                             'base:gtest_clone': lambda: found.update(git=shutil.which('git'))}
+                runner = StepRunner([Step(step.name, functions.get(step.name, lambda: None),
+                                          step.requires, step.before, step.resources)
+                                     for step in steps])
+                runner.run()
+                self.assertEqual([], runner.failures())
+                self.assertEqual(str(pathlib.Path(tmp) / 'git'), found['git'])
+            finally:
+                os.environ['PATH'] = path
+        # with git installed the clone overlaps with the apt commit
+        base = {step.name: step for step in BaseKeyword(self.build_config).steps()}
+        self.assertEqual([], base['gtest_clone'].requires)
+
+    def test_google_test_built(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            keyword = BaseKeyword(BuildConfig(VERSION, pathlib.Path(tmp) / 'state.json',
+                                              cache_path=pathlib.Path(tmp) / 'cache'))
+            keyword.GOOGLE_TEST_LIB_DIR = pathlib.Path(tmp) / 'lib'
+            self.assertFalse(keyword.google_test_built())
+            source = keyword.google_test_root() / 'source'
+            source.mkdir(parents=True)
+            git = ['git', '-c', 'user.name=t', '-c', 'user.email=t@example.com']
+            subprocess.run(git + ['init', '-q'], cwd=source, check=True)
+            subprocess.run(git + ['commit', '-q', '--allow-empty', '-m', 'v1'], cwd=source, check=True)
+            (keyword.google_test_root() / 'stamp.json').write_text(json.dumps(keyword.google_test_build_stamp()))
+            # the libraries are not installed
+            self.assertFalse(keyword.google_test_built())
+            keyword.GOOGLE_TEST_LIB_DIR.mkdir()
+            for name in keyword.GOOGLE_TEST_LIBRARIES:
+                (keyword.GOOGLE_TEST_LIB_DIR / name).touch()
+            self.assertTrue(keyword.google_test_built())
+            # a new commit in the checkout needs a new build
+            subprocess.run(git + ['commit', '-q', '--allow-empty', '-m', 'v2'], cwd=source, check=True)
+            self.assertFalse(keyword.google_test_built())
+
+    def test_plan(self):
+        keywords = manifest_keywords(self.build_config, ['C223J', 'C223N'])
+        session = AptSession(60)
+        cache = FakeCache({name: FakePackage(name == 'netbeans')
+                           for name in Transaction(keywords, True, session).package_names()})
+        transaction = Transaction(keywords, True, session)
+        transaction.plan(cache)
+        # netbeans is already installed, so it is skipped rather than marked
+        self.assertEqual(['netbeans'], transaction.reports[1].skipped)
+        self.assertEqual(['mono-complete'], transaction.reports[1].planned)
+        self.assertFalse(cache['netbeans'].marked_install)
+        # removing C223N must not remove netbeans while C223J still owns it
+        transaction = Transaction(keywords[1:], False, session, keep=['netbeans'])
+        transaction.plan(cache)
+        self.assertEqual(['netbeans'], transaction.reports[0].skipped)
+        self.assertFalse(cache['netbeans'].marked_delete)
+
+    def test_plan_dependency(self):
+        # keyword a pulled in libfoo as a dependency; keyword b asks for it
+        b = ManifestKeyword(self.build_config,
+                            {'name': 'b', 'description': '', 'packages': ['libfoo', 'bar'],
+                             'repositories': [], 'artifacts': [], 'post_install': []})
+        cache = FakeCache({'libfoo': FakePackage(True, is_auto_installed=True),
+                           'bar': FakePackage(False)})
+        transaction = Transaction([b], True, AptSession(60))
+        transaction.plan(cache)
+        self.assertEqual(['libfoo'], transaction.reports[0].skipped)
+        # so autoremove keeps it once a is removed
+        self.assertFalse(cache['libfoo'].is_auto_installed)
+        self.assertEqual(['libfoo'], transaction.manual)
+        transaction.plan(cache)
+        self.assertEqual([], transaction.manual)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp, 'extended_states')
+            self.assertEqual(set(), auto_installed_packages(['libfoo'], path))
+            path.write_text('Package: libfoo\nArchitecture: amd64\nAuto-Installed: 1\n\n'
+                            'Package: bar\nArchitecture: amd64\nAuto-Installed: 0\n\n'
+                            'Package: libbaz\nArchitecture: amd64\nAuto-Installed: 1\n')
+            self.assertEqual({'libfoo'}, auto_installed_packages(['libfoo', 'bar'], path))
+
+    def test_prefetch(self):
+        keywords = manifest_keywords(self.build_config, ['C223J', 'C223N'])
+        session = AptSession(60)
+        # mono-complete comes from a repository that is not added yet
+        cache = FakeCache({'netbeans': FakePackage(False), 'geany': FakePackage(True)})
+        session.cache = lambda: cache
+        Transaction(keywords, True, session).prefetch()
+        self.assertEqual(['netbeans'], cache.fetched)
+        # the marks are cleared for the commit to plan from scratch
+        self.assertFalse(cache['netbeans'].marked_install)
+
+    def test_estimate(self):
+        keywords = manifest_keywords(self.build_config, ['C223J', 'C223N'])
+        cache = FakeCache({'geany': FakePackage(True, 1), 'gthumb': FakePackage(False, 2),
+                           'netbeans': FakePackage(False, 4), 'openjdk-8-jdk': FakePackage(False, 8),
+                           'openjdk-8-jre': FakePackage(False, 16)})
+        transaction = Transaction(keywords, True, AptSession(60))
+        with tempfile.TemporaryDirectory() as tmp:
+            history = ThroughputHistory(pathlib.Path(tmp, 'throughput.json'))
+            history.record('download', 30, 1)
+            history.record('install', 15, 1)
+            estimate = transaction.estimate(cache, history)
+        self.assertEqual(4, estimate['changes'])
+        self.assertEqual(30, estimate['download_bytes'])
+        self.assertEqual(30, estimate['space_bytes'])
+        self.assertEqual(3.0, estimate['seconds'])
+        self.assertTrue(estimate['measured'])
+        # netbeans counts for C223J, which needs it first; mono-complete is
+        # not in the indexes
+        self.assertEqual(30, transaction.reports[0].download_bytes)
+        self.assertEqual(['geany'], transaction.reports[0].skipped)
+        self.assertEqual(0, transaction.reports[1].download_bytes)
+        self.assertEqual(['mono-complete'], transaction.reports[1].unknown)
+        self.assertFalse(cache['netbeans'].marked_install)
+        text = format_estimate(transaction.reports, estimate, True)
+        self.assertIn('C223J: 4 planned, 1 already present', text)
+        self.assertIn('not in the package indexes', text)
+        self.assertIn('predicted time: 3s\n', text + '\n')
+
+    def test_settled(self):
+        def keyword(packages):
+            return ManifestKeyword(self.build_config,
+                                   {'name': 'shell', 'description': '', 'packages': packages,
+                                    'repositories': [], 'artifacts': [], 'post_install': []})
+        installed = keyword(['dpkg', 'coreutils'])
+        saved = tuffixlib.APT_EXTENDED_STATES_PATH
+        with tempfile.TemporaryDirectory() as tmp:
+            try:
+                tuffixlib.APT_EXTENDED_STATES_PATH = pathlib.Path(tmp, 'extended_states')
+                transaction = Transaction([installed], True, AptSession(60))
+                self.assertTrue(transaction.settled())
+                self.assertEqual(['dpkg', 'coreutils'], transaction.reports[0].skipped)
+                self.assertFalse(Transaction([keyword(['dpkg', 'no-such-package'])], True, AptSession(60)).settled())
+                # installed, but only as a dependency, so the commit has to mark it
+                tuffixlib.APT_EXTENDED_STATES_PATH.write_text('Package: dpkg\nAuto-Installed: 1\n')
+                self.assertFalse(Transaction([installed], True, AptSession(60)).settled())
+            finally:
+                tuffixlib.APT_EXTENDED_STATES_PATH = saved
+        # removing: settled once nothing is left to remove except what is kept
+        self.assertFalse(Transaction([installed], False, AptSession(60), keep=['dpkg']).settled())
+        transaction = Transaction([installed], False, AptSession(60), keep=['dpkg', 'coreutils'])
+        self.assertTrue(transaction.settled())
+        self.assertEqual(['dpkg', 'coreutils'], transaction.reports[0].skipped)
+
+    def test_manifest_satisfied(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            dest = pathlib.Path(tmp, 'plugin.zip')
+            manifest = {'name': 'tools', 'description': '', 'packages': [], 'repositories': [],
+                        'artifacts': [{'url': 'http://example.com/plugin.zip', 'dest': str(dest),
+                                       'sha256': hashlib.sha256(b'plugin').hexdigest()}],
+                        'post_install': []}
+            keyword = ManifestKeyword(self.build_config, manifest)
+            self.assertTrue(keyword.pre_add_satisfied())
+            self.assertFalse(keyword.post_add_satisfied())
+            dest.write_bytes(b'plugin')
+            self.assertTrue(keyword.post_add_satisfied())
+            dest.write_bytes(b'changed')
+            self.assertFalse(keyword.post_add_satisfied())
+            manifest['post_install'] = ['true']
+            dest.write_bytes(b'plugin')
+            self.assertFalse(ManifestKeyword(self.build_config, manifest).post_add_satisfied())
+
+    def test_reconcile_downloads(self):
+        # records downloads instead of making them
+        class FakeEngine:
+            cache = None
+            def __init__(self):
+                self.submitted = []
+            def submit(self, artifact):
+                self.submitted.append(artifact.url)
+            def fetch_all(self, artifacts):
+                for artifact in artifacts:
+                    self.submit(artifact)
+                    artifact.dest.write_bytes(b'plugin')
+                return [artifact.dest for artifact in artifacts]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            dest = pathlib.Path(tmp, 'plugin.zip')
+            manifest = {'name': 'tools', 'description': '', 'packages': [], 'repositories': [],
+                        'artifacts': [{'url': 'http://example.com/plugin.zip', 'dest': str(dest),
+                                       'sha256': hashlib.sha256(b'plugin').hexdigest()}],
+                        'post_install': []}
+            saved = tuffixlib._download_engine
+            try:
+                tuffixlib._download_engine = engine = FakeEngine()
+                keyword = ManifestKeyword(self.build_config, manifest)
+                reports = Transaction([keyword], True, AptSession(60)).execute()
+                self.assertEqual(['pre_add'], reports[0].satisfied)
+                self.assertEqual(['http://example.com/plugin.zip'] * 2, engine.submitted)
+                # everything is in place: nothing is downloaded or revalidated
+                engine.submitted = []
+                reports = Transaction([keyword], True, AptSession(60)).execute()
+                self.assertEqual(['pre_add', 'post_add'], reports[0].satisfied)
+                self.assertEqual([], engine.submitted)
+            finally:
+                tuffixlib._download_engine = saved
+
+class TestThroughputHistory(unittest.TestCase):
+    def test_constructor(self):
+        with self.assertRaises(ValueError):
+            ThroughputHistory('/tmp/throughput.json')
+        with self.assertRaises(ValueError):
+            ThroughputHistory(pathlib.Path('/tmp/throughput.json'), 0)
+
+    def test_predict(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp, 'throughput.json')
+            history = ThroughputHistory(path, samples=2)
+            self.assertIsNone(history.rate('download'))
+            self.assertEqual((0.0, True), history.predict(0, 0))
+            seconds, measured = history.predict(THROUGHPUT_DEFAULTS['download'], 0)
+            self.assertEqual((1.0, False), (seconds, measured))
+            for size in [1000, 200, 400]:
+                history.record('download', size, 2)
+            history.record('install', 100, 0)
+            # only the last two measurements are kept, and they are saved
+            reread = ThroughputHistory(path)
+            self.assertEqual(150, reread.rate('download'))
+            self.assertIsNone(reread.rate('install'))
+            with self.assertRaises(ValueError):
+                history.record('unpack', 1, 1)
+
+    def test_disk_shortfalls(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp)
+            self.assertEqual([], disk_shortfalls(0, 0, path, path))
+            self.assertEqual([], disk_shortfalls(1000, -10 ** 15, path, path))
+            free = shutil.disk_usage(path).free
+            # both on one file system: the sizes add up
+            self.assertEqual(1, len(disk_shortfalls(free // 2, free // 2, path, path)))
+            self.assertEqual([], disk_shortfalls(10 ** 15, 0, path / 'missing', path))
+
+    def test_format_duration(self):
+        self.assertEqual('42s', format_duration(42.4))
+        self.assertEqual('4m 05s', format_duration(245))
+        self.assertEqual('2h 03m', format_duration(7380))
+
+class TestStepRunner(unittest.TestCase):
+    def test_constructor(self):
+        noop = lambda: None
+        with self.assertRaises(ValueError):
+            StepRunner([Step('a', noop), Step('a', noop)])
+        with self.assertRaises(ValueError):
+            StepRunner([Step('a', noop, requires=['b'])])
+        with self.assertRaises(ValueError):
+            StepRunner([Step('a', noop, requires=['b']), Step('b', noop, before=['a'], requires=['a'])])
+        with self.assertRaises(ValueError):
+            StepRunner([Step('a', noop)], workers=0)
+        with self.assertRaises(ValueError):
+            Step('a', None)
+
+    def test_order(self):
+        order = []
+        runner = StepRunner([Step('c', lambda: order.append('c'), requires=['b']),
+                             Step('b', lambda: order.append('b')),
+                             Step('a', lambda: order.append('a'), before=['b'])],
+                            workers=1)
+        self.assertEqual({'a': 'done', 'b': 'done', 'c': 'done'}, runner.run())
+        self.assertEqual(['a', 'b', 'c'], order)
+
+    def test_concurrency(self):
+        def sleep():
+            time.sleep(0.2)
+        start = time.monotonic()
+        StepRunner([Step(name, sleep) for name in 'abcd'], workers=4).run()
+        self.assertLess(time.monotonic() - start, 0.6)
+        # a shared resource serializes steps
+        active = []
+        overlapped = []
+        def exclusive():
+            active.append(1)
+            overlapped.append(len(active) > 1)
+            time.sleep(0.05)
+            active.pop()
+        StepRunner([Step(name, exclusive, resources=[DPKG_RESOURCE]) for name in 'abc']).run()
+        self.assertEqual([False] * 3, overlapped)
+
+    def test_failure_isolated(self):
+        def fail():
+            raise EnvironmentError('clone failed')
+        runner = StepRunner([Step('clone', fail),
+                             Step('build', lambda: None, requires=['clone']),
+                             Step('test', lambda: None, requires=['build']),
+                             Step('git', lambda: None)])
+        status = runner.run()
+        self.assertEqual('failed', status['clone'])
+        self.assertEqual('skipped', status['build'])
+        self.assertEqual('skipped', status['test'])
+        self.assertEqual('done', status['git'])
+        self.assertEqual(['clone', 'build', 'test'], runner.failures())
+        self.assertEqual('clone failed', runner.errors['clone'].message)
+
+    def test_satisfied(self):
+        ran = []
+        def broken():
+            raise OSError('no such command')
+        runner = StepRunner([Step('repo', lambda: ran.append('repo'), satisfied=lambda: True),
+                             Step('install', lambda: ran.append('install'), requires=['repo'],
+                                  satisfied=lambda: False),
+                             Step('git', lambda: ran.append('git'), satisfied=broken)])
+        status = runner.run()
+        # a satisfied step counts as success for the steps after it, and a
+        # check that cannot tell runs the step
+        self.assertEqual({'repo': 'satisfied', 'install': 'done', 'git': 'done'}, status)
+        self.assertEqual(['git', 'install'], sorted(ran))
+        self.assertEqual([], runner.failures())
+        with self.assertRaises(ValueError):
+            Step('a', lambda: None, satisfied=True)
+
+class TestStatusProbes(unittest.TestCase):
+    def test_constructor(self):
+        with self.assertRaises(ValueError):
+            StatusProbe(None, current_time)
+        with self.assertRaises(ValueError):
+            StatusProbe('time', 'not callable')
+        with self.assertRaises(ValueError):
+            StatusProbe('time', current_time, timeout=0)
+        obj = StatusProbe('time', current_time, degraded='never')
+        self.assertEqual('never', obj.degraded)
+
+    def test_names_unique(self):
+        names = [probe.name for probe in STATUS_PROBES]
+        self.assertEqual(len(names), len(set(names)))
+
+    def test_run(self):
+        def fail():
+            raise EnvironmentError('probe failed')
+        probes = [StatusProbe('slow', lambda: time.sleep(5), timeout=0.2, degraded='late'),
+                  StatusProbe('fast', lambda: 'value'),
+                  StatusProbe('broken', fail, degraded='unknown')]
+        probes += [StatusProbe(f'sleep{i}', lambda: time.sleep(0.1) or 'slept')
+                   for i in range(5)]
+        start = time.monotonic()
+        report = run_status_probes(probes)
+        # bounded by the slowest timeout, not the sum of the probes
+        self.assertLess(time.monotonic() - start, 0.45)
+        self.assertEqual('late', report['slow'])
+        self.assertEqual('value', report['fast'])
+        self.assertEqual('unknown', report['broken'])
+        self.assertEqual('slept', report['sleep4'])
+
+class TestStatusData(unittest.TestCase):
+    def test_select(self):
+        self.assertEqual(STATUS_PROBES, select_status_probes())
+        probes = select_status_probes(['installed', 'cpu'])
+        # in registry order, not request order
+        self.assertEqual(['cpu', 'installed'], [probe.name for probe in probes])
+        with self.assertRaises(UsageError):
+            select_status_probes(['cpu', 'bogus'])
+
+    def test_installed(self):
+        # read from the state of the given configuration, not the default one
+        build_config = BuildConfig(VERSION, pathlib.Path('/srv/lab/state.json'))
+        state = State(build_config, VERSION, ['base', 'C484'])
+        with pyfakefs.fake_filesystem_unittest.Patcher() as patcher:
+            patcher.fs.create_dir('/srv/lab')
+            state.write()
+            self.assertEqual({'installed': ['base', 'C484']}, status_data(build_config, ['installed']))
+
+    def test_format(self):
+        data = {'kernel': '5.4.0',
+                'git': {'username': 'tuffy', 'email': 'tuffy@fullerton.edu'},
+                'installed': ['base', 'C484']}
+        text = format_status(data)
+        self.assertIn('Kernel: 5.4.0', text)
+        self.assertIn('  - Username: tuffy', text)
+        self.assertIn('C484', text)
+        self.assertNotIn('CPU', text)
+
+class TestProbeCache(unittest.TestCase):
+    def test_constructor(self):
+        with self.assertRaises(ValueError):
+            ProbeCache('/var/cache/tuffix/status-0.json')
+        with self.assertRaises(ValueError):
+            ProbeCache(pathlib.Path('status.json'), 1234)
+        with self.assertRaises(ValueError):
+            StatusProbe('cpu', cpu_information, cache_ttl=0)
+
+    def test_path(self):
+        try:
+            os.getlogin()
+            self.skipTest('the login name comes from the terminal, not SUDO_USER')
+        except OSError:
+            pass
+        # status under sudo for two users must not share their git identities
+        saved = os.environ.get('SUDO_USER')
+        try:
+            os.environ['SUDO_USER'] = 'root'
+            root = probe_cache_path(DEFAULT_BUILD_CONFIG)
+            os.environ['SUDO_USER'] = 'nobody'
+            nobody = probe_cache_path(DEFAULT_BUILD_CONFIG)
+        finally:
+            if saved is None:
+                del os.environ['SUDO_USER']
+            else:
+                os.environ['SUDO_USER'] = saved
+        self.assertEqual(f'status-{os.getuid()}-{lookup_user("nobody").pw_uid}.json', nobody.name)
+        self.assertNotEqual(root, nobody)
+
+    def test_reuse(self):
+        calls = []
+        def count(name):
+            calls.append(name)
+            return name
+        probes = [StatusProbe('static', lambda: count('static'), cache_ttl=UNTIL_REBOOT),
+                  StatusProbe('dynamic', lambda: count('dynamic'))]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp, 'status.json')
+            for _ in range(3):
+                report = run_status_probes(probes, ProbeCache(path, 'boot-1'))
+                self.assertEqual({'static': 'static', 'dynamic': 'dynamic'}, report)
+            self.assertEqual(1, calls.count('static'))
+            self.assertEqual(3, calls.count('dynamic'))
+            # a reboot invalidates everything
+            run_status_probes(probes, ProbeCache(path, 'boot-2'))
+            self.assertEqual(2, calls.count('static'))
+
+# Serves artifacts for TestDownloadEngine on a local port.
+class ArtifactHandler(http.server.BaseHTTPRequestHandler):
+    lock = threading.Lock()
+    active = 0
+    peak = 0
+    flaky_failures = 0
+    # served by /large, first cut off halfway then resumed with a Range request
+    large = bytes(range(256)) * 1024
+    large_etag = '"large-v1"'
+    ranges = []
+    if_ranges = []
+    # number of full bodies served by /etag
+    etag_bodies = 0
+    # number of bodies served from /ubuntu/pool/
+    pool_bodies = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.active += 1
+            cls.peak = max(cls.peak, cls.active)
+        try:
+            if self.path.startswith('/slow/'):
+                time.sleep(0.2)
+                self.reply(200, self.path.encode())
+            elif self.path == '/flaky':
+                with cls.lock:
+                    fail = cls.flaky_failures < 2
+                    cls.flaky_failures += 1
+                self.reply(503 if fail else 200, b'flaky')
+            elif self.path == '/large':
+                self.large_reply()
+            elif self.path.startswith('/ubuntu/pool/'):
+                with cls.lock:
+                    cls.pool_bodies += 1
+                time.sleep(0.2)
+                self.reply(200, self.path.encode() * 1000)
+            elif self.path == '/ubuntu/dists/focal/InRelease':
+                self.reply(200, b'release')
+            elif self.path == '/etag':
+                if self.headers.get('If-None-Match') == '"v1"':
+                    self.send_response(304)
+                    self.end_headers()
+                else:
+                    cls.etag_bodies += 1
+                    self.send_response(200)
+                    self.send_header('ETag', '"v1"')
+                    self.send_header('Content-Length', '4')
+                    self.end_headers()
+                    self.wfile.write(b'etag')
+            else:
+                self.reply(404, b'')
+        finally:
+            with cls.lock:
+                cls.active -= 1
+
+    def large_reply(self):
+        cls = type(self)
+        requested = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        cls.ranges.append(requested)
+        cls.if_ranges.append(if_range)
+        if requested is None:
+            # promise the whole body but hang up halfway through
+            self.send_response(200)
+            self.send_header('ETag', cls.large_etag)
+            self.send_header('Content-Length', str(len(cls.large)))
+            self.end_headers()
+            self.wfile.write(cls.large[:len(cls.large) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        if if_range is not None and if_range != cls.large_etag:
+            # the file changed since the client got the start of it
+            self.send_response(200)
+            self.send_header('ETag', cls.large_etag)
+            self.send_header('Content-Length', str(len(cls.large)))
+            self.end_headers()
+            self.wfile.write(cls.large)
+            return
+        start = int(requested[len('bytes='):-1])
+        self.send_response(206)
+        self.send_header('ETag', cls.large_etag)
+        self.send_header('Content-Range', f'bytes {start}-{len(cls.large) - 1}/{len(cls.large)}')
+        self.send_header('Content-Length', str(len(cls.large) - start))
+        self.end_headers()
+        self.wfile.write(cls.large[start:])
+
+    def reply(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class TestDownloadEngine(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ArtifactHandler)
+        cls.url = f'http://127.0.0.1:{cls.server.server_address[1]}'
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = pathlib.Path(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_constructor(self):
+        with self.assertRaises(ValueError):
+            DownloadEngine(workers=0)
+        with self.assertRaises(ValueError):
+            DownloadEngine(connections_per_host=0)
+        with self.assertRaises(ValueError):
+            DownloadEngine(retries=-1)
+        with self.assertRaises(ValueError):
+            DownloadEngine().submit('http://example.com/file')
+
+    def test_per_host_limit(self):
+        ArtifactHandler.peak = 0
+        engine = DownloadEngine(workers=4, connections_per_host=2)
+        artifacts = [Artifact(f'{self.url}/slow/{i}', self.dir / f'{i}')
+                     for i in range(4)]
+        paths = engine.fetch_all(artifacts)
+        engine.shutdown()
+        self.assertEqual([artifact.dest for artifact in artifacts], paths)
+        self.assertEqual(b'/slow/3', paths[3].read_bytes())
+        self.assertEqual(2, ArtifactHandler.peak)
+
+    def test_retry(self):
+        ArtifactHandler.flaky_failures = 0
+        engine = DownloadEngine(retries=2, backoff=0)
+        path = engine.fetch(Artifact(f'{self.url}/flaky', self.dir / 'flaky'))
+        engine.shutdown()
+        self.assertEqual(b'flaky', path.read_bytes())
+
+    def test_resume(self):
+        ArtifactHandler.ranges = []
+        digest = hashlib.sha256(ArtifactHandler.large).hexdigest()
+        engine = DownloadEngine(retries=1, backoff=0)
+        artifact = Artifact(f'{self.url}/large', self.dir / 'large', digest)
+        path = engine.fetch(artifact)
+        engine.shutdown()
+        self.assertEqual(ArtifactHandler.large, path.read_bytes())
+        self.assertEqual(digest, engine.digests[path])
+        half = len(ArtifactHandler.large) // 2
+        self.assertEqual([None, f'bytes={half}-'], ArtifactHandler.ranges)
+        self.assertEqual([None, ArtifactHandler.large_etag], ArtifactHandler.if_ranges)
+        self.assertFalse((self.dir / 'large.part').exists())
+        self.assertFalse((self.dir / 'large.part.json').exists())
+
+    def test_resume_changed(self):
+        # an earlier run got the start of an older version of the file
+        ArtifactHandler.ranges, ArtifactHandler.if_ranges = [], []
+        artifact = Artifact(f'{self.url}/large', self.dir / 'large')
+        (self.dir / 'large.part').write_bytes(b'old version')
+        (self.dir / 'large.part.json').write_text(json.dumps({'url': artifact.url,
+                                                              'validator': '"large-v0"'}))
+        engine = DownloadEngine(retries=1, backoff=0)
+        path = engine.fetch(artifact)
+        engine.shutdown()
+        self.assertEqual(ArtifactHandler.large, path.read_bytes())
+        self.assertEqual(['"large-v0"'], ArtifactHandler.if_ranges)
+
+    def test_resume_unvalidated(self):
+        # neither a validator nor a digest: the .part file cannot be trusted
+        ArtifactHandler.ranges, ArtifactHandler.if_ranges = [], []
+        (self.dir / 'large.part').write_bytes(b'who knows')
+        engine = DownloadEngine(retries=1, backoff=0)
+        path = engine.fetch(Artifact(f'{self.url}/large', self.dir / 'large'))
+        engine.shutdown()
+        self.assertEqual(ArtifactHandler.large, path.read_bytes())
+        half = len(ArtifactHandler.large) // 2
+        self.assertEqual([None, f'bytes={half}-'], ArtifactHandler.ranges)
+
+    def test_checksum_mismatch(self):
+        engine = DownloadEngine(retries=2, backoff=0)
+        ArtifactHandler.flaky_failures = 2
+        with self.assertRaises(EnvironmentError):
+            engine.fetch(Artifact(f'{self.url}/flaky', self.dir / 'flaky', '0' * 64))
+        engine.shutdown()
+        self.assertFalse((self.dir / 'flaky').exists())
+
+    def test_not_found(self):
+        engine = DownloadEngine(backoff=0)
+        with self.assertRaises(EnvironmentError):
+            engine.fetch(Artifact(f'{self.url}/missing', self.dir / 'missing'))
+        engine.shutdown()
+
+    def test_cache_revalidation(self):
+        ArtifactHandler.etag_bodies = 0
+        cache = ArtifactCache(self.dir / 'cache')
+        for run in range(2):
+            # a fresh engine per run, like two separate tuffix invocations
+            engine = DownloadEngine(cache=cache)
+            path = engine.fetch(Artifact(f'{self.url}/etag', self.dir / 'etag'))
+            engine.shutdown()
+            self.assertEqual(b'etag', path.read_bytes())
+        self.assertEqual(1, ArtifactHandler.etag_bodies)
+        self.assertEqual(1, cache.stats['misses'])
+        self.assertEqual(1, cache.stats['revalidated'])
+
+    def test_cache_evicted_before_revalidation(self):
+        # the cached file goes away between the lookup and the 304
+        class EvictingCache(ArtifactCache):
+            def lookup(self, url):
+                entry = super().lookup(url)
+                if entry:
+                    self._object_path(entry['sha256']).unlink()
+                return entry
+
+        ArtifactHandler.etag_bodies = 0
+        cache = EvictingCache(self.dir / 'cache')
+        for run in range(2):
+            engine = DownloadEngine(cache=cache, retries=0)
+            path = engine.fetch(Artifact(f'{self.url}/etag', self.dir / 'etag'))
+            engine.shutdown()
+            self.assertEqual(b'etag', path.read_bytes())
+        # asked again without If-None-Match rather than keeping an empty file
+        self.assertEqual(2, ArtifactHandler.etag_bodies)
+        self.assertEqual(0, cache.stats['revalidated'])
+        self.assertEqual(hashlib.sha256(b'etag').hexdigest(),
+                         ArtifactCache(self.dir / 'cache').lookup(f'{self.url}/etag')['sha256'])
+
+    def test_offline(self):
+        cache = ArtifactCache(self.dir / 'cache')
+        seed = self.dir / 'seed'
+        seed.write_bytes(b'from a bundle')
+        cache.insert('http://example.invalid/seed', seed, hashlib.sha256(b'from a bundle').hexdigest())
+        self.assertEqual(0, cache.stats['misses'])
+        engine = DownloadEngine(cache=cache)
+        engine.offline = True
+        path = engine.fetch(Artifact('http://example.invalid/seed', self.dir / 'copy'))
+        self.assertEqual(b'from a bundle', path.read_bytes())
+        # not cached, and the network is off limits even though it works
+        with self.assertRaises(EnvironmentError):
+            engine.fetch(Artifact(f'{self.url}/etag', self.dir / 'etag'))
+        engine.shutdown()
+
+    def test_cache_by_digest(self):
+        cache = ArtifactCache(self.dir / 'cache')
+        digest = hashlib.sha256(b'etag').hexdigest()
+        engine = DownloadEngine(cache=cache)
+        engine.fetch(Artifact(f'{self.url}/etag', self.dir / 'etag', digest))
+        # same content under another URL that does not even exist
+        path = engine.fetch(Artifact(f'{self.url}/missing', self.dir / 'copy', digest))
+        engine.shutdown()
+        self.assertEqual(b'etag', path.read_bytes())
+        self.assertEqual(1, cache.stats['hits'])
+
+class TestProxy(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.upstream = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ArtifactHandler)
+        cls.upstream_url = f'http://127.0.0.1:{cls.upstream.server_address[1]}'
+        threading.Thread(target=cls.upstream.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.upstream.shutdown()
+        cls.upstream.server_close()
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = ProxyCache(pathlib.Path(self.tmp.name), ['127.0.0.1', 'archive.ubuntu.com'])
+        self.server = proxy_server(('127.0.0.1', 0), self.cache, self.upstream_url)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def get(self, path):
+        with urllib.request.urlopen(self.url + path) as response:
+            return response.read()
+
+    def test_path_for(self):
+        root = self.cache.root
+        self.assertEqual(root / 'archive.ubuntu.com/ubuntu/pool/main/n/nasm/nasm_2.14.deb',
+                         self.cache.path_for('http://archive.ubuntu.com/ubuntu/pool/main/n/nasm/nasm_2.14.deb'))
+        self.assertIsNotNone(self.cache.path_for('http://archive.ubuntu.com/ubuntu/dists/focal/main/by-hash/SHA256/ab12'))
+        self.assertIsNone(self.cache.path_for('http://archive.ubuntu.com/ubuntu/dists/focal/InRelease'))
+        self.assertIsNone(self.cache.path_for('http://archive.ubuntu.com/ubuntu/../../etc/x.deb'))
+        self.assertIsNone(self.cache.path_for('https://archive.ubuntu.com/ubuntu/pool/x.deb'))
+        # host names that would escape or collide within the cache root
+        self.assertIsNone(self.cache.path_for('http://../ubuntu/pool/x.deb'))
+        self.assertIsNone(self.cache.path_for('http://archive.ubuntu.com..//ubuntu/pool/x.deb'))
+        self.assertIsNone(self.cache.path_for('http://[::1]/ubuntu/pool/x.deb'))
+        self.assertIsNone(self.cache.path_for('http://user@archive.ubuntu.com/ubuntu/pool/x.deb'))
+        # a mirror that was not configured
+        self.assertIsNone(self.cache.path_for('http://evil.example.com/ubuntu/pool/x.deb'))
+        self.assertFalse(self.cache.allowed('http://evil.example.com/ubuntu/dists/focal/InRelease'))
+        self.assertTrue(self.cache.allowed('http://ARCHIVE.ubuntu.com/ubuntu/dists/focal/InRelease'))
+
+    def test_foreign_host(self):
+        # localhost is the same server, but not an allowed mirror
+        opener = urllib.request.build_opener(urllib.request.ProxyHandler({'http': self.url}))
+        foreign = self.upstream_url.replace('127.0.0.1', 'localhost')
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            opener.open(foreign + '/ubuntu/dists/focal/InRelease')
+        self.assertEqual(403, context.exception.code)
+        self.assertEqual(0, self.cache.report()['passthrough'])
+
+    def test_client_address(self):
+        command = ProxyCommand(DEFAULT_BUILD_CONFIG)
+        self.assertEqual(f'lab1:{PROXY_PORT}', command.address('lab1'))
+        self.assertEqual('10.0.0.5:8080', command.address('10.0.0.5:8080'))
+        self.assertEqual('[fd00::5]:3142', command.address('[fd00::5]'))
+        # anything that could add to the apt.conf line is refused
+        for text in ['lab1"; Acquire::http::Proxy "http://evil', 'lab1\nAPT::Get::Assume-Yes "true";',
+                     'lab1;', 'lab1:port', 'lab1:70000', 'lab1:0', '[fd00::5', '[lab1]', 'fd00::5', '',
+                     'user@lab1', 'lab1/path']:
+            with self.assertRaises(UsageError):
+                command.address(text)
+        with self.assertRaises(UsageError):
+            command.execute(['client', 'lab1"; evil "x'])
+
+    def test_upstream_cut_off(self):
+        # /large hangs up halfway through the body
+        with self.assertRaises(http.client.IncompleteRead):
+            self.get('/large')
+        self.assertEqual(1, self.cache.report()['errors'])
+        # the proxy is still serving
+        self.assertEqual(b'release', self.get('/ubuntu/dists/focal/InRelease'))
+
+    def test_apt_source_hosts(self):
+        root = pathlib.Path(self.tmp.name)
+        (root / 'sources.list').write_text(
+            '# deb http://commented.example.com/ubuntu focal main\n'
+            'deb http://us.archive.ubuntu.com/ubuntu/ focal main\n'
+            'deb-src [arch=amd64] http://security.ubuntu.com/ubuntu focal-security main\n')
+        (root / 'sources.list.d').mkdir()
+        (root / 'sources.list.d' / 'vscode.sources').write_text(
+            'Types: deb\nURIs: https://packages.microsoft.com/repos/code\nSuites: stable\n')
+        (root / 'sources.list.d' / 'old.list.save').write_text('deb http://old.example.com/ focal main\n')
+        self.assertEqual({'us.archive.ubuntu.com', 'security.ubuntu.com', 'packages.microsoft.com'},
+                         apt_source_hosts([root / 'sources.list', root / 'sources.list.d']))
+
+    def test_single_flight(self):
+        ArtifactHandler.pool_bodies = 0
+        path = '/ubuntu/pool/main/a.deb'
+        with ThreadPoolExecutor(4) as pool:
+            bodies = list(pool.map(lambda _: self.get(path), range(4)))
+        expected = path.encode() * 1000
+        self.assertEqual([expected] * 4, bodies)
+        self.assertEqual(1, ArtifactHandler.pool_bodies)
+        # now it is on disk
+        self.assertEqual(expected, self.get(path))
+        self.assertEqual(1, ArtifactHandler.pool_bodies)
+        report = json.loads(self.get(PROXY_STATS_PATH))
+        self.assertEqual(1, report['misses'])
+        # the last request may still find the first fetch finishing up
+        self.assertEqual(4, report['coalesced'] + report['hits'])
+        self.assertEqual(0.8, report['hit_rate'])
+        self.assertEqual(len(expected), report['bytes_from_upstream'])
+
+    def test_absolute_url(self):
+        # as apt sends it with Acquire::http::Proxy
+        opener = urllib.request.build_opener(urllib.request.ProxyHandler({'http': self.url}))
+        with opener.open(self.upstream_url + '/ubuntu/dists/focal/InRelease') as response:
+            self.assertEqual(b'release', response.read())
+        self.assertEqual(1, self.cache.report()['passthrough'])
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            opener.open(self.upstream_url + '/missing.deb')
+        self.assertEqual(404, context.exception.code)
+        # errors are relayed, not cached
+        self.assertEqual([], [path for path in self.cache.root.rglob('*') if path.is_file()])
+
+class TestArtifactCache(unittest.TestCase):
+    def test_constructor(self):
+        with self.assertRaises(ValueError):
+            ArtifactCache('/var/cache/tuffix')
+        with self.assertRaises(ValueError):
+            ArtifactCache(pathlib.Path('/var/cache/tuffix'), -1)
+        obj = ArtifactCache(pathlib.Path('/var/cache/tuffix'), 100)
+        self.assertEqual(100, obj.max_bytes)
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = pathlib.Path(tmp)
+            cache = ArtifactCache(root / 'cache', max_bytes=10)
+            for name in ['a', 'b', 'c']:
+                path = root / name
+                path.write_bytes(name.encode() * 4)
+                digest = hashlib.sha256(path.read_bytes()).hexdigest()
+                cache.store(f'http://example.com/{name}', path, digest, {})
+                time.sleep(0.01)
+            # 12 bytes do not fit in 10, so the oldest file went
+            self.assertIsNone(cache.lookup('http://example.com/a'))
+            self.assertIsNotNone(cache.lookup('http://example.com/c'))
+            self.assertEqual(8, cache.size())
+            self.assertEqual(1, cache.stats['evicted'])
+
+# Stands in for ssh: [-p PORT] HOST -- COMMAND. Hosts named slow* hang,
+# down* cannot be reached, bad* fail and long* print a 200 KB line; the
+# others print what they ran.
+FAKE_SSH = """
+if [ "$1" = -p ]; then shift 2; fi
+host=$1; shift 2
+case $host in
+    slow*) sleep 10 ;;
+    long*) head -c 200000 /dev/zero | tr '\\0' x; echo ;;
+    down*) echo "ssh: connect to host $host port 22: Connection refused"; exit 255 ;;
+esac
+sleep 0.2
+echo "$host: $*"
+case $host in bad*) echo "tuffix: it broke"; exit 3 ;; esac
+"""
+
+class TestFleet(unittest.TestCase):
+    def runner(self, names, **kwargs):
+        hosts = [FleetHost(name) for name in names]
+        return FleetRunner(hosts, ['add', 'base'], ssh=['sh', '-c', FAKE_SSH, 'ssh'], **kwargs)
+
+    def run_quietly(self, runner):
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            results = runner.run()
+        return results, out.getvalue()
+
+    def test_read_inventory(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp) / 'lab'
+            path.write_text('# CS 101\nlab-01\n\nstudent@lab-02:2222  # spare\n')
+            self.assertEqual([FleetHost('lab-01'), FleetHost('student@lab-02', 2222)],
+                             read_inventory(path))
+            path.write_text('lab-01\nlab-01\n')
+            with self.assertRaises(EnvironmentError):
+                read_inventory(path)
+            path.write_text('lab 01\n')
+            with self.assertRaises(EnvironmentError):
+                read_inventory(path)
+            path.write_text('# nothing\n')
+            with self.assertRaises(EnvironmentError):
+                read_inventory(path)
+            with self.assertRaises(EnvironmentError):
+                read_inventory(pathlib.Path(tmp) / 'missing')
+
+    def test_constructor(self):
+        with self.assertRaises(ValueError):
+            FleetRunner(['lab-01'], ['status'])
+        with self.assertRaises(ValueError):
+            FleetRunner([FleetHost('lab-01')], ['status'], concurrency=0)
+        runner = FleetRunner([FleetHost('lab-01', 2222)], ['add', 'C++ tools'])
+        self.assertEqual(FLEET_SSH + ['-p', '2222', 'lab-01', '--', "sudo -n tuffix add 'C++ tools'"],
+                         runner.ssh_argv(runner.hosts[0]))
+
+    def test_concurrency(self):
+        runner = self.runner([f'lab-{i}' for i in range(6)], concurrency=3, canaries=0)
+        start = time.perf_counter()
+        results, out = self.run_quietly(runner)
+        seconds = time.perf_counter() - start
+        # two rounds of three hosts, not six in a row
+        self.assertGreaterEqual(seconds, 0.4)
+        self.assertLess(seconds, 1.0)
+        self.assertEqual(['ok'] * 6, [result.status for result in results])
+        self.assertEqual(['lab-0: sudo -n tuffix add base'], results[0].tail)
+        self.assertIn('[6/6]', out)
+
+    def test_statuses(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            runner = self.runner(['lab-1', 'bad-1', 'down-1', 'slow-1'], timeout=1, canaries=0,
+                                 log_dir=pathlib.Path(tmp))
+            results, _ = self.run_quietly(runner)
+            self.assertEqual(['ok', 'failed', 'unreachable', 'timeout'],
+                             [result.status for result in results])
+            self.assertEqual(3, results[1].returncode)
+            self.assertEqual('tuffix: it broke', results[1].tail[-1])
+            self.assertIsNone(results[3].returncode)
+            self.assertEqual('bad-1: sudo -n tuffix add base\ntuffix: it broke\n',
+                             (pathlib.Path(tmp) / 'bad-1.log').read_text())
+        summary = format_fleet_summary(results, runner.seconds)
+        self.assertIn('1 ok, 1 failed, 1 unreachable, 1 timeout, 0 skipped', summary)
+        self.assertIn('  bad-1: failed, exit 3', summary)
+        self.assertIn('slowest: slow-1', summary)
+
+    def test_long_lines(self):
+        results, _ = self.run_quietly(self.runner(['long-1', 'lab-1'], canaries=0))
+        self.assertEqual(['ok', 'ok'], [result.status for result in results])
+        self.assertEqual('x' * FLEET_LINE_LENGTH, results[0].tail[0])
+        self.assertEqual('long-1: sudo -n tuffix add base', results[0].tail[-1])
+
+    def test_interrupt(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            inventory = pathlib.Path(tmp) / 'lab'
+            inventory.write_text('lab-1\nslow-1\nslow-2\n')
+            command = FleetCommand(BuildConfig(VERSION, pathlib.Path(tmp) / 'state.json'))
+            # Ctrl-C while the slow hosts are still running
+            timer = threading.Timer(1.0, lambda: os.kill(os.getpid(), signal.SIGINT))
+            timer.start()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                with self.assertRaises(EnvironmentError):
+                    command.execute([f'--ssh=sh -c {shlex.quote(FAKE_SSH)} ssh', '--canary=0',
+                                     str(inventory), 'status'])
+            timer.join()
+            self.assertLess(time.perf_counter() - start, 5)
+            self.assertIn('1 ok, 0 failed, 0 unreachable, 0 timeout, 0 skipped, 2 interrupted',
+                          out.getvalue())
+        # no fake ssh is left sleeping
+        sleeping = subprocess.run(['ps', '-eo', 'args'], stdout=subprocess.PIPE,
+                                  encoding='utf-8').stdout.splitlines()
+        self.assertNotIn('sleep 10', sleeping)
+
+    def test_canary(self):
+        results, out = self.run_quietly(self.runner(['bad-1', 'lab-1', 'lab-2'], canaries=1))
+        self.assertEqual(['failed', 'skipped', 'skipped'], [result.status for result in results])
+        self.assertIn('skipping the other 2 hosts', out)
+        results, _ = self.run_quietly(self.runner(['lab-1', 'bad-1', 'lab-2'], canaries=1))
+        self.assertEqual(['ok', 'failed', 'ok'], [result.status for result in results])
 
-        # TODO: check that writing to a pyfakefs works
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            inventory = pathlib.Path(tmp) / 'lab'
+            inventory.write_text('lab-1\nlab-2\n')
+            build_config = BuildConfig(VERSION, pathlib.Path(tmp) / 'state.json')
+            command = FleetCommand(build_config)
+            ssh = f'--ssh=sh -c {shlex.quote(FAKE_SSH)} ssh'
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                command.execute([ssh, str(inventory), 'status'])
+            self.assertIn('2 ok, 0 failed', out.getvalue())
+            inventory.write_text('lab-1\nbad-2\n')
+            with contextlib.redirect_stdout(io.StringIO()):
+                with self.assertRaises(EnvironmentError):
+                    command.execute([ssh, str(inventory), 'status'])
+            with self.assertRaises(UsageError):
+                command.execute(['--concurrency=many', str(inventory), 'status'])
+            with self.assertRaises(UsageError):
+                command.execute([str(inventory)])
 
 if __name__ == '__main__':
     unittest.main()
@@ -5,27 +5,36 @@
 
 # standard library
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
+import collections
+import contextlib
+import functools
+import hashlib
 import io
 import json
 import os
 import pathlib
+import pwd
 import re
+import shlex
 import shutil
+import signal
 import socket
 import subprocess
 import sys
-import unittest
+import threading
+import time
+import urllib.parse
+import getpass
 
 # packages
-import apt.cache
-import apt.debfile
 import packaging.version
 from termcolor import colored
-import requests
-from Crypto.PublicKey import RSA
-import gnupg
-import getpass
+
+# Heavy packages (apt, requests, Crypto, gnupg, yaml) are imported inside the
+# functions that use them, so that read-only commands such as list and
+# describe start quickly and work without them.
 
 ################################################################################
 # constants
@@ -35,8 +44,143 @@ VERSION = packaging.version.parse('0.1.0')
 
 STATE_PATH = pathlib.Path('/var/lib/tuffix/state.json')
 
+# Records appended to the state journal before State.write compacts it into
+# the state file.
+JOURNAL_COMPACT_RECORDS = 32
+
+# Files that tuffix can recreate, e.g. downloaded artifacts, live under here.
+CACHE_PATH = pathlib.Path('/var/cache/tuffix')
+
 KEYWORD_MAX_LENGTH = 8
 
+# Owner recorded for a package that was already installed when a keyword first
+# asked for it. It is never a keyword name, so such packages are never removed.
+SYSTEM_OWNER = '(system)'
+
+# Directory of YAML manifests for keywords that are only packages and simple
+# steps; see KeywordIndex.
+KEYWORD_MANIFEST_PATH = pathlib.Path(__file__).resolve().parent / 'keywords'
+
+# Bumped whenever the layout of the compiled keyword index changes.
+KEYWORD_INDEX_FORMAT = 1
+
+# Where apt keeps its downloaded package indexes, and the files that say
+# where to download them from.
+APT_LISTS_PATH = pathlib.Path('/var/lib/apt/lists')
+APT_SOURCES_PATHS = [pathlib.Path('/etc/apt/sources.list'),
+                     pathlib.Path('/etc/apt/sources.list.d')]
+
+# Package indexes younger than this many seconds are not refreshed.
+APT_INDEX_TTL = 6 * 60 * 60
+
+# Limits for downloading files that do not come from apt.
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_CONNECTIONS_PER_HOST = 2
+DOWNLOAD_TIMEOUT = (10, 60) # (connect, read) in seconds
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 1.0 # seconds before the first retry, doubled each time
+DOWNLOAD_CHUNK_SIZE = 64 * 1024 # bytes held in memory per download
+
+# The artifact cache evicts least recently used files beyond this size.
+ARTIFACT_CACHE_MAX_BYTES = 4 * 1024 ** 3
+
+# Defaults for `tuffix proxy`: the port apt-cacher-ng also uses, the mirror
+# that path-only requests go to, and the path that reports statistics.
+PROXY_PORT = 3142
+PROXY_UPSTREAM = 'http://archive.ubuntu.com'
+PROXY_STATS_PATH = '/tuffix-proxy/stats'
+
+# apt configuration written by `tuffix proxy client`.
+APT_PROXY_CONF_PATH = pathlib.Path('/etc/apt/apt.conf.d/01tuffix-proxy')
+
+# Bumped whenever the layout of `tuffix bundle` files changes.
+BUNDLE_FORMAT = 1
+
+# Dependencies followed when collecting the packages for a bundle; apt
+# installs recommended packages by default, so they are included.
+BUNDLE_DEPENDENCY_TYPES = ['PreDepends', 'Depends', 'Recommends']
+
+# Where apt keeps the .deb files it downloaded.
+APT_ARCHIVES_PATH = pathlib.Path('/var/cache/apt/archives')
+
+# dpkg's database of the packages it knows about and their states.
+DPKG_STATUS_PATH = pathlib.Path('/var/lib/dpkg/status')
+
+# apt's record of the packages it only installed as dependencies.
+APT_EXTENDED_STATES_PATH = pathlib.Path('/var/lib/apt/extended_states')
+
+# apt source that earlier versions of `tuffix bundle install` left behind;
+# removed whenever a bundle is installed.
+BUNDLE_SOURCES_PATH = pathlib.Path('/etc/apt/sources.list.d/tuffix-bundle.list')
+
+# Seconds that `tuffix status` waits for one probe before reporting it as
+# unknown.
+STATUS_PROBE_TIMEOUT = 2.0
+
+# Identifies the current boot; cached status values from an earlier boot are
+# discarded.
+BOOT_ID_PATH = pathlib.Path('/proc/sys/kernel/random/boot_id')
+
+# cache_ttl of a status probe whose value cannot change until reboot
+UNTIL_REBOOT = float('inf')
+
+# Memory one parallel C++ compile job is assumed to need; builds run no more
+# jobs than available memory allows.
+COMPILE_JOB_MEMORY = 512 * 1024 ** 2
+
+# Maximum number of keyword steps, e.g. clones and builds, running at once.
+STEP_WORKERS = 4
+
+# Name of the step that commits the package changes of a Transaction; keyword
+# steps use it in requires/before.
+APT_STEP = 'apt'
+
+# Name of the step that downloads the packages of a Transaction ahead of the
+# commit, while the keywords' other steps run.
+APT_PREFETCH_STEP = 'apt-prefetch'
+
+# Resources that only one step may hold at a time.
+DPKG_RESOURCE = 'dpkg'
+TERMINAL_RESOURCE = 'terminal'
+
+# Where dpkg unpacks most of what it installs, for the free space check.
+INSTALL_ROOT_PATH = pathlib.Path('/usr')
+
+# Free space left over after a transaction, below which it is refused.
+DISK_SPACE_MARGIN = 100 * 1000 ** 2
+
+# Measurements of apt throughput that are kept to predict how long a
+# transaction takes, per kind (download, install).
+THROUGHPUT_SAMPLES = 20
+
+# Bytes per second assumed before anything was measured on this host.
+THROUGHPUT_DEFAULTS = {'download': 4 * 1000 ** 2, 'install': 25 * 1000 ** 2}
+
+# How `tuffix fleet` reaches a lab host. BatchMode makes ssh fail rather than
+# ask for a password nobody is there to type.
+FLEET_SSH = ['ssh', '-o', 'BatchMode=yes', '-o', 'ConnectTimeout=10']
+
+# The tuffix that `tuffix fleet` runs on each host; it must not prompt for
+# the sudo password either.
+FLEET_REMOTE = ['sudo', '-n', 'tuffix']
+
+# Hosts that `tuffix fleet` works on at once.
+FLEET_CONCURRENCY = 20
+
+# Seconds one host may take before `tuffix fleet` gives up on it.
+FLEET_TIMEOUT = 30 * 60
+
+# Hosts that run the command first, alone; the rest only start when all of
+# them succeeded.
+FLEET_CANARIES = 1
+
+# Last lines of a host's output kept for the `tuffix fleet` summary.
+FLEET_TAIL_LINES = 5
+
+# Characters of one output line kept for the `tuffix fleet` summary; longer
+# lines, e.g. progress bars without a newline, keep their end.
+FLEET_LINE_LENGTH = 1000
+
 ################################################################################
 # exception types
 ################################################################################
@@ -90,46 +234,254 @@ class PrivilageExecutionException(MessageException):
 class BuildConfig:
     # version: packaging.Version for the currently-running tuffix
     # state_path: pathlib.Path holding the path to state.json
+    # apt_index_ttl: age in seconds after which apt package indexes are
+    #   considered stale and get refreshed
+    # cache_path: pathlib.Path of the directory for cached downloads
+    # manifest_path: pathlib.Path of the directory of keyword manifests
     def __init__(self,
                  version,
-                 state_path):
+                 state_path,
+                 apt_index_ttl=APT_INDEX_TTL,
+                 cache_path=CACHE_PATH,
+                 manifest_path=KEYWORD_MANIFEST_PATH):
         if not (isinstance(version, packaging.version.Version) and
                 isinstance(state_path, pathlib.Path) and
-                state_path.suffix == '.json'):
+                state_path.suffix == '.json' and
+                isinstance(apt_index_ttl, (int, float)) and
+                apt_index_ttl >= 0 and
+                isinstance(cache_path, pathlib.Path) and
+                isinstance(manifest_path, pathlib.Path)):
             raise ValueError
         self.version = version
         self.state_path = state_path
+        self.apt_index_ttl = apt_index_ttl
+        self.cache_path = cache_path
+        self.manifest_path = manifest_path
         self.server_path = "root@144.202.127.25"
 
 # Singleton BuildConfig object using the constants declared at the top of
 # this file.
 DEFAULT_BUILD_CONFIG = BuildConfig(VERSION, STATE_PATH)
 
-# Current state of tuffix, saved in a .json file under /var.
+# Path of a cache file called name: under the build's cache directory when we
+# can write there (e.g. as root), otherwise under the user's own cache
+# directory.
+# build_config: a BuildConfig object
+# name: file name, a string
+def cache_file_path(build_config, name):
+    if not (isinstance(build_config, BuildConfig) and
+            isinstance(name, str)):
+        raise ValueError
+    if os.getuid() == 0 or os.access(build_config.cache_path, os.W_OK):
+        return build_config.cache_path / name
+    xdg_cache = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return pathlib.Path(xdg_cache, 'tuffix', name)
+
+# Current state of tuffix, saved under /var as a snapshot, state.json, plus
+# a journal, state.journal, of the keywords added and removed since. Every
+# change is appended to the journal and synced before anything else happens,
+# so an interrupted tuffix loses at most the change it was making; the
+# snapshot is only ever replaced atomically. Reading the state replays the
+# journal, and the journal is compacted into a new snapshot once it holds
+# JOURNAL_COMPACT_RECORDS records.
 class State:
     # build_config: a BuildConfig object
     # version: packaging.Version for the tuffix version that created this state
     # installed: list of strings representing the codewords that are currently installed
-    def __init__(self, build_config, version, installed):
+    # owners: dict mapping each deb package that tuffix installed to the list
+    #   of codewords that need it
+    # keywords: dict mapping each installed codeword to its metadata, a dict
+    #   with the keys installed_at (seconds since the epoch), seconds (how
+    #   long the transaction that added it took), packages_sha256 (see
+    #   package_set_hash) and tuffix (version that added it)
+    # journal_seq: sequence number of the last journal record included
+    def __init__(self, build_config, version, installed, owners=None, keywords=None, journal_seq=0):
+        if owners is None:
+            owners = {}
+        if keywords is None:
+            keywords = {}
         if not (isinstance(build_config, BuildConfig) and
                 isinstance(version, packaging.version.Version) and
                 isinstance(installed, list) and
-                all([isinstance(codeword, str) for codeword in installed])):
+                all([isinstance(codeword, str) for codeword in installed]) and
+                isinstance(owners, dict) and
+                all(isinstance(package, str) and
+                    isinstance(codewords, list) and
+                    all(isinstance(codeword, str) for codeword in codewords)
+                    for package, codewords in owners.items()) and
+                isinstance(keywords, dict) and
+                all(isinstance(metadata, dict) for metadata in keywords.values()) and
+                isinstance(journal_seq, int)):
             raise ValueError
         self.build_config = build_config
         self.version = version
         self.installed = installed
-
-    # Write this state to disk.
+        self.owners = owners
+        self.keywords = keywords
+        self.journal_seq = journal_seq
+        # records in the journal file, which write empties
+        self.journal_records = 0
+
+    @property
+    def journal_path(self):
+        return state_journal_path(self.build_config)
+
+    # Record that codeword needs packages. A package that was installed
+    # before any codeword claimed it also gets SYSTEM_OWNER, so removing
+    # codewords never removes it.
+    # preinstalled: names of the packages that were already installed
+    def claim(self, codeword, packages, preinstalled=[]):
+        for package in packages:
+            owners = self.owners.setdefault(package, [])
+            if not owners and package in preinstalled:
+                owners.append(SYSTEM_OWNER)
+            if codeword not in owners:
+                owners.append(codeword)
+
+    # Drop codeword as an owner of every package. Returns the names of the
+    # packages that no longer have any owner; they are forgotten.
+    def release(self, codeword):
+        orphans = []
+        for package, owners in list(self.owners.items()):
+            if codeword in owners:
+                owners.remove(codeword)
+                if not owners:
+                    del self.owners[package]
+                    orphans.append(package)
+        return orphans
+
+    # Names of packages among packages that are owned by something other than
+    # the given codewords.
+    def shared(self, packages, codewords):
+        return [package for package in packages
+                if any(owner not in codewords
+                       for owner in self.owners.get(package, []))]
+
+    # Journal that codeword was added, with its packages, and apply it.
+    # Adding it again, e.g. to reconcile, keeps its original install time.
+    # preinstalled: names of its packages that were already installed
+    # seconds: how long the transaction that added it took
+    def added(self, codeword, packages, preinstalled=[], seconds=0.0):
+        installed_at = self.keywords.get(codeword, {}).get('installed_at', time.time())
+        self._log({'op': 'add',
+                   'keyword': codeword,
+                   'packages': list(packages),
+                   'preinstalled': list(preinstalled),
+                   'metadata': {'installed_at': installed_at,
+                                'seconds': seconds,
+                                'packages_sha256': package_set_hash(packages),
+                                'tuffix': str(self.build_config.version)}})
+
+    # Journal that codeword was removed, and apply it.
+    def removed(self, codeword):
+        self._log({'op': 'remove', 'keyword': codeword})
+
+    # Apply one journal record to this state. Applying a record twice has
+    # no further effect.
+    def _apply(self, record):
+        codeword = record['keyword']
+        if record['op'] == 'add':
+            if codeword not in self.installed:
+                self.installed.append(codeword)
+            self.claim(codeword, record['packages'], record['preinstalled'])
+            self.keywords[codeword] = record['metadata']
+        elif record['op'] == 'remove':
+            if codeword in self.installed:
+                self.installed.remove(codeword)
+            self.release(codeword)
+            self.keywords.pop(codeword, None)
+        else:
+            raise ValueError
+        self.journal_seq = max(self.journal_seq, record['seq'])
+
+    def _log(self, record):
+        record = dict(record, seq=self.journal_seq + 1)
+        with open(self.journal_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._apply(record)
+        self.journal_records += 1
+        if self.journal_records >= JOURNAL_COMPACT_RECORDS:
+            self.write()
+
+    # Write this state to disk as a new snapshot, atomically, and empty the
+    # journal, which the snapshot now includes.
     def write(self):
-        with open(self.build_config.state_path, 'w') as f:
-            document = {
-                'version' : str(self.version),
-                'installed' : self.installed
-            }
-            json.dump(document, f)
-
-# Reads the current state.
+        document = {
+            'version' : str(self.version),
+            'installed' : self.installed,
+            'owners' : self.owners,
+            'keywords' : self.keywords,
+            'journal_seq' : self.journal_seq
+        }
+        path = self.build_config.state_path
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps(document))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        sync_directory(path.parent)
+        # records up to journal_seq are in the snapshot now
+        with open(self.journal_path, 'w'):
+            pass
+        self.journal_records = 0
+
+# Path of the journal that goes with the state file of build_config.
+def state_journal_path(build_config):
+    return build_config.state_path.with_suffix('.journal')
+
+# Hex SHA-256 identifying a set of package names, whatever their order.
+def package_set_hash(packages):
+    return hashlib.sha256('\n'.join(sorted(set(packages))).encode()).hexdigest()
+
+# fsync a directory, so that a rename in it survives a power loss.
+def sync_directory(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+# Read the journal at path. Returns the list of intact records, in order,
+# and the number of lines that were not, e.g. the last line of a journal
+# whose writer was interrupted.
+def read_journal(path):
+    records = []
+    damaged = 0
+    try:
+        with open(path) as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return records, damaged
+    for line in lines:
+        try:
+            record = json.loads(line)
+            if not (isinstance(record, dict) and
+                    isinstance(record.get('seq'), int) and
+                    record.get('op') in ['add', 'remove'] and
+                    isinstance(record.get('keyword'), str)):
+                raise ValueError
+            if record['op'] == 'add':
+                if not (isinstance(record.get('packages'), list) and
+                        isinstance(record.get('preinstalled'), list) and
+                        isinstance(record.get('metadata'), dict)):
+                    raise ValueError
+        except ValueError:
+            damaged += 1
+            continue
+        records.append(record)
+    return records, damaged
+
+# Reads the current state: the snapshot, plus whatever the journal holds
+# that it does not. If that took recovering, e.g. from an interrupted write,
+# the state is compacted into a new snapshot when we may write it.
 # build_config: A BuildConfig object.
 # raises EnvironmentError if there is a problem.
 def read_state(build_config):
@@ -138,9 +490,19 @@ def read_state(build_config):
     try:
         with open(build_config.state_path) as f:
             document = json.load(f)
-            return State(build_config,
-                         packaging.version.Version(document['version']),
-                         document['installed'])
+            state = State(build_config,
+                          packaging.version.Version(document['version']),
+                          document['installed'],
+                          document.get('owners'),
+                          document.get('keywords'),
+                          document.get('journal_seq', 0))
+            if 'owners' not in document:
+                # written before packages had owners; assume every installed
+                # keyword owns all of its packages
+                for codeword in state.installed:
+                    if KEYWORDS.resolve(codeword):
+                        keyword = find_keyword(build_config, codeword)
+                        state.claim(keyword.name, keyword.packages)
     except OSError:
         raise EnvironmentError('state file not found, you must run $ tuffix init')
     except json.JSONDecodeError:
@@ -152,13 +514,247 @@ def read_state(build_config):
     except ValueError:
         raise EnvironmentError('state file JSON has malformed values')
 
+    try:
+        records, damaged = read_journal(state.journal_path)
+    except OSError as e:
+        raise EnvironmentError(f'cannot read the state journal: {e}')
+    for record in records:
+        state.journal_records += 1
+        if record['seq'] > state.journal_seq:
+            state._apply(record)
+    tmp_path = build_config.state_path.with_name(build_config.state_path.name + '.tmp')
+    if damaged or tmp_path.exists():
+        if damaged:
+            print(colored(f'[WARNING] ignoring {damaged} damaged record(s) in {state.journal_path}', 'yellow'))
+        if os.access(build_config.state_path.parent, os.W_OK):
+            tmp_path.unlink(missing_ok=True)
+            state.write()
+    return state
+
+################################################################################
+# tracing
+################################################################################
+
+# One timed span of a Tracer; use it as a context manager. Entering returns
+# the dict of attributes, which the body may add to, e.g. byte counts.
+class TraceSpan:
+    __slots__ = ('tracer', 'name', 'category', 'args', 'start')
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self.args
+
+    def __exit__(self, kind, value, traceback):
+        end = time.perf_counter()
+        if kind is not None:
+            self.args['error'] = (value.message if isinstance(value, MessageException)
+                                  else f'{kind.__name__}: {value}')
+        self.tracer.record(self.name, self.category, self.start, end, self.args)
+        return False
+
+# Does nothing; what trace returns while tracing is off, so that spans cost
+# one call and no allocation beyond the attribute dict.
+class NullSpan:
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, kind, value, traceback):
+        return False
+
+NULL_SPAN = NullSpan()
+
+# Records nested timing spans from every thread and writes them as Chrome
+# trace events (https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU),
+# which Perfetto and chrome://tracing load. Spans that nest in time on one
+# thread are shown nested.
+class Tracer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self.events = []
+        # thread id -> thread name, for the metadata events
+        self.threads = {}
+
+    # Return a TraceSpan called name; keyword arguments become its
+    # attributes.
+    # category: groups related spans, e.g. 'apt' or 'step'
+    def span(self, name, category='tuffix', **args):
+        return TraceSpan(self, name, category, args)
+
+    # Record a finished span; start and end are time.perf_counter values.
+    def record(self, name, category, start, end, args):
+        thread = threading.current_thread()
+        event = {'name': name,
+                 'cat': category,
+                 'ph': 'X',
+                 'ts': (start - self._origin) * 1e6,
+                 'dur': (end - start) * 1e6,
+                 'pid': os.getpid(),
+                 'tid': thread.ident,
+                 'args': args}
+        with self._lock:
+            self.events.append(event)
+            self.threads[thread.ident] = thread.name
+
+    # The trace as a JSON-compatible dict in the trace event format.
+    def document(self):
+        with self._lock:
+            names = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                      'args': {'name': name}}
+                     for tid, name in self.threads.items()]
+            return {'traceEvents': names + sorted(self.events, key=lambda event: event['ts']),
+                    'displayTimeUnit': 'ms'}
+
+    # Write the trace to path, a pathlib.Path.
+    def write(self, path):
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.document(), f, default=str)
+        os.replace(tmp_path, path)
+
+_tracer = None
+
+# Start recording spans for the rest of the process. Returns the Tracer.
+def start_tracing():
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+# Stop recording spans. Returns the Tracer that recorded them, or None.
+def stop_tracing():
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+# Time the body of a with statement as a span called name, if tracing is on;
+# keyword arguments become its attributes. Entering returns the attribute
+# dict, so the body can add attributes.
+#   with trace('apt: fetch', 'apt', packages=12) as span:
+#       span['bytes'] = ...
+def trace(name, category='tuffix', **args):
+    if _tracer is None:
+        return NULL_SPAN
+    return _tracer.span(name, category, **args)
+
+# subprocess.run in a span that records the command and its exit code.
+def run_traced(argv, **kwargs):
+    with trace(os.path.basename(argv[0]), 'process', argv=list(argv)) as span:
+        result = subprocess.run(argv, **kwargs)
+        span['returncode'] = result.returncode
+        return result
+
 ##################################
 # shell command wrapper in Python
 ##################################
 
+# Look up a user in the password database; cached, since the same few users
+# are looked up over and over.
+# raises UnknownUserException if there is no such user.
+@functools.lru_cache(maxsize=None)
+def lookup_user(name):
+    if not isinstance(name, str):
+        raise ValueError
+    try:
+        return pwd.getpwnam(name)
+    except KeyError:
+        raise UnknownUserException(f'Unknown user: {name}')
+
+# What running one command as another user produced.
+class CommandResult:
+    def __init__(self, argv, returncode, stdout, stderr):
+        self.argv = argv
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+
+    # Non-empty lines of stdout.
+    def lines(self):
+        return [line for line in self.stdout.split('\n') if line]
+
+    # raises subprocess.CalledProcessError if the command failed.
+    def check(self):
+        if self.returncode != 0:
+            raise subprocess.CalledProcessError(self.returncode, self.argv, self.stdout, self.stderr)
+        return self
+
+# Runs commands as another user, instead of one `sudo -u user bash -c ...`
+# per command. Each command is started directly with subprocess, which drops
+# to the user's uid and gids in the child between fork and exec; commands
+# never go through a shell. Nothing is forked at the Python level, so the
+# StepRunner and DownloadEngine threads that may be running cannot leave a
+# child stuck on a lock they held, and no pipes leak into other commands.
+class UserWorker:
+    # user: name of the user that commands run as
+    def __init__(self, user):
+        if not isinstance(user, str):
+            raise ValueError
+        self.user = lookup_user(user)
+        self._credentials = None
+
+    # subprocess.run keyword arguments that run a command as the user, worked
+    # out on first use.
+    def _options(self):
+        if self._credentials is None:
+            user = self.user
+            if os.getuid() not in (0, user.pw_uid):
+                raise PrivilageExecutionException(f'{login_name()} does not have permission to run commands as the user {user.pw_name}')
+            credentials = {}
+            if os.getuid() != user.pw_uid:
+                credentials = {'user': user.pw_uid,
+                               'group': user.pw_gid,
+                               'extra_groups': os.getgrouplist(user.pw_name, user.pw_gid)}
+            home = user.pw_dir if os.path.isdir(user.pw_dir) else '/'
+            credentials['env'] = dict(os.environ, HOME=home, USER=user.pw_name,
+                                      LOGNAME=user.pw_name, SHELL=user.pw_shell)
+            credentials['cwd'] = home
+            self._credentials = credentials
+        return self._credentials
+
+    # Run argv, a list of strings, as the user. cwd defaults to their home
+    # directory. Returns a CommandResult.
+    def run(self, argv, cwd=None):
+        if not (isinstance(argv, list) and
+                len(argv) > 0 and
+                all(isinstance(arg, str) for arg in argv) and
+                (cwd is None or isinstance(cwd, (str, pathlib.Path)))):
+            raise ValueError
+        options = dict(self._options())
+        if cwd is not None:
+            options['cwd'] = str(cwd)
+        with trace(os.path.basename(argv[0]), 'process', argv=argv, user=self.user.pw_name) as span:
+            try:
+                result = subprocess.run(argv,
+                                        stdin=subprocess.DEVNULL,
+                                        capture_output=True,
+                                        close_fds=True,
+                                        encoding='utf-8',
+                                        errors='replace',
+                                        **options)
+                result = CommandResult(argv, result.returncode, result.stdout, result.stderr)
+            except OSError as e:
+                result = CommandResult(argv, 127, '', str(e))
+            span['returncode'] = result.returncode
+        return result
+
+_user_workers = {}
+_user_workers_lock = threading.Lock()
+
+# The UserWorker shared by the whole process for the user called name.
+def user_worker(name):
+    with _user_workers_lock:
+        if name not in _user_workers:
+            _user_workers[name] = UserWorker(name)
+        return _user_workers[name]
+
 class sudo_run():
     def __init__(self):
-        self.whoami = os.getlogin()
+        self.whoami = login_name()
 
     def chuser(self, user_id: int, user_gid: int, permanent: bool):
         """
@@ -175,39 +771,107 @@ class sudo_run():
 
     def check_user(self, user: str):
         """
-        Check the passwd file to see if a given user a valid user
+        Check the password database to see if a given user a valid user
         """
 
         if not(isinstance(user, str)):
             raise ValueError
 
-        passwd_path = pathlib.Path("/etc/passwd")
-        contents = [line for line in passwd_path.open()]
-        return user in [re.search('^(?P<name>.+?)\:', line).group("name") for line in contents]
+        try:
+            lookup_user(user)
+            return True
+        except UnknownUserException:
+            return False
 
-    def run(self, command: str, desired_user: str) -> list:
+    def run(self, command, desired_user: str) -> list:
         """
-        Run a shell command as another user using sudo
-        Check if the desired user is a valid user.
-        If permission is denied, throw a descriptive error why
+        Run a command as another user, through that user's UserWorker
+        command is a string split like a shell would, or a list of arguments;
+        no shell is involved either way
+        Returns the lines of output; raises subprocess.CalledProcessError if
+        the command fails, UnknownUserException for an unknown user and
+        PrivilageExecutionException if permission is denied
         """
 
-        if not(isinstance(command, str) and
+        if not((isinstance(command, str) or
+                (isinstance(command, list) and all(isinstance(arg, str) for arg in command))) and
                isinstance(desired_user, str)):
                raise ValueError
-        
-        if not(self.check_user(desired_user)):
-            raise UnknownUserException(f'Unknown user: {desired_user}')
 
-        command = f'sudo -H -u {desired_user} bash -c \'{command}\''
+        argv = shlex.split(command) if isinstance(command, str) else command
+        return user_worker(desired_user).run(argv).check().lines()
 
-        try:
-            return [line for line in subprocess.check_output(command, 
-                                   shell=True,
-                                   encoding="utf-8").split('\n') if line]
+################################################################################
+# registries of commands and keywords
+################################################################################
+
+# Maps names to classes, so that finding a command or keyword is a dict lookup
+# and only the object that is actually used gets constructed. Names are
+# matched case-insensitively, and an entry may have aliases.
+class Registry:
+    # kind: what is registered, e.g. 'keyword', for error messages
+    # hint: appended to the error message for an unknown name
+    # loader: optional callable taking this registry, which registers the
+    #   entries the first time any of them is looked up
+    def __init__(self, kind, hint='', loader=None):
+        if not (isinstance(kind, str) and
+                isinstance(hint, str) and
+                (loader is None or callable(loader))):
+            raise ValueError
+        self.kind = kind
+        self.hint = hint
+        self._loader = loader
+        self._names = []
+        self._factories = {}
+        self._lookup = {}
+
+    def _load(self):
+        if self._loader is not None:
+            loader, self._loader = self._loader, None
+            loader(self)
+
+    # name: canonical name, which must equal the name of the objects that
+    #   factory constructs
+    # factory: callable taking a BuildConfig, usually the class itself
+    # aliases: list of other names that find the same entry
+    def register(self, name, factory, aliases=[]):
+        if not (isinstance(name, str) and
+                callable(factory) and
+                isinstance(aliases, list) and
+                all(isinstance(alias, str) for alias in aliases)):
+            raise ValueError
+        for key in [name] + aliases:
+            if key.lower() in self._lookup:
+                raise ValueError(f'{self.kind} name "{key}" registered twice')
+            self._lookup[key.lower()] = name
+        self._names.append(name)
+        self._factories[name] = factory
+
+    # Canonical names in the order they were registered.
+    def names(self):
+        self._load()
+        return list(self._names)
+
+    # Return the canonical name for name or one of its aliases, in any case,
+    # or None if there is no such entry.
+    def resolve(self, name):
+        self._load()
+        return self._lookup.get(name.lower())
+
+    # Construct the object registered under name. Raises UsageError for an
+    # unknown name.
+    def create(self, build_config, name):
+        if not (isinstance(build_config, BuildConfig) and
+                isinstance(name, str)):
+            raise ValueError
+        canonical = self.resolve(name)
+        if canonical is None:
+            raise UsageError(f'unknown {self.kind} "{name}"{self.hint}')
+        return self._factories[canonical](build_config)
 
-        except PermissionError:
-            raise PrivilageExecutionException(f'{os.getlogin()} does not have permission to run the command {command} as the user {desired_user}')
+    # Construct one object for every entry, in registration order.
+    def create_all(self, build_config):
+        return [self.create(build_config, name) for name in self.names()]
 
 ################################################################################
 # user-facing commands (init, add, etc.)
@@ -273,6 +937,10 @@ class MarkCommand(AbstractCommand):
                 all([isinstance(argument, str) for argument in arguments])):
                 raise ValueError
         
+        # ./tuffix add --reconcile base: add base again, redoing only what drifted
+        reconcile = self.command == "add" and "--reconcile" in arguments
+        arguments = [argument for argument in arguments if argument != "--reconcile"]
+
         if (len(arguments) == 0):
             raise UsageError("you must supply at least one keyword to mark")
 
@@ -280,7 +948,7 @@ class MarkCommand(AbstractCommand):
         collection = [find_keyword(self.build_config, arguments[x]) for x, _ in enumerate(arguments)]
 
         state = read_state(self.build_config)
-        first_arg = arguments[0]
+        first_arg = KEYWORDS.resolve(arguments[0])
         install = True if self.command == "add" else False
 
         # for console messages
@@ -303,38 +971,42 @@ class MarkCommand(AbstractCommand):
 
         for element in collection:
             if((element.name in state.installed)):
-                if(install):
-                    raise UsageError(f'tuffix: cannot add {element.name}, it is already installed')
+                if(install and not reconcile):
+                    raise UsageError(f'tuffix: cannot add {element.name}, it is already installed; '
+                                     f'use add --reconcile to repair it')
             elif((element.name not in state.installed) and (not install)):
                 raise UsageError(f'cannot remove candidate {element.name}; not installed')
 
-            print(f'tuffix: {verb} {element.name}')
-            
-            try:
-                 getattr(element, self.command)()
-            except AttributeError:
-                raise UsageError(f'{element.__name__} does not have the function {self.command}')
-
+        print(f'tuffix: {verb} {", ".join(element.name for element in collection)}')
 
-            new_action = state.installed
+        names = [element.name for element in collection]
+        # packages that installed keywords outside the collection still need
+        requested = [package for element in collection for package in element.packages]
+        keep = [] if install else state.shared(requested, names)
+        history = ThroughputHistory(cache_file_path(self.build_config, 'throughput.json'))
+        start = time.monotonic()
+        reports = Transaction(collection, install, keep=keep, history=history).execute()
+        seconds = time.monotonic() - start
 
+        # journaled one keyword at a time, so an interruption loses at most one
+        for report in reports:
             if(not install):
-                new_action.remove(element.name)
+                state.removed(report.keyword.name)
             else:
-                new_action.append(element.name)
-
-            new_state = State(self.build_config,
-                              self.build_config.version,
-                              new_action)
-            new_state.write()
+                state.added(report.keyword.name, report.requested, report.skipped, seconds)
 
-            os.system("apt autoremove")
-
-            print(f'tuffix: successfully {past} {element.name}')
+        for report in reports:
+            print(f'tuffix: {report.summary()}')
+            if(report.changed):
+                print(f'  {past}: {" ".join(report.changed)}')
+        failed = [report.keyword.name for report in reports if report.failed]
+        if(failed):
+            raise EnvironmentError(f'packages {past}, but some steps of {", ".join(failed)} failed; see the errors above')
+        print(f'tuffix: successfully {past} {", ".join(element.name for element in collection)}')
 
 class AddCommand(AbstractCommand):
     def __init__(self, build_config):
-        super().__init__(build_config, 'add', 'add (install) one or more keywords')
+        super().__init__(build_config, 'add', 'add (install) one or more keywords; --reconcile repairs installed ones')
         self.mark = MarkCommand(build_config, self.name)
 
     def execute(self, arguments):
@@ -357,13 +1029,18 @@ class DescribeCommand(AbstractCommand):
 
 class RekeyCommand(AbstractCommand):
 
-    whoami = os.getlogin()
     # name, email, passphrase = input("Name: "), input("Email: "), getpass.getpass("Passphrase: ")
 
     def __init__(self, build_config):
         super().__init__(build_config, 'rekey', 'regenerate ssh and/or gpg key')
 
+    @property
+    def whoami(self):
+        return login_name()
+
     def ssh_gen(self):
+        from Crypto.PublicKey import RSA
+
         ssh_dir = pathlib.Path(f'/home/{self.whoami}/.ssh')
         key = RSA.generate(4096)
         private_path = pathlib.Path(os.path.join(ssh_dir, 'id_rsa'))
@@ -381,6 +1058,8 @@ class RekeyCommand(AbstractCommand):
 
     def gpg_gen(self):
 
+        import gnupg
+
         gpg = gnupg.GPG(gnupghome=f'/home/{self.whoami}/.gnupg')
         gpg.encoding = 'utf-8'
         gpg_file = pathlib.Path(os.path.join(gpg.gnupghome, 'tuffix_key.asc'))
@@ -491,17 +1170,303 @@ class ListCommand(AbstractCommand):
 
 class StatusCommand(AbstractCommand):
     def __init__(self, build_config):
-        super().__init__(build_config, 'status', 'status of the current host')
+        super().__init__(build_config, 'status', 'status of the current host [--json|--ndjson] [--fields=name,...]')
 
     def execute(self, arguments):
         if not (isinstance(arguments, list) and
                 all([isinstance(argument, str) for argument in arguments])):
                 raise ValueError
 
-        if len(arguments) != 0:
-            raise UsageError("status command does not accept arguments")
+        output = 'text'
+        fields = None
+        for argument in arguments:
+            if argument in ('--json', '--ndjson'):
+                output = argument[2:]
+            elif argument.startswith('--fields='):
+                fields = [field for field in argument[len('--fields='):].split(',') if field]
+            else:
+                raise UsageError(f'unknown status option "{argument}"')
+
+        data = status_data(self.build_config, fields)
+        if output == 'json':
+            print(json.dumps(data))
+        elif output == 'ndjson':
+            for name, value in data.items():
+                print(json.dumps({'field': name, 'value': value}))
+        else:
+            print(format_status(data))
+
+class BundleCommand(AbstractCommand):
+    def __init__(self, build_config):
+        super().__init__(build_config, 'bundle', 'offline installs: create [--output=FILE] KEYWORD... | install FILE [KEYWORD...]')
+
+    def execute(self, arguments):
+        if not (isinstance(arguments, list) and
+                all([isinstance(argument, str) for argument in arguments])):
+                raise ValueError
+
+        if len(arguments) < 2 or arguments[0] not in ('create', 'install'):
+            raise UsageError('bundle needs create with keywords, or install with a bundle file')
+        if arguments[0] == 'create':
+            output = None
+            names = []
+            for argument in arguments[1:]:
+                if argument.startswith('--output='):
+                    output = pathlib.Path(argument[len('--output='):])
+                else:
+                    names.append(argument)
+            if not names:
+                raise UsageError('you must supply at least one keyword to bundle')
+            keywords = [find_keyword(self.build_config, name) for name in names]
+            if output is None:
+                output = pathlib.Path(f'tuffix-bundle-{"-".join(keyword.name for keyword in keywords)}.tar')
+            manifest = create_bundle(self.build_config, keywords, output)
+            size = output.stat().st_size
+            print(f'tuffix: wrote {output}: {len(manifest["packages"])} packages, '
+                  f'{len(manifest["artifacts"])} other files, {size / 1e6:.1f} MB')
+        else:
+            ensure_root_access()
+            with open_bundle(self.build_config, pathlib.Path(arguments[1])) as manifest:
+                names = arguments[2:]
+                if not names:
+                    installed = read_state(self.build_config).installed
+                    names = [name for name in manifest['keywords'] if name not in installed]
+                if not names:
+                    print('tuffix: every keyword in the bundle is already installed')
+                    return
+                MarkCommand(self.build_config, 'add').execute(names)
+
+class ProxyCommand(AbstractCommand):
+    def __init__(self, build_config):
+        super().__init__(build_config, 'proxy', 'caching apt proxy for labs: serve [--port=N] [--upstream=URL] [--allow=HOST,...] | client HOST[:PORT] | off | stats [HOST[:PORT]]')
+
+    def execute(self, arguments):
+        if not (isinstance(arguments, list) and
+                all([isinstance(argument, str) for argument in arguments])):
+                raise ValueError
+
+        if len(arguments) == 0:
+            raise UsageError('proxy needs one of serve, client, off or stats')
+        mode, options = arguments[0], arguments[1:]
+        if mode == 'serve':
+            self.serve(options)
+        elif mode == 'client' and len(options) == 1:
+            url = f'http://{self.address(options[0])}/'
+            ensure_root_access()
+            with open(APT_PROXY_CONF_PATH, 'w') as f:
+                f.write(f'Acquire::http::Proxy "{url}";\n')
+            print(f'tuffix: apt now downloads through {url}; undo with $ tuffix proxy off')
+        elif mode == 'off' and len(options) == 0:
+            ensure_root_access()
+            try:
+                os.remove(APT_PROXY_CONF_PATH)
+            except FileNotFoundError:
+                pass
+            print('tuffix: apt now downloads directly from its sources')
+        elif mode == 'stats' and len(options) <= 1:
+            import urllib.request
+            address = self.address(options[0] if options else 'localhost')
+            try:
+                with urllib.request.urlopen(f'http://{address}{PROXY_STATS_PATH}', timeout=5) as response:
+                    report = json.load(response)
+            except (OSError, ValueError) as e:
+                raise EnvironmentError(f'cannot read statistics from the proxy at {address}: {e}')
+            print(format_proxy_report(report))
+        else:
+            raise UsageError(f'invalid proxy arguments "{" ".join(arguments)}"')
+
+    # host or host:port, with the default port filled in. The host is a host
+    # name, an IPv4 address or an IPv6 address in brackets, and the port a
+    # number; the result goes into apt's configuration, so nothing else is
+    # let through.
+    # raises UsageError for anything else.
+    def address(self, text):
+        import ipaddress
+        match = re.fullmatch(r'(\[[0-9A-Fa-f:.]+\]|[^:\[\]]+)(?::([0-9]{1,5}))?', text)
+        if match:
+            host, port = match.group(1), match.group(2) or str(PROXY_PORT)
+            if host.startswith('['):
+                try:
+                    valid = isinstance(ipaddress.ip_address(host[1:-1]), ipaddress.IPv6Address)
+                except ValueError:
+                    valid = False
+            else:
+                valid = ProxyCache.HOSTNAME.fullmatch(host.lower()) is not None
+            if valid and 0 < int(port) < 65536:
+                return f'{host}:{port}'
+        raise UsageError(f'"{text}" is not HOST or HOST:PORT')
+
+    def serve(self, options):
+        port, upstream = PROXY_PORT, PROXY_UPSTREAM
+        # the mirrors this machine uses, which the clients use too
+        hosts = apt_source_hosts()
+        for option in options:
+            if option.startswith('--port=') and option[len('--port='):].isdigit():
+                port = int(option[len('--port='):])
+            elif option.startswith('--upstream='):
+                upstream = option[len('--upstream='):]
+            elif option.startswith('--allow=') and option[len('--allow='):]:
+                hosts.update(option[len('--allow='):].split(','))
+            else:
+                raise UsageError(f'unknown proxy serve option "{option}"')
+        if not urllib.parse.urlsplit(upstream).hostname:
+            raise UsageError(f'--upstream must be an http:// URL, not "{upstream}"')
+        hosts.add(urllib.parse.urlsplit(upstream).hostname)
+        invalid = [host for host in hosts if not ProxyCache.HOSTNAME.fullmatch(host.lower())]
+        if invalid:
+            raise UsageError(f'not a host name: {", ".join(sorted(invalid))}')
+        cache = ProxyCache(self.build_config.cache_path / 'proxy', hosts)
+        server = proxy_server(('', port), cache, upstream)
+        print(f'[INFO] Serving apt on port {port}, caching in {cache.root}; press Ctrl-C to stop')
+        print(f'[INFO] Fetching only from {", ".join(sorted(cache.hosts))}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        print(format_proxy_report(cache.report()))
+
+# tuffix plan add|remove KEYWORD...
+# Resolves the transaction that add or remove would run, without changing
+# anything, and reports what it would download, how much disk it would use
+# and how long it would take, predicted from earlier transactions on this
+# host.
+class PlanCommand(AbstractCommand):
+    def __init__(self, build_config):
+        super().__init__(build_config, 'plan', 'show the download size, disk use and time of adding or removing keywords: add|remove KEYWORD...')
+
+    def execute(self, arguments):
+        if not (isinstance(arguments, list) and
+                all([isinstance(argument, str) for argument in arguments])):
+                raise ValueError
+        if (len(arguments) < 2 or arguments[0] not in ['add', 'remove']):
+            raise UsageError('usage: tuffix plan add|remove KEYWORD...')
+        install = arguments[0] == 'add'
+        names = arguments[1:]
+
+        state = read_state(self.build_config)
+        if (KEYWORDS.resolve(names[0]) == 'all'):
+            names = ([word.name for word in all_keywords(self.build_config) if word.name != 'all']
+                     if install else state.installed)
+            names = [name for name in names if (name in state.installed) != install]
+        collection = [find_keyword(self.build_config, name) for name in names]
+        for element in collection:
+            if (install and element.name in state.installed):
+                raise UsageError(f'tuffix: cannot add {element.name}, it is already installed')
+            if (not install and element.name not in state.installed):
+                raise UsageError(f'cannot remove candidate {element.name}; not installed')
+
+        session = apt_session(self.build_config)
+        if (os.geteuid() != 0):
+            # only root can refresh the indexes; plan with the ones there are
+            session.offline = True
+        requested = [package for element in collection for package in element.packages]
+        keep = [] if install else state.shared(requested, [element.name for element in collection])
+        transaction = Transaction(collection, install, session, keep=keep)
+        history = ThroughputHistory(cache_file_path(self.build_config, 'throughput.json'))
+        estimate = transaction.estimate(session.cache(), history)
+        print(format_estimate(transaction.reports, estimate, install))
+        if (estimate['shortfalls']):
+            raise EnvironmentError('not enough disk space: ' + '; '.join(estimate['shortfalls']))
+
+# tuffix verify [KEYWORD...]
+# Checks the packages of installed keywords (or the given ones) against
+# dpkg's database and reports keywords that are only partly installed.
+class VerifyCommand(AbstractCommand):
+    def __init__(self, build_config):
+        super().__init__(build_config, 'verify', 'check that installed keywords are really installed [KEYWORD...]')
+
+    def execute(self, arguments):
+        if not (isinstance(arguments, list) and
+                all([isinstance(argument, str) for argument in arguments])):
+                raise ValueError
+
+        start = time.perf_counter()
+        state = read_state(self.build_config)
+        names = [KEYWORDS.resolve(argument) or argument for argument in arguments] or state.installed
+        index = dpkg_status()
+
+        incomplete = []
+        checked = 0
+        for name in names:
+            if KEYWORDS.resolve(name):
+                packages = find_keyword(self.build_config, name).packages
+            elif name in state.installed:
+                # no longer a keyword; check what it installed back then
+                packages = [package for package, owners in state.owners.items() if name in owners]
+            else:
+                raise UsageError(f'unknown keyword "{name}", see valid keyword names with $ tuffix list')
+            checked += len(packages)
+            missing, broken = package_problems(index, packages)
+            if not (missing or broken):
+                print(f'  {name}: ok ({len(packages)} packages)')
+                continue
+            incomplete.append(name)
+            how = 'not installed' if len(missing) == len(packages) else 'partly installed'
+            print(f'  {name}: {how}')
+            if missing:
+                print(f'    missing: {" ".join(missing)}')
+            if broken:
+                print(f'    broken: {" ".join(f"{package} ({dpkg_state})" for package, dpkg_state in broken)}')
+        milliseconds = (time.perf_counter() - start) * 1000
+        print(f'tuffix: {len(names) - len(incomplete)} of {len(names)} keywords fully installed; '
+              f'checked {checked} packages in {milliseconds:.1f} ms')
+        if incomplete:
+            raise EnvironmentError(f'{", ".join(incomplete)} not fully installed; '
+                                   f'repair with $ tuffix add --reconcile {" ".join(incomplete)}')
+
+# tuffix fleet [OPTION...] INVENTORY COMMAND [ARGUMENT...]
+# Runs a tuffix command on every host of an inventory over ssh, a few hosts at
+# a time, canaries first.
+class FleetCommand(AbstractCommand):
+    USAGE = ('usage: tuffix fleet [--concurrency=N] [--timeout=SECONDS] [--canary=N] '
+             '[--ssh=COMMAND] [--remote=COMMAND] [--log-dir=DIR] INVENTORY COMMAND [ARGUMENT...]')
+
+    def __init__(self, build_config):
+        super().__init__(build_config, 'fleet', 'run a tuffix command on many lab hosts over ssh: [--concurrency=N] [--timeout=SECONDS] [--canary=N] [--log-dir=DIR] INVENTORY COMMAND...')
+
+    def execute(self, arguments):
+        if not (isinstance(arguments, list) and
+                all([isinstance(argument, str) for argument in arguments])):
+                raise ValueError
 
-        print(status())
+        options = {'concurrency': FLEET_CONCURRENCY, 'timeout': FLEET_TIMEOUT,
+                   'canaries': FLEET_CANARIES, 'ssh': FLEET_SSH, 'remote': FLEET_REMOTE,
+                   'log_dir': None}
+        while arguments and arguments[0].startswith('--'):
+            option, _, value = arguments[0].partition('=')
+            arguments = arguments[1:]
+            if option in ['--concurrency', '--canary'] and value.isdigit():
+                options['concurrency' if option == '--concurrency' else 'canaries'] = int(value)
+            elif option == '--timeout' and value.replace('.', '', 1).isdigit():
+                options['timeout'] = float(value)
+            elif option in ['--ssh', '--remote'] and value:
+                options[option[2:]] = shlex.split(value)
+            elif option == '--log-dir' and value:
+                options['log_dir'] = pathlib.Path(value)
+            else:
+                raise UsageError(f'unknown fleet option "{option}"; {self.USAGE}')
+        if len(arguments) < 2:
+            raise UsageError(self.USAGE)
+        if options['concurrency'] < 1 or options['timeout'] <= 0:
+            raise UsageError('fleet needs --concurrency of at least 1 and a positive --timeout')
+
+        hosts = read_inventory(arguments[0])
+        runner = FleetRunner(hosts, arguments[1:], **options)
+        print(f'[INFO] Running "tuffix {shlex.join(arguments[1:])}" on {len(hosts)} hosts, '
+              f'{runner.concurrency} at a time')
+        import asyncio
+        try:
+            results = runner.run()
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            # the runner killed the ssh processes; report what did finish
+            print(format_fleet_summary(runner.results, runner.seconds))
+            raise EnvironmentError(f'interrupted; the command finished on {runner.finished} of {len(hosts)} hosts')
+        print(format_fleet_summary(results, runner.seconds))
+        failed = [result.host for result in results if result.status != 'ok']
+        if failed:
+            raise EnvironmentError(f'the command did not succeed on {len(failed)} of {len(hosts)} hosts')
 
 class RemoveCommand(AbstractCommand):
     def __init__(self, build_config):
@@ -514,40 +1479,979 @@ class RemoveCommand(AbstractCommand):
 
 # TODO: all the other commands...
 
+# Every user-visible command, in the order print_usage lists them.
+COMMANDS = Registry('command')
+COMMANDS.register('add', AddCommand)
+COMMANDS.register('describe', DescribeCommand)
+COMMANDS.register('init', InitCommand)
+COMMANDS.register('installed', InstalledCommand)
+COMMANDS.register('list', ListCommand)
+COMMANDS.register('status', StatusCommand)
+COMMANDS.register('remove', RemoveCommand)
+COMMANDS.register('rekey', RekeyCommand)
+# commands added since, alphabetical
+COMMANDS.register('bundle', BundleCommand)
+COMMANDS.register('fleet', FleetCommand)
+COMMANDS.register('plan', PlanCommand)
+COMMANDS.register('proxy', ProxyCommand)
+COMMANDS.register('verify', VerifyCommand)
+
 # Create and return a list containing one instance of every known
 # AbstractCommand, using build_config and state for each.
 def all_commands(build_config):
     if not isinstance(build_config, BuildConfig):
         raise ValueError
-    # alphabetical order
-    return [ AddCommand(build_config),
-             DescribeCommand(build_config),
-             InitCommand(build_config),
-             InstalledCommand(build_config),
-             ListCommand(build_config),
-             StatusCommand(build_config),
-             RemoveCommand(build_config),
-             RekeyCommand(build_config) ]
+    return COMMANDS.create_all(build_config)
+
+################################################################################
+# downloading artifacts (files that do not come from apt)
+################################################################################
+
+# A file that a keyword downloads from the web rather than from apt, e.g.
+# an installer .deb or a repository signing key.
+class Artifact:
+    # url: string URL to download from
+    # dest: pathlib.Path where the file is saved
+    # sha256: expected hex SHA-256 digest of the file, or None to accept any
+    def __init__(self, url, dest, sha256=None):
+        if not (isinstance(url, str) and
+                len(url) > 0 and
+                isinstance(dest, pathlib.Path) and
+                (sha256 is None or (isinstance(sha256, str) and len(sha256) == 64))):
+            raise ValueError
+        self.url = url
+        self.dest = dest
+        self.sha256 = sha256.lower() if sha256 else None
+
+    def host(self):
+        return urllib.parse.urlsplit(self.url).netloc
+
+    def __repr__(self):
+        return f'Artifact({self.url!r}, {str(self.dest)!r})'
+
+# A download in progress: the bytes received so far live in a .part file next
+# to the destination, and are hashed as they arrive so that the finished file
+# never has to be read back to verify it. The ETag or Last-Modified of the
+# response that started the .part file is kept beside it, so that a resumed
+# request only gets the rest of the same file (If-Range); a .part file that
+# cannot be validated that way, or by a pinned digest, is started over.
+class PartialDownload:
+    # artifact: the Artifact being downloaded
+    def __init__(self, artifact):
+        if not isinstance(artifact, Artifact):
+            raise ValueError
+        self.artifact = artifact
+        self.path = artifact.dest.with_name(artifact.dest.name + '.part')
+        self.validator_path = self.path.with_name(self.path.name + '.json')
+        self.hasher = hashlib.sha256()
+        self.offset = 0
+        self.validator = None
+        # pick up whatever an earlier, interrupted run left behind
+        try:
+            saved = json.loads(self.validator_path.read_text())
+            if saved.get('url') == artifact.url:
+                self.validator = saved.get('validator')
+        except (OSError, ValueError, AttributeError):
+            pass
+        try:
+            with open(self.path, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    self.hasher.update(chunk)
+                    self.offset += len(chunk)
+        except FileNotFoundError:
+            pass
+        if self.offset and not (self.validator or artifact.sha256):
+            # nothing tells whether the file changed upstream since
+            self.restart()
+
+    # Throw away everything received so far.
+    def restart(self):
+        self.hasher = hashlib.sha256()
+        self.offset = 0
+        self.validator = None
+        self.path.unlink(missing_ok=True)
+        self.validator_path.unlink(missing_ok=True)
+
+    # Headers to request the bytes that are still missing. Starts over when
+    # what was received cannot be validated.
+    def headers(self):
+        if self.offset and not (self.validator or self.artifact.sha256):
+            self.restart()
+        if not self.offset:
+            return {}
+        headers = {'Range': f'bytes={self.offset}-'}
+        if self.validator:
+            headers['If-Range'] = self.validator
+        return headers
+
+    # Remember the validator of response, which starts the .part file.
+    def _start(self, response):
+        etag = response.headers.get('ETag')
+        # If-Range only takes a strong ETag
+        self.validator = (etag if etag and not etag.startswith('W/')
+                          else response.headers.get('Last-Modified'))
+        if self.validator:
+            self.validator_path.write_text(json.dumps({'url': self.artifact.url,
+                                                       'validator': self.validator}))
+        else:
+            self.validator_path.unlink(missing_ok=True)
+
+    # Append the body of response to the .part file, one chunk at a time.
+    # Raises requests.RequestException if the transfer is cut short.
+    def receive(self, response):
+        import requests
+
+        if self.offset and response.status_code == 206:
+            match = re.match(r'bytes (\d+)-', response.headers.get('Content-Range', ''))
+            if not (match and int(match.group(1)) == self.offset):
+                self.restart()
+        elif self.offset:
+            # the server ignored the Range header, or the file changed since
+            # the .part file was started (If-Range), and sent the whole file
+            self.restart()
+        if not self.offset:
+            self._start(response)
+        expected = response.headers.get('Content-Length')
+        expected = self.offset + int(expected) if expected and expected.isdigit() else None
+        with open(self.path, 'ab' if self.offset else 'wb') as fp:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                fp.write(chunk)
+                self.hasher.update(chunk)
+                self.offset += len(chunk)
+        if expected is not None and self.offset < expected:
+            raise requests.ConnectionError(f'transfer ended after {self.offset} of {expected} bytes')
+
+    # Move the .part file into place. Raises EnvironmentError, and discards
+    # the download, if it does not match the expected digest.
+    def finish(self):
+        digest = self.hasher.hexdigest()
+        if self.artifact.sha256 and digest != self.artifact.sha256:
+            self.restart()
+            raise EnvironmentError(f'checksum mismatch for {self.artifact.url}: '
+                                   f'expected {self.artifact.sha256}, got {digest}')
+        os.replace(self.path, self.artifact.dest)
+        self.validator_path.unlink(missing_ok=True)
+        return digest
+
+# Persistent store of downloaded artifacts. Files are kept once per distinct
+# content, under their SHA-256 digest, and an index maps each URL to the digest
+# it last served along with the ETag/Last-Modified validators needed to ask the
+# server whether it has changed. When the store grows past max_bytes the least
+# recently used files are evicted. A cache that cannot be written to (e.g. when
+# not running as root) simply stores nothing.
+class ArtifactCache:
+    # root: pathlib.Path of the cache directory
+    # max_bytes: total size of cached files to stay under
+    def __init__(self, root, max_bytes=ARTIFACT_CACHE_MAX_BYTES):
+        if not (isinstance(root, pathlib.Path) and
+                isinstance(max_bytes, int) and
+                max_bytes >= 0):
+            raise ValueError
+        self.root = root
+        self.max_bytes = max_bytes
+        self.index_path = root / 'index.json'
+        self._lock = threading.Lock()
+        self._index = None
+        # counters for this process
+        self.stats = {'hits': 0,
+                      'revalidated': 0,
+                      'misses': 0,
+                      'stale': 0,
+                      'evicted': 0,
+                      'bytes_saved': 0,
+                      'bytes_downloaded': 0}
+
+    def _object_path(self, digest):
+        return self.root / 'objects' / digest[:2] / digest
+
+    def _load(self):
+        if self._index is None:
+            try:
+                with open(self.index_path) as f:
+                    self._index = json.load(f)
+                if not isinstance(self._index.get('urls'), dict):
+                    raise ValueError
+            except (OSError, ValueError, AttributeError):
+                self._index = {'urls': {}}
+        return self._index
+
+    def _save(self):
+        tmp_path = self.index_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _touch(self, digest):
+        now = time.time()
+        for entry in self._load()['urls'].values():
+            if entry['sha256'] == digest:
+                entry['last_used'] = now
+
+    # Return the index entry for url, a dict with the keys sha256, size, etag,
+    # last_modified and last_used, or None if it is not cached.
+    def lookup(self, url):
+        with self._lock:
+            entry = self._load()['urls'].get(url)
+            if entry and self._object_path(entry['sha256']).is_file():
+                return dict(entry)
+            return None
+
+    # Request headers that ask the server to reply 304 if entry is current.
+    @staticmethod
+    def conditional_headers(entry):
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    # Copy the cached file with the given digest to dest. Returns False if
+    # there is no such file.
+    # counter: which entry of stats to count this as
+    def copy_to(self, digest, dest, counter='hits'):
+        source = self._object_path(digest)
+        try:
+            with self._lock:
+                if not source.is_file():
+                    return False
+                self._touch(digest)
+            tmp_path = dest.with_name(dest.name + '.part')
+            shutil.copyfile(source, tmp_path)
+            os.replace(tmp_path, dest)
+        except OSError:
+            return False
+        with self._lock:
+            self.stats[counter] += 1
+            self.stats['bytes_saved'] += source.stat().st_size
+            try:
+                self._save()
+            except OSError:
+                pass
+        return True
+
+    # Drop the index entry of url, e.g. when its file can no longer be
+    # copied; the file itself goes when it is evicted.
+    def forget(self, url):
+        with self._lock:
+            if self._load()['urls'].pop(url, None) is not None:
+                try:
+                    self._save()
+                except OSError:
+                    pass
+
+    # Add a freshly downloaded file to the cache.
+    # url: where it was downloaded from
+    # path: pathlib.Path of the downloaded file, left in place
+    # digest: its hex SHA-256
+    # headers: the response headers, for the validators
+    def store(self, url, path, digest, headers):
+        with self._lock:
+            self.stats['misses'] += 1
+            self.stats['bytes_downloaded'] += path.stat().st_size
+        self.insert(url, path, digest, headers)
+
+    # Put the file at path into the cache as the content of url without
+    # counting it as a download, e.g. when it comes from an offline bundle.
+    def insert(self, url, path, digest, headers={}):
+        size = path.stat().st_size
+        with self._lock:
+            try:
+                target = self._object_path(digest)
+                if not target.is_file():
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    tmp_path = target.with_name(target.name + '.tmp')
+                    shutil.copyfile(path, tmp_path)
+                    os.replace(tmp_path, target)
+                self._load()['urls'][url] = {'sha256': digest,
+                                             'size': size,
+                                             'etag': headers.get('ETag'),
+                                             'last_modified': headers.get('Last-Modified'),
+                                             'last_used': time.time()}
+                self._evict()
+                self._save()
+            except OSError:
+                pass
+
+    # Remove least recently used files until the cache fits in max_bytes.
+    # Must be called with the lock held.
+    def _evict(self):
+        urls = self._load()['urls']
+        objects = {}
+        for entry in urls.values():
+            size, last_used = objects.get(entry['sha256'], (0, 0))
+            objects[entry['sha256']] = (entry['size'], max(last_used, entry['last_used']))
+        total = sum(size for size, _ in objects.values())
+        for digest, (size, _) in sorted(objects.items(), key=lambda item: item[1][1]):
+            if total <= self.max_bytes:
+                break
+            self._object_path(digest).unlink(missing_ok=True)
+            for url in [url for url, entry in urls.items() if entry['sha256'] == digest]:
+                del urls[url]
+            total -= size
+            self.stats['evicted'] += 1
+
+    # Total size in bytes of the cached files.
+    def size(self):
+        with self._lock:
+            sizes = {entry['sha256']: entry['size'] for entry in self._load()['urls'].values()}
+            return sum(sizes.values())
+
+    def report(self):
+        stats = self.stats
+        return (f'artifact cache: {stats["hits"] + stats["revalidated"]} hits '
+                f'({stats["revalidated"]} revalidated), {stats["misses"]} misses, '
+                f'{stats["bytes_saved"] // 1024 ** 2} MB saved, '
+                f'{stats["bytes_downloaded"] // 1024 ** 2} MB downloaded')
+
+# Downloads artifacts concurrently on a bounded pool of threads. Connections
+# are pooled in one requests.Session, no host gets more than a fixed number of
+# simultaneous transfers, and failed transfers are retried with exponential
+# backoff. Bodies are streamed to disk in fixed-size chunks, and a retry
+# resumes with an HTTP Range request instead of starting over. With an
+# ArtifactCache, a file whose digest is known and cached is not requested at
+# all, and any other cached file is revalidated with a conditional request and
+# only downloaded again if it changed. Submitting
+# returns immediately, so apt can work while downloads are still in flight;
+# fetch blocks until one artifact is on disk.
+class DownloadEngine:
+    # workers: maximum number of simultaneous downloads
+    # connections_per_host: maximum simultaneous downloads from one host
+    # timeout: requests timeout, seconds or a (connect, read) tuple
+    # retries: number of times a failed download is retried
+    # backoff: seconds to wait before the first retry, doubled each time
+    # cache: an ArtifactCache, or None to always download
+    # Setting the offline attribute makes the engine serve everything from
+    # the cache, without touching the network.
+    def __init__(self,
+                 workers=DOWNLOAD_WORKERS,
+                 connections_per_host=DOWNLOAD_CONNECTIONS_PER_HOST,
+                 timeout=DOWNLOAD_TIMEOUT,
+                 retries=DOWNLOAD_RETRIES,
+                 backoff=DOWNLOAD_BACKOFF,
+                 cache=None):
+        if not (isinstance(workers, int) and workers > 0 and
+                isinstance(connections_per_host, int) and connections_per_host > 0 and
+                isinstance(retries, int) and retries >= 0 and
+                isinstance(backoff, (int, float)) and backoff >= 0 and
+                (cache is None or isinstance(cache, ArtifactCache))):
+            raise ValueError
+        self.cache = cache
+        self.offline = False
+        self.workers = workers
+        self.connections_per_host = connections_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='tuffix-download')
+        self._lock = threading.Lock()
+        self._session = None
+        self._host_slots = {}
+        self._futures = {}
+        # dest -> hex SHA-256 of every finished download
+        self.digests = {}
+
+    def _http(self):
+        import requests
+
+        with self._lock:
+            if self._session is None:
+                self._session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=self.workers,
+                                                        pool_maxsize=self.connections_per_host)
+                self._session.mount('http://', adapter)
+                self._session.mount('https://', adapter)
+            return self._session
+
+    def _slot(self, host):
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.connections_per_host)
+            return self._host_slots[host]
+
+    # Start downloading artifact in the background, unless it has already
+    # been submitted. Returns a concurrent.futures.Future whose result is the
+    # artifact's dest.
+    def submit(self, artifact):
+        if not isinstance(artifact, Artifact):
+            raise ValueError
+        with self._lock:
+            future = self._futures.get(artifact.dest)
+            if future is None:
+                future = self._executor.submit(self._download, artifact)
+                self._futures[artifact.dest] = future
+            return future
+
+    # Download artifact, or wait for a download already in flight. Returns the
+    # artifact's dest; raises EnvironmentError if it cannot be downloaded.
+    def fetch(self, artifact):
+        return self.submit(artifact).result()
+
+    # Download every artifact in the list concurrently and wait for all of
+    # them. Returns the list of dests in the same order.
+    def fetch_all(self, artifacts):
+        futures = [self.submit(artifact) for artifact in artifacts]
+        return [future.result() for future in futures]
+
+    def _download(self, artifact):
+        with trace('download', 'download', url=artifact.url) as span:
+            dest = self._transfer(artifact)
+            span['bytes'] = dest.stat().st_size
+            return dest
+
+    def _transfer(self, artifact):
+        import requests
+
+        entry = None
+        if self.cache:
+            if artifact.sha256 and self.cache.copy_to(artifact.sha256, artifact.dest):
+                self.digests[artifact.dest] = artifact.sha256
+                return artifact.dest
+            entry = self.cache.lookup(artifact.url)
+            if entry and artifact.sha256 and entry['sha256'] != artifact.sha256:
+                entry = None
+        if self.offline:
+            if entry and self.cache.copy_to(entry['sha256'], artifact.dest):
+                self.digests[artifact.dest] = entry['sha256']
+                return artifact.dest
+            raise EnvironmentError(f'cannot download {artifact.url} while offline, and it is not cached')
+        session = self._http()
+        partial = PartialDownload(artifact)
+        with self._slot(artifact.host()):
+            attempt = 0
+            while attempt <= self.retries:
+                headers = partial.headers()
+                if entry and not partial.offset:
+                    headers.update(self.cache.conditional_headers(entry))
+                try:
+                    with session.get(artifact.url,
+                                     headers=headers,
+                                     stream=True,
+                                     timeout=self.timeout) as response:
+                        if response.status_code == 304:
+                            if entry and self.cache.copy_to(entry['sha256'], artifact.dest, 'revalidated'):
+                                self.digests[artifact.dest] = entry['sha256']
+                                return artifact.dest
+                            if entry:
+                                # the cached copy went away since the lookup;
+                                # ask again, unconditionally, without counting
+                                # it as a retry
+                                self.cache.forget(artifact.url)
+                                entry = None
+                                continue
+                            raise requests.HTTPError('304 Not Modified for an unconditional request')
+                        if response.status_code == 416:
+                            # our .part file is no use to the server
+                            partial.restart()
+                            error = 'requested range not satisfiable'
+                            attempt += 1
+                            continue
+                        if response.status_code < 500:
+                            response.raise_for_status()
+                            partial.receive(response)
+                            digest = partial.finish()
+                            self.digests[artifact.dest] = digest
+                            if self.cache:
+                                self.cache.store(artifact.url, artifact.dest, digest, response.headers)
+                            return artifact.dest
+                        error = f'server error {response.status_code}'
+                except requests.HTTPError as e:
+                    # 4xx, retrying will not help
+                    raise EnvironmentError(f'cannot download {artifact.url}: {e}')
+                except requests.RequestException as e:
+                    error = str(e)
+                if attempt < self.retries:
+                    time.sleep(self.backoff * (2 ** attempt))
+                attempt += 1
+        # better a copy that may be out of date than no copy at all
+        if entry and self.cache.copy_to(entry['sha256'], artifact.dest, 'stale'):
+            print(f'[WARNING] using cached copy of {artifact.url}: {error}')
+            self.digests[artifact.dest] = entry['sha256']
+            return artifact.dest
+        raise EnvironmentError(f'cannot download {artifact.url} after {self.retries + 1} attempts: {error}')
+
+    # Stop accepting downloads and wait for the ones in flight.
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+        if self._session is not None:
+            self._session.close()
+
+_download_engine = None
+
+# Return the DownloadEngine shared by the whole process, creating it on first
+# use.
+# build_config: a BuildConfig object whose cache_path holds the artifact cache
+def download_engine(build_config=DEFAULT_BUILD_CONFIG):
+    global _download_engine
+    if not isinstance(build_config, BuildConfig):
+        raise ValueError
+    if _download_engine is None:
+        cache = ArtifactCache(build_config.cache_path / 'artifacts')
+        _download_engine = DownloadEngine(cache=cache)
+    return _download_engine
+
+################################################################################
+# caching apt proxy (tuffix proxy)
+################################################################################
+
+# Files that apt fetches through a ProxyCache, stored on disk as
+# <root>/<host>/<path> so that they survive restarts and can be shared. Only
+# files that never change once published are cached: packages in the pool,
+# and indexes addressed by their hash. Everything else, e.g. InRelease, is
+# passed through to the mirror so clients always see current indexes.
+# Concurrent requests for the same file are served from one upstream fetch:
+# the first request downloads it into a .part file while later ones stream
+# from that file as it grows.
+# Only the hosts it was given are ever fetched from, so that the proxy is not
+# an open relay for anyone on the network.
+class ProxyCache:
+    CACHEABLE_SUFFIXES = ('.deb', '.udeb', '.ddeb', '.dsc', '.tar.gz', '.tar.xz', '.diff.gz')
+    # a host name made of DNS labels, or an IPv4 address
+    HOSTNAME = re.compile(r'[a-z0-9]([a-z0-9-]{0,61}[a-z0-9])?(\.[a-z0-9]([a-z0-9-]{0,61}[a-z0-9])?)*')
+
+    # root: pathlib.Path of the cache directory
+    # hosts: names of the mirrors that may be fetched from, e.g. from
+    #   apt_source_hosts()
+    def __init__(self, root, hosts):
+        if not (isinstance(root, pathlib.Path) and
+                isinstance(hosts, (list, set, tuple)) and
+                all(isinstance(host, str) for host in hosts)):
+            raise ValueError
+        self.root = root
+        self.hosts = {host.lower() for host in hosts}
+        self._lock = threading.Lock()
+        # url -> ProxyFlight currently being fetched
+        self._flights = {}
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0,
+                      'passthrough': 0, 'errors': 0,
+                      'bytes_from_cache': 0, 'bytes_from_upstream': 0}
+
+    # True if url may be fetched: plain http from one of the allowed hosts.
+    def allowed(self, url):
+        try:
+            parts = urllib.parse.urlsplit(url)
+            parts.port
+        except ValueError:
+            return False
+        return (parts.scheme == 'http' and
+                parts.username is None and
+                parts.hostname is not None and
+                self.HOSTNAME.fullmatch(parts.hostname) is not None and
+                parts.hostname in self.hosts)
+
+    # Where url is cached, or None if it is not cacheable.
+    def path_for(self, url):
+        if not self.allowed(url):
+            return None
+        parts = urllib.parse.urlsplit(url)
+        segments = parts.path.split('/')
+        if (parts.query or
+            any(segment in ('.', '..') for segment in segments)):
+            return None
+        if not (parts.path.endswith(self.CACHEABLE_SUFFIXES) or '/by-hash/' in parts.path):
+            return None
+        return self.root.joinpath(parts.hostname, *[segment for segment in segments if segment])
+
+    def count(self, key, amount=1):
+        with self._lock:
+            self.stats[key] += amount
+
+    # Return (flight, leader): the ProxyFlight for url, and whether the
+    # caller is the one that must fetch it.
+    # Returns (None, False) if the file was cached in the meantime.
+    def join(self, url, path):
+        with self._lock:
+            if path.is_file():
+                return None, False
+            flight = self._flights.get(url)
+            if flight is not None:
+                self.stats['coalesced'] += 1
+                return flight, False
+            flight = ProxyFlight(path)
+            self._flights[url] = flight
+            return flight, True
+
+    def leave(self, url):
+        with self._lock:
+            self._flights.pop(url, None)
+
+    # Statistics as a dict, including the hit rate among cacheable requests.
+    def report(self):
+        with self._lock:
+            report = dict(self.stats)
+        cacheable = report['hits'] + report['misses'] + report['coalesced']
+        report['hit_rate'] = (report['hits'] + report['coalesced']) / cacheable if cacheable else 0.0
+        return report
+
+# One upstream fetch into a .part file, which the leader writes and any
+# number of followers read while it grows.
+class ProxyFlight:
+    # path: pathlib.Path where the finished file goes
+    def __init__(self, path):
+        self.path = path
+        self.part_path = path.with_name(path.name + '.part')
+        self.condition = threading.Condition()
+        self.length = None    # Content-Length once the upstream answered
+        self.written = 0
+        self.done = False
+        self.failed = False
+
+    # Leader: the upstream answered with length bytes to come; the .part
+    # file exists.
+    def start(self, length):
+        with self.condition:
+            self.length = length
+            self.condition.notify_all()
+
+    def progress(self, amount):
+        with self.condition:
+            self.written += amount
+            self.condition.notify_all()
+
+    def finish(self, failed=False):
+        with self.condition:
+            self.done = True
+            self.failed = failed
+            self.condition.notify_all()
+
+    # Follower: wait until the leader knows the length. Returns False if the
+    # fetch failed before that.
+    def wait_started(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.length is not None or self.done)
+            return self.length is not None
+
+    # Follower: yield the file's content as the leader writes it.
+    def stream(self):
+        try:
+            f = open(self.part_path, 'rb')
+        except FileNotFoundError:
+            # the leader already finished and renamed it
+            f = open(self.path, 'rb')
+        with f:
+            position = 0
+            while True:
+                with self.condition:
+                    self.condition.wait_for(lambda: self.written > position or self.done)
+                    if self.failed:
+                        raise OSError(f'upstream fetch of {self.part_path.name} failed')
+                    available = self.written - position
+                if available == 0:
+                    return
+                while available > 0:
+                    chunk = f.read(min(available, DOWNLOAD_CHUNK_SIZE))
+                    if not chunk:
+                        raise OSError(f'{self.part_path} is shorter than expected')
+                    position += len(chunk)
+                    available -= len(chunk)
+                    yield chunk
+
+# Handles one request from apt. Requests normally carry an absolute URL, as
+# sent to a proxy configured with Acquire::http::Proxy. A path-only request
+# is for the upstream mirror, so sources.list can also name the proxy
+# directly (see TUFFIX_APT_SOURCES_HOSTURL in tuffixize.sh); except for
+# PROXY_STATS_PATH, which reports statistics.
+# This is mixed into http.server.BaseHTTPRequestHandler by proxy_server, so
+# that other commands do not pay for importing http.server.
+class ProxyHandler:
+    protocol_version = 'HTTP/1.1'
+    # headers passed from the client to the mirror, and back
+    REQUEST_HEADERS = ['If-Modified-Since', 'If-None-Match', 'Range']
+    RESPONSE_HEADERS = ['Content-Type', 'Last-Modified', 'ETag', 'Content-Range']
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_response(self, *args):
+        self.responded = True
+        super().send_response(*args)
+
+    def do_GET(self):
+        if self.path == PROXY_STATS_PATH:
+            self.send_body(200, json.dumps(self.server.cache.report()).encode('utf-8'),
+                           'application/json')
+            return
+        if self.path.startswith('/'):
+            url = self.server.upstream.rstrip('/') + self.path
+        else:
+            url = self.path
+        if not url.startswith('http://'):
+            self.send_body(400, b'only http:// URLs can be proxied\n')
+            return
+        if not self.server.cache.allowed(url):
+            self.send_body(403, b'this proxy only fetches from the configured apt mirrors\n')
+            return
+        self.responded = False
+        try:
+            path = self.server.cache.path_for(url)
+            if path is None or 'Range' in self.headers:
+                self.server.cache.count('passthrough')
+                self.pass_through(url)
+            else:
+                self.serve_cached(url, path)
+        except OSError as e:
+            self.server.cache.count('errors')
+            print(colored(f'[WARNING] {url}: {e}', 'yellow'), file=sys.stderr)
+            if not self.responded:
+                self.send_body(502, f'{e}\n'.encode('utf-8'))
+            else:
+                # the response has already begun; all we can do is hang up
+                self.close_connection = True
+
+    def send_body(self, status, body, content_type='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def upstream(self, url, headers={}):
+        import requests
+        try:
+            return requests.get(url, headers=headers, stream=True,
+                                timeout=DOWNLOAD_TIMEOUT, allow_redirects=True)
+        except requests.RequestException as e:
+            raise ConnectionError(str(e))
+
+    # The body of response in chunks. The mirror failing part way through
+    # raises ConnectionError, like failing before the response does.
+    def body(self, response):
+        import http.client
+        import requests
+        import urllib3
+        try:
+            yield from response.iter_content(DOWNLOAD_CHUNK_SIZE)
+        except (requests.RequestException, urllib3.exceptions.HTTPError, http.client.HTTPException) as e:
+            raise ConnectionError(f'reading from the mirror failed: {e}')
+
+    def send_file(self, path):
+        size = path.stat().st_size
+        self.send_response(200)
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile, DOWNLOAD_CHUNK_SIZE)
+        self.server.cache.count('bytes_from_cache', size)
+
+    def pass_through(self, url):
+        headers = {name: self.headers[name] for name in self.REQUEST_HEADERS if name in self.headers}
+        with self.upstream(url, headers) as response:
+            self.send_response(response.status_code)
+            for name in self.RESPONSE_HEADERS:
+                if name in response.headers:
+                    self.send_header(name, response.headers[name])
+            length = response.headers.get('Content-Length')
+            if length is None:
+                # re-frame the body so the connection can be reused
+                body = b''.join(self.body(response))
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            self.send_header('Content-Length', length)
+            self.end_headers()
+            for chunk in self.body(response):
+                self.wfile.write(chunk)
+                self.server.cache.count('bytes_from_upstream', len(chunk))
+
+    def serve_cached(self, url, path):
+        cache = self.server.cache
+        if path.is_file():
+            cache.count('hits')
+            os.utime(path)
+            self.send_file(path)
+            return
+        flight, leader = cache.join(url, path)
+        if flight is None:
+            cache.count('hits')
+            self.send_file(path)
+            return
+        if leader:
+            cache.count('misses')
+            try:
+                self.fetch(url, path, flight)
+            finally:
+                cache.leave(url)
+            return
+        if not flight.wait_started():
+            raise ConnectionError(f'upstream fetch of {url} failed')
+        self.send_response(200)
+        self.send_header('Content-Length', str(flight.length))
+        self.end_headers()
+        for chunk in flight.stream():
+            self.wfile.write(chunk)
+            cache.count('bytes_from_cache', len(chunk))
+
+    # Fetch url into path through flight's .part file, sending it to this
+    # client at the same time. Errors from the mirror are relayed and not
+    # cached.
+    def fetch(self, url, path, flight):
+        failed = True
+        try:
+            with self.upstream(url) as response:
+                length = response.headers.get('Content-Length')
+                if response.status_code != 200 or length is None:
+                    body = b''.join(self.body(response))
+                    self.send_body(response.status_code, body,
+                                   response.headers.get('Content-Type', 'application/octet-stream'))
+                    return
+                path.parent.mkdir(parents=True, exist_ok=True)
+                with open(flight.part_path, 'wb') as f:
+                    flight.start(int(length))
+                    self.send_response(200)
+                    self.send_header('Content-Length', length)
+                    self.end_headers()
+                    client = True
+                    for chunk in self.body(response):
+                        f.write(chunk)
+                        f.flush()
+                        flight.progress(len(chunk))
+                        self.server.cache.count('bytes_from_upstream', len(chunk))
+                        if client:
+                            try:
+                                self.wfile.write(chunk)
+                            except OSError:
+                                # keep filling the cache for the others
+                                client = False
+                if flight.written != int(length):
+                    raise ConnectionError(f'{url} ended after {flight.written} of {length} bytes')
+                os.replace(flight.part_path, path)
+                failed = False
+        finally:
+            flight.finish(failed)
+            if failed:
+                try:
+                    os.remove(flight.part_path)
+                except OSError:
+                    pass
+
+# Names of the hosts that the apt sources in paths download from, both
+# one-line (.list) and deb822 (.sources) style.
+# paths: list of pathlib.Path, source files or directories of them
+def apt_source_hosts(paths=APT_SOURCES_PATHS):
+    hosts = set()
+    for path in paths:
+        try:
+            entries = sorted(path.iterdir()) if path.is_dir() else [path]
+        except OSError:
+            continue
+        for entry in entries:
+            if not (entry == path or entry.suffix in ('.list', '.sources')):
+                continue
+            try:
+                text = entry.read_text()
+            except OSError:
+                continue
+            for line in text.splitlines():
+                line = line.split('#', 1)[0].strip()
+                match = re.match(r'deb(?:-src)?\s+(?:\[[^\]]*\]\s+)?(\S+)', line)
+                if match:
+                    uris = [match.group(1)]
+                elif line.lower().startswith('uris:'):
+                    uris = line[len('uris:'):].split()
+                else:
+                    continue
+                for uri in uris:
+                    hostname = urllib.parse.urlsplit(uri).hostname
+                    if hostname:
+                        hosts.add(hostname)
+    return hosts
+
+# One line summarizing a ProxyCache report.
+def format_proxy_report(report):
+    return (f'proxy: {report["hits"]} hits, {report["coalesced"]} shared fetches, '
+            f'{report["misses"]} misses, {report["passthrough"]} passed through, '
+            f'{report["errors"]} errors; hit rate {report["hit_rate"]:.0%}; '
+            f'{report["bytes_from_cache"] / 1e6:.1f} MB from cache, '
+            f'{report["bytes_from_upstream"] / 1e6:.1f} MB from upstream')
+
+# Create a multi-threaded HTTP server running ProxyHandler; call its
+# serve_forever method to start serving.
+# address: (host, port) to listen on
+# cache: a ProxyCache
+# upstream: mirror URL for path-only requests
+def proxy_server(address, cache, upstream=PROXY_UPSTREAM):
+    if not (isinstance(address, tuple) and
+            isinstance(cache, ProxyCache) and
+            isinstance(upstream, str)):
+        raise ValueError
+    import http.server
+
+    class Handler(ProxyHandler, http.server.BaseHTTPRequestHandler):
+        pass
+
+    server = http.server.ThreadingHTTPServer(address, Handler)
+    server.daemon_threads = True
+    server.cache = cache
+    server.upstream = upstream
+    return server
 
 ################################################################################
 # keywords
 ################################################################################
 
+# A keyword is a named set of deb packages, plus optional steps that run
+# before and after those packages are installed. Concrete keywords set the
+# packages class attribute and override pre_add/post_add, or steps for finer
+# control, as needed; the packages themselves are installed or removed by a
+# Transaction so that several keywords share one apt commit.
 class AbstractKeyword:
+    packages = []
+    # Artifact objects that pre_add/post_add need; a Transaction starts
+    # downloading those of every step that is not satisfied before it
+    # touches apt.
+    artifacts = []
+    # URLs of the git repositories that the steps clone with git_clone; a
+    # bundle carries a copy of each.
+    clones = []
+
     def __init__(self, build_config, name, description):
         if not (isinstance(build_config, BuildConfig) and
                 isinstance(name, str) and
                 len(name) <= KEYWORD_MAX_LENGTH and
                 isinstance(description, str)):
             raise ValueError
+        self.build_config = build_config
         self.name = name
         self.description = description
 
+    # Steps that must happen before the packages are installed, e.g. adding
+    # an apt repository that provides them.
+    def pre_add(self):
+        pass
+
+    # Steps that need the packages to be installed already, e.g. configuring
+    # a tool that one of them provides.
+    def post_add(self):
+        pass
+
+    # True if pre_add and post_add have nothing to do, e.g. on a machine
+    # that already has the keyword; see Step.satisfied.
+    def pre_add_satisfied(self):
+        return False
+
+    def post_add_satisfied(self):
+        return False
+
+    # Everything besides the packages that adding this keyword involves, as
+    # a list of Step objects. Step names are local to the keyword, except
+    # APT_STEP, the commit that installs the packages. By default pre_add
+    # runs before the commit and post_add after it; both hold dpkg, since
+    # they may install .deb files, and either may use any of the artifacts.
+    def steps(self):
+        return [Step('pre_add', self.pre_add, before=[APT_STEP], resources=[DPKG_RESOURCE],
+                     satisfied=self.pre_add_satisfied, artifacts=self.artifacts),
+                Step('post_add', self.post_add, requires=[APT_STEP], resources=[DPKG_RESOURCE],
+                     satisfied=self.post_add_satisfied, artifacts=self.artifacts)]
+
+    # Install this keyword on its own.
     def add(self):
-        raise NotImplementedError
-        
+        return Transaction([self], True).execute()
+
+    # Remove this keyword on its own.
     def remove(self):
-        raise NotImplementedError
+        return Transaction([self], False).execute()
 
 # Keyword names may begin with a course code (digits), but Python
 # identifiers may not. If a keyword name starts with a digit, prepend
@@ -558,52 +2462,7 @@ class AllKeyword(AbstractKeyword):
 
     def __init__(self, build_config):
         super().__init__(build_config, 'all', 'all keywords available (glob pattern); to be used in conjunction with remove or add respectively')
- 
-    def add(self):
-        add_deb_packages(self.packages)
-
-    def remove(self):
-        remove_deb_packages(self.packages)
-
-class GeneralKeyword(AbstractKeyword):
 
-    """
-    Point person: undergraduate committee
-    SRC: sub-tuffix/min-tuffix.yml (Kitchen sink)
-    """
-
-    packages = ['autoconf',
-                'automake',
-                'a2ps',
-                'cscope',
-                'curl',
-                'dkms',
-                'emacs',
-                'enscript',
-                'glibc-doc',
-                'gpg',
-                'graphviz',
-                'gthumb',
-                'libreadline-dev',
-                'manpages-posix',
-                'manpages-posix-dev',
-                'meld',
-                'nfs-common',
-                'openssh-client',
-                'openssh-server',
-                'seahorse',
-                'synaptic',
-                'vim',
-                'vim-gtk3']
-
-    def __init__(self, build_config):
-        super().__init__(build_config, 'general', 'General configuration, not tied to any specific course')
- 
-    def add(self):
-        add_deb_packages(self.packages)
-
-    def remove(self):
-        remove_deb_packages(self.packages)
 
 class BaseKeyword(AbstractKeyword):
 
@@ -612,6 +2471,7 @@ class BaseKeyword(AbstractKeyword):
     """
 
     packages = ['build-essential',
+              'ccache',
               'clang',
               'clang-format',
               'clang-tidy',
@@ -629,41 +2489,81 @@ class BaseKeyword(AbstractKeyword):
               'lldb',
               'python2']
 
+    microsoft_key = Artifact('https://packages.microsoft.com/keys/microsoft.asc',
+                             pathlib.Path('/tmp/m.asc'))
+    atom_installer = Artifact('https://atom.io/download/deb',
+                              pathlib.Path('/tmp/atom.deb'))
+
+    artifacts = [microsoft_key, atom_installer]
+
+    GOOGLE_TEST_URL = "https://github.com/google/googletest.git"
+    GOOGLE_TEST_ATTEMPT_URL = "https://github.com/JaredDyreson/tuffix-google-test.git"
+
+    clones = [GOOGLE_TEST_URL, GOOGLE_TEST_ATTEMPT_URL]
   
     def __init__(self, build_config):
         super().__init__(build_config,
                        'base',
                        'CPSC 120-121-131-301 C++ development environment')
       
-    def add(self):
-        self.add_vscode_repository()
-        add_deb_packages(self.packages)
-        self.atom()
-        self.google_test_attempt()
-        self.configure_git()
-      
-    def remove(self):
-        remove_deb_packages(self.packages)
+    # The repository only needs the network, so it overlaps with the
+    # downloads, and so does the clone when git is installed already; on a
+    # fresh machine git comes with the apt commit, so the clone waits for it.
+    # Atom, the Google Test build and git need packages from the apt commit,
+    # and the Google Test check needs the build. Each step checks whether it
+    # is already satisfied, so adding base again only redoes what drifted.
+    def steps(self):
+        clone_requires = [] if shutil.which('git') else [APT_STEP]
+        return [Step('vscode', self.add_vscode_repository, before=[APT_STEP],
+                     satisfied=self.vscode_repository_added, artifacts=[self.microsoft_key]),
+                Step('atom', self.atom, requires=[APT_STEP], resources=[DPKG_RESOURCE],
+                     satisfied=lambda: 'atom' in installed_deb_packages(['atom']),
+                     artifacts=[self.atom_installer]),
+                Step('apm', self.atom_plugins, requires=['atom'], satisfied=self.atom_plugins_installed),
+                Step('gtest_clone', self.google_test_clone, requires=clone_requires,
+                     satisfied=self.google_test_cloned),
+                Step('gtest_build', self.google_test_build, requires=[APT_STEP],
+                     satisfied=self.google_test_built),
+                Step('gtest', self.google_test_attempt, requires=['gtest_clone', 'gtest_build'],
+                     satisfied=self.google_test_passed),
+                Step('git', self.configure_git, requires=[APT_STEP], resources=[TERMINAL_RESOURCE],
+                     satisfied=self.git_configured)]
+
+    VSCODE_SOURCE = pathlib.Path("/etc/apt/sources.list.d/vscode.list")
+    VSCODE_KEY = pathlib.Path("/etc/apt/trusted.gpg.d/packages.microsoft.gpg")
+    VSCODE_REPOSITORY = "deb [arch=amd64 signed-by=/etc/apt/trusted.gpg.d/packages.microsoft.gpg] https://packages.microsoft.com/repos/vscode stable main"
 
     def add_vscode_repository(self):
         print("[INFO] Adding Microsoft repository...")
         sudo_install_command = "sudo install -o root -g root -m 644 /tmp/packages.microsoft.gpg /etc/apt/trusted.gpg.d/"
         
-        url = "https://packages.microsoft.com/keys/microsoft.asc"
-
-        asc_path = pathlib.Path("/tmp/m.asc")
+        asc_path = download_engine().fetch(self.microsoft_key)
         gpg_path = pathlib.Path("/tmp/packages.microsoft.gpg")
 
-        with open(asc_path, "w") as f:
-            f.write(requests.get(url).content.decode("utf-8"))
-
-        subprocess.check_output(('gpg', '--output', f'{gpg_path}', '--dearmor', f'{asc_path}'))
+        subprocess.check_output(('gpg', '--batch', '--yes', '--output', f'{gpg_path}', '--dearmor', f'{asc_path}'))
         subprocess.run(sudo_install_command.split())
 
-        vscode_source = pathlib.Path("/etc/apt/sources.list.d/vscode.list")
-        vscode_ppa = "deb [arch=amd64 signed-by=/etc/apt/trusted.gpg.d/packages.microsoft.gpg] https://packages.microsoft.com/repos/vscode stable main"
-        with open(vscode_source, "a") as fp:
-            fp.write(vscode_ppa)
+        with open(self.VSCODE_SOURCE, "w") as fp:
+            fp.write(self.VSCODE_REPOSITORY + '\n')
+
+    def vscode_repository_added(self):
+        try:
+            return (self.VSCODE_KEY.is_file() and
+                    self.VSCODE_REPOSITORY in self.VSCODE_SOURCE.read_text().splitlines())
+        except OSError:
+            return False
+
+    # Path of a file in the home directory of the user running tuffix.
+    @staticmethod
+    def home_path(*parts):
+        return pathlib.Path(lookup_user(login_name()).pw_dir, *parts)
+
+    def git_configured(self):
+        git_conf_file = self.home_path('.gitconfig')
+        return all(subprocess.run(['git', 'config', '--file', str(git_conf_file), '--get', key],
+                                  stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL).returncode == 0
+                   for key in ['user.name', 'user.email'])
 
 
     def configure_git(self):
@@ -676,10 +2576,10 @@ class BaseKeyword(AbstractKeyword):
 
         username = input("Git username: ")
         mail = input("Git email: ")
-        git_conf_file = pathlib.Path(f'/home/{whoami}/.gitconfig')
+        git_conf_file = pathlib.Path(lookup_user(whoami).pw_dir, '.gitconfig')
         commands = [
-            f'git config --file {git_conf_file} user.name {username}',
-            f'git config --file {git_conf_file} user.email {mail}'
+            ['git', 'config', '--file', str(git_conf_file), 'user.name', username],
+            ['git', 'config', '--file', str(git_conf_file), 'user.email', mail]
         ]
         for command in commands:
             keeper.run(command, whoami)
@@ -690,76 +2590,161 @@ class BaseKeyword(AbstractKeyword):
         GOAL: Get and install Atom
         """
 
-        atom_url = "https://atom.io/download/deb"
-        atom_dest = "/tmp/atom.deb"
-        atom_plugins = ['dbg-gdb', 
-                        'dbg', 
-                        'output-panel']
+        print("[INFO] Waiting for the Atom Debian installer....")
+        atom_dest = download_engine().fetch(self.atom_installer)
+        print("[INFO] Finished downloading...")
+        print("[INFO] Installing atom....")
+        import apt.debfile
+        apt.debfile.DebPackage(filename=str(atom_dest)).install()
+        print("[INFO] Finished installing Atom")
+
+    ATOM_PLUGINS = ['dbg-gdb', 
+                    'dbg', 
+                    'output-panel']
+
+    def atom_plugins_installed(self):
+        return all(self.home_path('.atom', 'packages', plugin, 'package.json').is_file()
+                   for plugin in self.ATOM_PLUGINS)
+
+    def atom_plugins(self):
+        """
+        GOAL: Install the Atom plugins, in one apm run
+        """
+
+        atom_plugins = self.ATOM_PLUGINS
+
+        # apm only installs from atom.io, which a bundle cannot stand in for
+        if download_engine().offline:
+            print(colored(f'[WARNING] not installing the Atom plugins without a network; '
+                          f'run $ tuffix add --reconcile {self.name} once online', 'yellow'))
+            return
 
         executor = sudo_run()
         normal_user = executor.whoami
-        atom_conf_dir = pathlib.Path(f'/home/{normal_user}/.atom')
+        atom_conf_dir = pathlib.Path(lookup_user(normal_user).pw_dir, '.atom')
 
-        print("[INFO] Downloading Atom Debian installer....")
-        with open(atom_dest, 'wb') as fp:
-            fp.write(requests.get(atom_url).content)
-        print("[INFO] Finished downloading...")
-        print("[INFO] Installing atom....")
-        apt.debfile.DebPackage(filename=atom_dest).install()
-        for plugin in atom_plugins:
-            print(f'[INFO] Installing {plugin}...')
-            executor.run(f'/usr/bin/apm install {plugin}', normal_user)
-            executor.run(f'chown {normal_user} -R {atom_conf_dir}', normal_user)
-        print("[INFO] Finished installing Atom")
+        print(f'[INFO] Installing {", ".join(atom_plugins)}...')
+        executor.run(f'/usr/bin/apm install {" ".join(atom_plugins)}', normal_user)
+        executor.run(f'chown {normal_user} -R {atom_conf_dir}', normal_user)
+
+    GOOGLE_TEST_LIBRARIES = ['libgtest.a', 'libgtest_main.a', 'libgmock.a', 'libgmock_main.a']
+    GOOGLE_TEST_LIB_DIR = pathlib.Path("/usr/lib")
+
+    def google_test_root(self):
+        return self.build_config.cache_path / "googletest"
+
+    # What google_test_build last installed: the commit of the local checkout
+    # and the compiler. Needs neither the network nor a build.
+    def google_test_build_stamp(self):
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=self.google_test_root() / "source",
+                                         encoding='utf-8').strip()
+        compiler = subprocess.check_output(['c++', '--version'], encoding='utf-8').splitlines()[0]
+        return {'commit': commit, 'compiler': compiler}
+
+    def google_test_built(self):
+        try:
+            stamp = json.loads((self.google_test_root() / "stamp.json").read_text())
+            return (stamp == self.google_test_build_stamp() and
+                    all((self.GOOGLE_TEST_LIB_DIR / name).exists() for name in self.GOOGLE_TEST_LIBRARIES))
+        except (OSError, ValueError, subprocess.CalledProcessError):
+            return False
 
     def google_test_build(self):
         """
         GOAL: Get and install GoogleTest
+        The checkout and the build directory are kept under the cache
+        directory and compiled through ccache when it is installed, with as
+        many jobs as the CPUs and memory allow. The checkout is only cloned
+        when it is missing; delete it to build a newer GoogleTest. A stamp
+        records its commit and the compiler, for google_test_built.
         """
 
-        GOOGLE_TEST_URL = "https://github.com/google/googletest.git"
-        GOOGLE_DEST = "google"
-
-        os.chdir("/tmp")
-        if(os.path.isdir(GOOGLE_DEST)):
-            shutil.rmtree(GOOGLE_DEST)
-        subprocess.run(['git', 'clone', GOOGLE_TEST_URL, GOOGLE_DEST])
-        os.chdir(GOOGLE_DEST)
-        script = ["cmake CMakeLists.txt",
-                   "make -j8",
-                   "sudo cp -r -v googletest/include/. /usr/include",
-                   "sudo cp -r -v googlemock/include/. /usr/include",
-                   "sudo chown -v root:root /usr/lib"]
-        for command in script:
-          subprocess.run(command.split())
+        root = self.google_test_root()
+        source, build, stamp_path = root / "source", root / "build", root / "stamp.json"
+        lib_dir = self.GOOGLE_TEST_LIB_DIR
+
+        def run(argv, **kwargs):
+            if run_traced(argv, **kwargs).returncode != 0:
+                raise EnvironmentError(f'GoogleTest build failed: {" ".join(argv)}')
+
+        if not (source / ".git").is_dir():
+            shutil.rmtree(source, ignore_errors=True)
+            root.mkdir(parents=True, exist_ok=True)
+            git_clone(self.GOOGLE_TEST_URL, source, depth=1)
+        stamp = self.google_test_build_stamp()
+        commit = stamp['commit']
+
+        configure = ['cmake', '-S', str(source), '-B', str(build), '-DCMAKE_BUILD_TYPE=Release']
+        env = dict(os.environ)
+        if shutil.which('ccache'):
+            configure.append('-DCMAKE_CXX_COMPILER_LAUNCHER=ccache')
+            env['CCACHE_DIR'] = str(self.build_config.cache_path / "ccache")
+        jobs = compile_jobs()
+        print(f'[INFO] Building GoogleTest {commit[:12]} with {jobs} job(s)...')
+        run(configure, env=env)
+        run(['cmake', '--build', str(build), '--parallel', str(jobs)], env=env)
+
+        run(['cp', '-r', str(source / "googletest/include") + '/.', '/usr/include'])
+        run(['cp', '-r', str(source / "googlemock/include") + '/.', '/usr/include'])
+        run(['install', '-o', 'root', '-g', 'root', '-m', '644'] +
+            [str(build / "lib" / name) for name in self.GOOGLE_TEST_LIBRARIES] +
+            [str(lib_dir)])
+        stamp_path.write_text(json.dumps(stamp))
+
+    GOOGLE_TEST_ATTEMPT_DEST = pathlib.Path("/tmp/test")
+
+    def google_test_cloned(self):
+        try:
+            config = (self.GOOGLE_TEST_ATTEMPT_DEST / ".git" / "config").read_text()
+        except OSError:
+            return False
+        return self.GOOGLE_TEST_ATTEMPT_URL in config
+
+    # What google_test_attempt last passed with: the commit of the test
+    # project and the installed Google Test version.
+    def google_test_attempt_stamp(self):
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=self.GOOGLE_TEST_ATTEMPT_DEST,
+                                         encoding='utf-8').strip()
+        return {'commit': commit,
+                'gtest': installed_deb_packages(['libgtest-dev']).get('libgtest-dev')}
+
+    def google_test_passed(self):
+        stamp_path = self.build_config.cache_path / "gtest-attempt.json"
+        try:
+            return json.loads(stamp_path.read_text()) == self.google_test_attempt_stamp()
+        except (OSError, ValueError):
+            return False
+
+    def google_test_clone(self):
+        """
+        Goal: fetch the small Google Test project used by google_test_attempt
+        """
+
+        if(os.path.isdir(self.GOOGLE_TEST_ATTEMPT_DEST)):
+            shutil.rmtree(self.GOOGLE_TEST_ATTEMPT_DEST)
+        git_clone(self.GOOGLE_TEST_ATTEMPT_URL, self.GOOGLE_TEST_ATTEMPT_DEST)
 
     def google_test_attempt(self):
         """
         Goal: small test to check if Google Test works after install
         """ 
 
-        TEST_URL = "https://github.com/JaredDyreson/tuffix-google-test.git"
-        TEST_DEST = "test"
+        TEST_DEST = self.GOOGLE_TEST_ATTEMPT_DEST
 
-        os.chdir("/tmp")
-        if(os.path.isdir(TEST_DEST)):
-            shutil.rmtree(TEST_DEST)
-        subprocess.run(['git', 'clone', TEST_URL, TEST_DEST])
-        os.chdir(TEST_DEST)
-        subprocess.check_output(['clang++', '-v', 'main.cpp', '-o', 'main'])
-        ret_code = subprocess.run(['make', 'all']).returncode
+        subprocess.check_output(['clang++', '-v', 'main.cpp', '-o', 'main'], cwd=TEST_DEST)
+        ret_code = run_traced(['make', 'all'], cwd=TEST_DEST).returncode
         if(ret_code != 0):
           print(colored("[ERROR] Google Unit test failed!", "red"))
-        else:
-          print(colored("[SUCCESS] Google unit test succeeded!", "green"))
-
-    def google_test_all(self):
-        """
-        Goal: make and test Google Test library install
-        """
-
-        self.google_test_build()
-        self.google_test_attempt()
+          raise EnvironmentError(f'Google unit test in {TEST_DEST} failed: make exited {ret_code}')
+        print(colored("[SUCCESS] Google unit test succeeded!", "green"))
+        stamp_path = self.build_config.cache_path / "gtest-attempt.json"
+        try:
+            stamp_path.parent.mkdir(parents=True, exist_ok=True)
+            stamp_path.write_text(json.dumps(self.google_test_attempt_stamp()))
+        except OSError:
+            pass
 
 
 class ChromeKeyword(AbstractKeyword):
@@ -771,199 +2756,28 @@ class ChromeKeyword(AbstractKeyword):
 
     packages = ['google-chrome-stable']
 
+    installer = Artifact('https://dl.google.com/linux/direct/google-chrome-stable_current_amd64.deb',
+                         pathlib.Path('/tmp/chrome.deb'))
+    signing_key = Artifact('https://dl.google.com/linux/linux_signing_key.pub',
+                           pathlib.Path('/tmp/linux_signing_key.pub'))
+
+    artifacts = [installer, signing_key]
+
     def __init__(self, build_config):
         super().__init__(build_config, 'chrome', 'Google Chrome')
  
-    def add(self):
-        google_chrome = "https://dl.google.com/linux/direct/google-chrome-stable_current_amd64.deb"
-        dest = "/tmp/chrome.deb"
-
+    # Chrome is not in the Ubuntu archive, so install the .deb before the
+    # transaction; marking google-chrome-stable afterwards is then a no-op.
+    def pre_add(self):
         print("[INFO] Downloading Chrome Debian installer....")
-        with open(dest, 'wb') as fp:
-            fp.write(requests.get(google_chrome).content)
+        dest, google_sources_path = download_engine().fetch_all(self.artifacts)
         print("[INFO] Finished downloading...")
         print("[INFO] Installing Chrome....")
-        apt.debfile.DebPackage(filename=dest).install()
+        import apt.debfile
+        apt.debfile.DebPackage(filename=str(dest)).install()
 
-        google_sources = "https://dl.google.com/linux/linux_signing_key.pub"
-        google_sources_path = pathlib.Path("/tmp/linux_signing_key.pub")
-
-        with open(google_sources_path, 'wb') as fp:
-            fp.write(requests.get(google_sources).content)
         subprocess.check_output(f'sudo apt-key add {google_sources_path}'.split())
 
-    def remove(self):
-        remove_deb_packages(self.packages)
-
-class C121Keyword(AbstractKeyword):
-
-    packages = ['cimg-dev']
-
-    def __init__(self, build_config):
-        super().__init__(build_config, 'C121', 'CPSC 121 (Object-Oriented Programming)')
- 
-    def add(self):
-        add_deb_packages(self.packages)
-
-    def remove(self):
-        remove_deb_packages(self.packages)
-
-class C223JKeyword(AbstractKeyword):
-
-    """
-    NOTE: do you want to use a newer version of Java?
-    Or are the IDE's dependent on a certain version?
-    Point Person: Floyd Holliday
-    SRC: sub-tuffix/cpsc223j.yml
-    """
-
-    packages = ['geany',
-                'gthumb',
-                'netbeans',
-                'openjdk-8-jdk',
-                'openjdk-8-jre']
-
-    def __init__(self, build_config):
-        super().__init__(build_config, 'C223J', 'CPSC 223J (Java Programming)')
- 
-    def add(self):
-        add_deb_packages(self.packages)
-
-    def remove(self):
-        remove_deb_packages(self.packages)
-
-class C223NKeyword(AbstractKeyword):
-    """
-    Point person: Floyd Holliday
-    SRC: sub-tuffix/cpsc223n.yml
-    """
-    packages = ['mono-complete',
-                'netbeans']
-
-    def __init__(self, build_config):
-        super().__init__(build_config, 'C223N', 'CPSC 223N (C# Programming)')
- 
-    def add(self):
-        add_deb_packages(self.packages)
-
-    def remove(self):
-        remove_deb_packages(self.packages)
-
-class C223PKeyword(AbstractKeyword):
-    """
-    python 2.7 and lower pip no longer exists
-    has been superseeded by python3-pip
-    also python-virtualenv no longer exists
-    Point person: Michael Shafae
-    SRC: sub-tuffix/cpsc223p.yml
-    """
-
-    packages = ['python2',
-                'python2-dev',
-                # 'python-pip',
-                # 'python-virtualenv',
-                'python3',
-                'python3-dev',
-                'python3-pip',
-                'virtualenvwrapper']
-
-    def __init__(self, build_config):
-        super().__init__(build_config, 'C223P', 'CPSC 223P (Python Programming)')
- 
-    def add(self):
-        add_deb_packages(self.packages)
-
-    def remove(self):
-        remove_deb_packages(self.packages)
-
-class C223WKeyword(AbstractKeyword):
-    
-    """
-    Point person: Paul Inventado
-    """
-
-    packages = ['binutils',
-                'curl',
-                'gnupg2',
-                'libc6-dev',
-                'libcurl4',
-                'libedit2',
-                'libgcc-9-dev',
-                'libpython2.7',
-                'libsqlite3-0',
-                'libstdc++-9-dev',
-                'libxml2',
-                'libz3-dev',
-                'pkg-config',
-                'tzdata',
-                'zlib1g-dev']
-
-    def __init__(self, build_config):
-        super().__init__(build_config, 'C223W', 'CPSC 223W (Swift Programming)')
- 
-    def add(self):
-        add_deb_packages(self.packages)
-
-    def remove(self):
-        remove_deb_packages(self.packages)
-
-
-class C240Keyword(AbstractKeyword):
-
-    """
-    Point person: Floyd Holliday
-    """
-
-    packages = ['intel2gas',
-                'nasm']
-
-    def __init__(self, build_config):
-        super().__init__(build_config, 'C240', 'CPSC 240 (Assembler)')
- 
-    def add(self):
-        add_deb_packages(self.packages)
-
-    def remove(self):
-        remove_deb_packages(self.packages)
-
-class C439Keyword(AbstractKeyword):
-
-    """
-    Point person: <++>
-    """
-
-    packages = ['minisat2']
-
-    def __init__(self, build_config):
-        super().__init__(build_config, 'C439', 'CPSC 439 (Theory of Computation)')
-
-    def add(self):
-        add_deb_packages(self.packages)
-
-    def remove(self):
-        remove_deb_packages(self.packages)
-
-class C474Keyword(AbstractKeyword):
-
-    """
-    Point person: <++>
-    """
-
-    packages = ['libopenmpi-dev',
-                'mpi-default-dev',
-                'mpich',
-                'openmpi-bin',
-                'openmpi-common']
-    
-    def __init__(self, build_config):
-        super().__init__(build_config, 'C474', 'CPSC 474 (Parallel and Distributed Computing)')
-         
-    def add(self):
-        add_deb_packages(self.packages)
-        
-    def remove(self):
-        remove_deb_packages(self.packages)
-
 class C481Keyword(AbstractKeyword):
 
     """
@@ -978,28 +2792,23 @@ class C481Keyword(AbstractKeyword):
                 'swi-prolog-nox',
                 'swi-prolog-x']
 
+    # You are going to need to get the most up to date link because the
+    # original one broke and this one currently works. Might need to change
+    # because development was done in Idaho.
+    eclipse_installer = Artifact('http://mirror.umd.edu/eclipse/oomph/epp/2020-06/R/eclipse-inst-linux64.tar.gz',
+                                 pathlib.Path('/tmp/eclipse.tar.gz'))
+
+    artifacts = [eclipse_installer]
+
     def __init__(self, build_config):
         super().__init__(build_config, 'C481', 'CPSC 481 (Artificial Intelligence)')
  
-    def add(self):
-        add_deb_packages(self.packages)
-        """
-        You are going to need to get the most up to date
-        link because the original one broke and this one currently works.
-        """
-        eclipse_download = pathlib.Path("/tmp/eclipse.tar.gz")
-
-        """
-        might need to change because development was done in Idaho
-        """
-
-        eclipse_link = "http://mirror.umd.edu/eclipse/oomph/epp/2020-06/R/eclipse-inst-linux64.tar.gz"
-        with open(eclipse_download, 'wb') as fp:
-            r = requests.get(eclipse_link)
-            if(r.status_code == 404):
-                raise EnvironmentError("cannot access link to get Eclipse, please tell your instructor immediately")
-            fp.write(r.content)
-        os.mkdir("/tmp/eclipse")
+    def post_add(self):
+        try:
+            eclipse_download = download_engine().fetch(self.eclipse_installer)
+        except EnvironmentError:
+            raise EnvironmentError("cannot access link to get Eclipse, please tell your instructor immediately")
+        os.makedirs("/tmp/eclipse", exist_ok=True)
         subprocess.check_output(f'tar -xzvf {eclipse_download} -C /tmp/eclipse'.split())
         """
         Here is where I need help
@@ -1007,71 +2816,6 @@ class C481Keyword(AbstractKeyword):
         We might need to provide documentation
         """
 
-    def remove(self):
-        remove_deb_packages(self.packages)
-
-class C484Keyword(AbstractKeyword):
-
-    """
-    Point persons: Michael Shafae, Kevin Wortman
-    """
-
-    packages = ['freeglut3-dev',
-                'libfreeimage-dev',
-                'libgl1-mesa-dev',
-                'libglew-dev',
-                'libglu1-mesa-dev',
-                'libopenctm-dev',
-                'libx11-dev',
-                'libxi-dev',
-                'libxrandr-dev',
-                'mesa-utils',
-                'mesa-utils-extra',
-                'openctm-doc',
-                'openctm-tools']
-                # 'python-openctm']
-
-    def __init__(self, build_config):
-        super().__init__(build_config, 'C484', 'CPSC 484 (Principles of Computer Graphics)')
- 
-    def add(self):
-        add_deb_packages(self.packages)
-
-    def remove(self):
-        remove_deb_packages(self.packages)
-
-class MediaKeyword(AbstractKeyword):
-
-    packages = ['audacity',
-                'blender',
-                'gimp',
-                'imagemagick',
-                'sox',
-                'vlc']
-
-    def __init__(self, build_config):
-        super().__init__(build_config, 'media', 'Media Computation Tools')
- 
-    def add(self):
-        add_deb_packages(self.packages)
-
-    def remove(self):
-        remove_deb_packages(self.packages)
-
-class LatexKeyword(AbstractKeyword):
-    packages = ['texlive-full']
-
-    def __init__(self, build_config):
-        super().__init__(build_config,
-                         'latex',
-                         'LaTeX typesetting environment (large)')
-         
-    def add(self):
-        add_deb_packages(self.packages)
-        
-    def remove(self):
-        remove_deb_packages(self.packages)
-
 class VirtualBoxKeyword(AbstractKeyword):
     packages = ['virtualbox-6.1']
 
@@ -1080,7 +2824,7 @@ class VirtualBoxKeyword(AbstractKeyword):
                          'vbox',
                          'A powerful x86 and AMD64/Intel64 virtualization product')
          
-    def add(self):
+    def pre_add(self):
         if(subprocess.run("grep hypervisor /proc/cpuinfo".split(), stdout=subprocess.DEVNULL).returncode == 0):
             raise EnvironmentError("This is a virtual enviornment, not proceeding")
 
@@ -1093,44 +2837,269 @@ class VirtualBoxKeyword(AbstractKeyword):
                                         stdout=subprocess.PIPE)
         apt_key = subprocess.check_output(('sudo', 'apt-key', 'add', '-'), stdin=wget_request.stdout)
 
-        add_deb_packages(self.packages)
-        
-    def remove(self):
-        remove_deb_packages(self.packages)
+# A keyword defined by a YAML manifest under BuildConfig.manifest_path rather
+# than by a class. A manifest can declare everything a package-only keyword
+# needs; keywords that need custom steps stay classes above.
+#
+#   name: C484
+#   description: CPSC 484 (Principles of Computer Graphics)
+#   aliases: ['484', cpsc484]       # optional
+#   enabled: false                  # optional, hides it from list and all
+#   packages: [freeglut3-dev, ...]
+#   repositories:                   # optional, added before the packages
+#     - source: deb [arch=amd64] https://example.com/debian stable main
+#       key: https://example.com/signing-key.asc   # optional
+#   artifacts:                      # optional, downloaded with everything else
+#     - url: https://example.com/tool.tar.gz
+#       dest: /tmp/tool.tar.gz
+#       sha256: ...                 # optional
+#   post_install:                   # optional, run as root after the packages
+#     - tar -xzf /tmp/tool.tar.gz -C /opt
+class ManifestKeyword(AbstractKeyword):
+    # manifest: dict as compiled by KeywordIndex
+    def __init__(self, build_config, manifest):
+        if not isinstance(manifest, dict):
+            raise ValueError
+        super().__init__(build_config, manifest['name'], manifest['description'])
+        self.packages = list(manifest['packages'])
+        self.repositories = list(manifest['repositories'])
+        self.keys = [Artifact(repository['key'],
+                              pathlib.Path(f'/tmp/tuffix-{self.name}-{i}.asc'))
+                     for i, repository in enumerate(self.repositories)
+                     if repository.get('key')]
+        self.downloads = [Artifact(artifact['url'],
+                                   pathlib.Path(artifact['dest']),
+                                   artifact.get('sha256'))
+                          for artifact in manifest['artifacts']]
+        self.artifacts = self.keys + self.downloads
+        self.post_install = list(manifest['post_install'])
+
+    def pre_add(self):
+        if not self.repositories:
+            return
+        print(f'[INFO] Adding repositories for {self.name}...')
+        for i, key in enumerate(download_engine().fetch_all(self.keys)):
+            gpg_path = f'/etc/apt/trusted.gpg.d/tuffix-{self.name}-{i}.gpg'
+            subprocess.check_output(('gpg', '--batch', '--yes', '--output', gpg_path, '--dearmor', str(key)))
+        sources = pathlib.Path(f'/etc/apt/sources.list.d/tuffix-{self.name}.list')
+        with open(sources, 'w') as fp:
+            fp.writelines(repository['source'] + '\n' for repository in self.repositories)
+
+    def pre_add_satisfied(self):
+        sources = pathlib.Path(f'/etc/apt/sources.list.d/tuffix-{self.name}.list')
+        try:
+            return (not self.repositories or
+                    (all(pathlib.Path(f'/etc/apt/trusted.gpg.d/tuffix-{self.name}-{i}.gpg').is_file()
+                         for i in range(len(self.keys))) and
+                     sources.read_text() == ''.join(repository['source'] + '\n'
+                                                    for repository in self.repositories)))
+        except OSError:
+            return False
+
+    # The keys are only needed to add the repositories, the other downloads
+    # only after the packages.
+    def steps(self):
+        pre_add, post_add = super().steps()
+        pre_add.artifacts, post_add.artifacts = self.keys, self.downloads
+        return [pre_add, post_add]
+
+    # Commands cannot be checked, so a keyword with any always runs them.
+    def post_add_satisfied(self):
+        return (not self.post_install and
+                all(download.dest.is_file() and
+                    (not download.sha256 or file_sha256(download.dest) == download.sha256)
+                    for download in self.downloads))
+
+    def post_add(self):
+        download_engine().fetch_all(self.downloads)
+        for command in self.post_install:
+            print(f'[INFO] Running "{command}"...')
+            if run_traced(shlex.split(command)).returncode != 0:
+                raise EnvironmentError(f'{self.name}: "{command}" failed')
+
+# The keyword manifests compiled into one JSON file, so that startup reads a
+# single small file and only parses YAML after a manifest changes. The index
+# records the mtime and size of every manifest it was compiled from; when
+# those differ, the file's SHA-256 decides whether it really changed (e.g.
+# a git checkout touches files without changing them).
+class KeywordIndex:
+    FIELDS = {'name', 'description', 'aliases', 'enabled', 'packages',
+              'repositories', 'artifacts', 'post_install'}
+
+    # manifest_path: pathlib.Path of the directory of *.yml manifests
+    # index_path: pathlib.Path of the compiled JSON index
+    def __init__(self, manifest_path, index_path):
+        if not (isinstance(manifest_path, pathlib.Path) and
+                isinstance(index_path, pathlib.Path)):
+            raise ValueError
+        self.manifest_path = manifest_path
+        self.index_path = index_path
+        # whether the last load() had to parse YAML
+        self.compiled = False
+
+    # Return the compiled manifests, as dicts, ordered by file name;
+    # recompiles and rewrites the index if any manifest changed.
+    # raises EnvironmentError for a malformed manifest.
+    def load(self):
+        self.compiled = False
+        try:
+            paths = sorted(self.manifest_path.glob('*.yml'))
+        except OSError:
+            paths = []
+        try:
+            with open(self.index_path) as f:
+                document = json.load(f)
+            if document['format'] == KEYWORD_INDEX_FORMAT:
+                if self._validate(document, paths):
+                    return document['keywords']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return self._compile(paths)
+
+    @staticmethod
+    def _signature(stat):
+        return [stat.st_mtime_ns, stat.st_size]
+
+    # Check document against the manifests on disk. Refreshes the recorded
+    # signature of a manifest that was touched but not changed.
+    def _validate(self, document, paths):
+        sources = document['sources']
+        if sorted(sources) != [path.name for path in paths]:
+            return False
+        touched = False
+        for path in paths:
+            source = sources[path.name]
+            signature = self._signature(path.stat())
+            if source['signature'] == signature:
+                continue
+            if hashlib.sha256(path.read_bytes()).hexdigest() != source['sha256']:
+                return False
+            source['signature'] = signature
+            touched = True
+        if touched:
+            self._save(document)
+        return True
+
+    def _compile(self, paths):
+        import yaml
+        self.compiled = True
+        sources = {}
+        keywords = []
+        for path in paths:
+            stat = path.stat()
+            data = path.read_bytes()
+            try:
+                manifest = yaml.safe_load(data)
+            except yaml.YAMLError as e:
+                raise EnvironmentError(f'keyword manifest {path} is not valid YAML: {e}')
+            keywords.append(self._normalize(path, manifest))
+            sources[path.name] = {'signature': self._signature(stat),
+                                  'sha256': hashlib.sha256(data).hexdigest()}
+        self._save({'format': KEYWORD_INDEX_FORMAT,
+                    'sources': sources,
+                    'keywords': keywords})
+        return keywords
+
+    # Check one parsed manifest and fill in defaults.
+    def _normalize(self, path, manifest):
+        def strings(value):
+            return (isinstance(value, list) and
+                    all(isinstance(item, str) for item in value))
+        def invalid(problem):
+            return EnvironmentError(f'keyword manifest {path}: {problem}')
+
+        if not isinstance(manifest, dict):
+            raise invalid('expected a mapping')
+        unknown = set(manifest) - self.FIELDS
+        if unknown:
+            raise invalid(f'unknown fields {", ".join(sorted(unknown))}')
+        name = manifest.get('name')
+        if not (isinstance(name, str) and 0 < len(name) <= KEYWORD_MAX_LENGTH):
+            raise invalid(f'name must be at most {KEYWORD_MAX_LENGTH} characters')
+        if not isinstance(manifest.get('description'), str):
+            raise invalid('description is required')
+        keyword = {'name': name,
+                   'description': manifest['description'],
+                   'aliases': manifest.get('aliases', []),
+                   'enabled': manifest.get('enabled', True),
+                   'packages': manifest.get('packages', []),
+                   'repositories': manifest.get('repositories', []),
+                   'artifacts': manifest.get('artifacts', []),
+                   'post_install': manifest.get('post_install', [])}
+        for field in ['aliases', 'packages', 'post_install']:
+            if not strings(keyword[field]):
+                raise invalid(f'{field} must be a list of strings')
+        if not isinstance(keyword['enabled'], bool):
+            raise invalid('enabled must be true or false')
+        for repository in keyword['repositories']:
+            if not (isinstance(repository, dict) and
+                    isinstance(repository.get('source'), str) and
+                    isinstance(repository.get('key', ''), str) and
+                    set(repository) <= {'source', 'key'}):
+                raise invalid('a repository needs a source line and optionally a key URL')
+        for artifact in keyword['artifacts']:
+            if not (isinstance(artifact, dict) and
+                    isinstance(artifact.get('url'), str) and
+                    isinstance(artifact.get('dest'), str) and
+                    isinstance(artifact.get('sha256', ''), str) and
+                    set(artifact) <= {'url', 'dest', 'sha256'}):
+                raise invalid('an artifact needs a url and a dest, and optionally a sha256')
+        return keyword
+
+    # Failing to write the index is not an error; the next run compiles again.
+    def _save(self, document):
+        try:
+            self.index_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.index_path.with_suffix('.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(document, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            pass
 
-# TODO: more keywords...
+# Course keywords can also be spelled without the C, or with the full
+# department prefix, e.g. 484 or cpsc484 for C484.
+def course_aliases(name):
+    return [name[1:], 'cpsc' + name[1:]]
+
+# Keywords implemented as classes, as (name, class, aliases).
+CLASS_KEYWORDS = [
+    ('all', AllKeyword, []),
+    ('base', BaseKeyword, []),
+    # ('chrome', ChromeKeyword, []),
+    # ('vbox', VirtualBoxKeyword, []),
+    # ('C481', C481Keyword, course_aliases('C481')),
+]
+
+# Register every available keyword: the classes above plus the enabled
+# manifests. Alphabetical order, but put course codes (digits) after letters.
+def register_keywords(registry, build_config=DEFAULT_BUILD_CONFIG):
+    index = KeywordIndex(build_config.manifest_path,
+                         cache_file_path(build_config, 'keywords.json'))
+    entries = list(CLASS_KEYWORDS)
+    for manifest in index.load():
+        if manifest['enabled']:
+            entries.append((manifest['name'],
+                            functools.partial(ManifestKeyword, manifest=manifest),
+                            manifest['aliases']))
+    entries.sort(key=lambda entry: (entry[0][1:2].isdigit(), entry[0]))
+    for name, factory, aliases in entries:
+        registry.register(name, factory, aliases)
+
+KEYWORDS = Registry('keyword',
+                    ', see valid keyword names with $ tuffix list',
+                    register_keywords)
 
 def all_keywords(build_config):
     if not isinstance(build_config, BuildConfig):
         raise ValueError
-    # alphabetical order, but put digits after letters
-    return [ AllKeyword(build_config),
-             BaseKeyword(build_config),
-             # ChromeKeyword(build_config),
-             # GeneralKeyword(build_config),
-             LatexKeyword(build_config),
-             # MediaKeyword(build_config),
-             # VirtualBoxKeyword(build_config),
-             # C223JKeyword(build_config),
-             # C223NKeyword(build_config),
-             # C223PKeyword(build_config),
-             # C223WKeyword(build_config),
-             # C240Keyword(build_config),
-             C121Keyword(build_config),
-             C439Keyword(build_config),
-             C474Keyword(build_config),
-             # C481Keyword(build_config), 
-             C484Keyword(build_config)
-             ]
+    return KEYWORDS.create_all(build_config)
 
 def find_keyword(build_config, name):
     if not (isinstance(build_config, BuildConfig) and
             isinstance(name, str)):
         raise ValueError
-    for keyword in all_keywords(build_config):
-        if keyword.name == name:
-            return keyword
-    raise UsageError('unknown keyword "' + name + '", see valid keyword names with $ tuffix list')
+    return KEYWORDS.create(build_config, name)
 
 ################################################################################
 # system probing functions (gathering info about the environment)
@@ -1194,18 +3163,325 @@ def ensure_shell_command_exists(name):
     except FileNotFoundError:
         raise EnvironmentError("no 'which' command; this does not seem to be Linux")
 
+# Bytes of memory available for new processes without swapping, according to
+# /proc/meminfo, or None if the kernel does not say.
+def memory_available():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+# Number of parallel compile jobs this machine can take: one per CPU this
+# process may run on, but no more than fit in available memory at
+# COMPILE_JOB_MEMORY each, and at least one.
+# cpus, available: override the CPU count and available bytes, for testing
+def compile_jobs(cpus=None, available=None):
+    if cpus is None:
+        cpus = len(os.sched_getaffinity(0))
+    if available is None:
+        available = memory_available()
+    jobs = cpus if available is None else min(cpus, available // COMPILE_JOB_MEMORY)
+    return max(1, jobs)
+
+# What dpkg's status file says about every package, read in one pass into a
+# dict, so that checking any number of packages costs one file read and no
+# apt cache. Only the name, state and version of each package are kept.
+class DpkgStatusIndex:
+    # dpkg states in which a package is fully installed
+    INSTALLED_STATES = ['installed', 'triggers-pending', 'triggers-awaited']
+
+    # path: pathlib.Path of dpkg's status file
+    # raises EnvironmentError if it cannot be read
+    def __init__(self, path=DPKG_STATUS_PATH):
+        if not isinstance(path, pathlib.Path):
+            raise ValueError
+        self.path = path
+        # name -> (state, version); state is e.g. 'installed', 'unpacked'
+        # or 'config-files'
+        self.packages = {}
+        try:
+            with open(path, encoding='utf-8', errors='replace') as f:
+                stat = os.fstat(f.fileno())
+                self.signature = (stat.st_mtime_ns, stat.st_size)
+                self._parse(f)
+        except OSError as e:
+            raise EnvironmentError(f'cannot read the dpkg database {path}: {e}')
+
+    def _parse(self, lines):
+        name = state = version = None
+        for line in lines:
+            first = line[:1]
+            if first == ' ':
+                # continuation of a multi-line field, e.g. Description
+                continue
+            if first == '\n' or not first:
+                self._add(name, state, version)
+                name = state = version = None
+            elif line.startswith('Package: '):
+                name = line[9:].strip()
+            elif line.startswith('Status: '):
+                state = line.split()[-1]
+            elif line.startswith('Version: '):
+                version = line[9:].strip()
+        self._add(name, state, version)
+
+    def _add(self, name, state, version):
+        if name is None or state is None:
+            return
+        # one entry per architecture of a multi-arch package; installed wins
+        if name in self.packages and self.packages[name][0] in self.INSTALLED_STATES:
+            return
+        self.packages[name] = (state, version)
+
+    def __len__(self):
+        return len(self.packages)
+
+    # dpkg's state for package name, or None if dpkg has never seen it.
+    def state(self, name):
+        entry = self.packages.get(name)
+        return entry[0] if entry else None
+
+    # The installed version of package name, or None if it is not installed.
+    def version(self, name):
+        entry = self.packages.get(name)
+        return entry[1] if entry and entry[0] in self.INSTALLED_STATES else None
+
+    def is_installed(self, name):
+        return self.version(name) is not None
+
+# Check packages against index, a DpkgStatusIndex. Returns (missing,
+# broken): the names of the packages dpkg does not have installed at all,
+# and (name, state) for those it has in some unfinished state, e.g.
+# half-configured.
+def package_problems(index, packages):
+    missing = []
+    broken = []
+    for package in packages:
+        state = index.state(package)
+        if state in DpkgStatusIndex.INSTALLED_STATES:
+            continue
+        if state in [None, 'not-installed', 'config-files']:
+            missing.append(package)
+        else:
+            broken.append((package, state))
+    return missing, broken
+
+_dpkg_status = None
+_dpkg_status_lock = threading.Lock()
+
+# Return a DpkgStatusIndex of the current dpkg database. The index is shared
+# and only read again once dpkg has changed the status file.
+def dpkg_status(path=DPKG_STATUS_PATH):
+    global _dpkg_status
+    with _dpkg_status_lock:
+        try:
+            stat = path.stat()
+            signature = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            signature = None
+        if (_dpkg_status is None or _dpkg_status.path != path or
+            _dpkg_status.signature != signature):
+            _dpkg_status = DpkgStatusIndex(path)
+        return _dpkg_status
+
 ################################################################################
 # changing the system during keyword add/remove
 ################################################################################
 
+# An apt cache that is opened once and shared by everything in this process.
+# The package indexes are only refreshed (downloaded) when they are older than
+# a TTL, or when a sources file has changed since they were last downloaded.
+class AptSession:
+    # index_ttl: age in seconds after which the package indexes are stale
+    # lists_path: pathlib.Path of apt's package index directory
+    # sources_paths: list of pathlib.Path, apt source files or directories
+    def __init__(self,
+                 index_ttl=APT_INDEX_TTL,
+                 lists_path=APT_LISTS_PATH,
+                 sources_paths=APT_SOURCES_PATHS):
+        if not (isinstance(index_ttl, (int, float)) and
+                index_ttl >= 0 and
+                isinstance(lists_path, pathlib.Path) and
+                isinstance(sources_paths, list) and
+                all(isinstance(path, pathlib.Path) for path in sources_paths)):
+            raise ValueError
+        self.index_ttl = index_ttl
+        self.lists_path = lists_path
+        self.sources_paths = sources_paths
+        self._cache = None
+        self._opened_at = None
+        # seconds spent opening the cache and refreshing the indexes, summed
+        # over the lifetime of the session
+        self.open_seconds = 0.0
+        self.update_seconds = 0.0
+        self.updated = False
+        # when True, the indexes are only ever refreshed by update_from
+        self.offline = False
+
+    # Newest modification time of any file directly inside the given paths,
+    # or None if there are none.
+    @staticmethod
+    def _newest_mtime(paths):
+        newest = None
+        for path in paths:
+            try:
+                entries = list(path.iterdir()) if path.is_dir() else [path]
+                for entry in entries:
+                    if entry.is_file():
+                        mtime = entry.stat().st_mtime
+                        newest = mtime if newest is None else max(newest, mtime)
+            except OSError:
+                pass
+        return newest
+
+    # Age in seconds of the newest package index, or None if apt has never
+    # downloaded any.
+    def index_age(self):
+        newest = self._newest_mtime([self.lists_path])
+        return None if newest is None else time.time() - newest
+
+    # Source files changed since the package indexes were last downloaded.
+    def changed_sources(self):
+        lists = self._newest_mtime([self.lists_path])
+        changed = []
+        for path in self.sources_paths:
+            try:
+                entries = sorted(path.iterdir()) if path.is_dir() else [path]
+                for entry in entries:
+                    if entry.is_file() and (lists is None or entry.stat().st_mtime > lists):
+                        changed.append(entry)
+            except OSError:
+                pass
+        return changed
+
+    # True if the package indexes must be downloaded before they are used.
+    def needs_refresh(self):
+        lists = self._newest_mtime([self.lists_path])
+        if lists is None:
+            return True
+        if time.time() - lists > self.index_ttl:
+            return True
+        sources = self._newest_mtime(self.sources_paths)
+        return sources is not None and sources > lists
+
+    def _open(self):
+        import apt.cache
+
+        start = time.monotonic()
+        with trace('apt: open cache', 'apt'):
+            if self._cache is None:
+                self._cache = apt.cache.Cache()
+            else:
+                self._cache.open()
+        self.open_seconds += time.monotonic() - start
+        self._opened_at = time.time()
+
+    # Return the shared apt.cache.Cache, opening it and refreshing the package
+    # indexes first if necessary.
+    def cache(self):
+        if self._cache is not None:
+            # a keyword may have added a repository since the cache was opened
+            sources = self._newest_mtime(self.sources_paths)
+            if sources is None or sources <= self._opened_at:
+                return self._cache
+        if self._cache is None:
+            self._open()
+        if self.needs_refresh() and not self.offline:
+            start = time.monotonic()
+            age = self.index_age()
+            changed = self.changed_sources()
+            if age is not None and age <= self.index_ttl and changed:
+                # the other sources are fresh; e.g. a keyword just added a
+                # repository, so only download the indexes it provides
+                for path in changed:
+                    with trace('apt: update indexes', 'apt', sources=str(path)):
+                        self._cache.update(sources_list=str(path))
+            else:
+                with trace('apt: update indexes', 'apt', sources='all'):
+                    self._cache.update()
+            self.update_seconds += time.monotonic() - start
+            self.updated = True
+            self._open()
+        return self._cache
+
+    # Refresh only the indexes of the sources listed in sources_list, a
+    # pathlib.Path, e.g. a local repository while offline.
+    def update_from(self, sources_list):
+        if self._cache is None:
+            self._open()
+        start = time.monotonic()
+        try:
+            with trace('apt: update indexes', 'apt', sources=str(sources_list)):
+                self._cache.update(sources_list=str(sources_list))
+        except Exception as e:
+            raise EnvironmentError(f'cannot read the package index of {sources_list}: {e}')
+        self.update_seconds += time.monotonic() - start
+        self.updated = True
+        self._open()
+
+    # Until the with block ends, apt sees only the sources in sources_list, a
+    # pathlib.Path, with package indexes of their own in lists_path, and
+    # never refreshes them from the network; e.g. a local repository whose
+    # packages must not be mixed with the online mirrors'.
+    @contextlib.contextmanager
+    def only_sources(self, sources_list, lists_path):
+        import apt_pkg
+
+        keys = ['Dir::Etc::sourcelist', 'Dir::Etc::sourceparts', 'Dir::State::lists']
+        config = {key: apt_pkg.config.find(key) for key in keys}
+        attributes = (self.lists_path, self.sources_paths, self.offline)
+        parts = lists_path / 'sources.list.d'
+        (lists_path / 'partial').mkdir(parents=True, exist_ok=True)
+        parts.mkdir(exist_ok=True)
+        apt_pkg.config.set('Dir::Etc::sourcelist', str(sources_list))
+        apt_pkg.config.set('Dir::Etc::sourceparts', str(parts))
+        apt_pkg.config.set('Dir::State::lists', str(lists_path))
+        self.lists_path, self.sources_paths, self.offline = lists_path, [sources_list], True
+        try:
+            self.update_from(sources_list)
+            yield self
+        finally:
+            for key, value in config.items():
+                apt_pkg.config.set(key, value)
+            self.lists_path, self.sources_paths, self.offline = attributes
+            # the next cache() opens the usual sources again
+            self._cache = None
+
+    # Reread package states from disk, e.g. after a commit.
+    def reopen(self):
+        if self._cache is None:
+            self.cache()
+        else:
+            self._open()
+
+    def report(self):
+        refresh = (f'indexes refreshed in {self.update_seconds:.2f}s' if self.updated
+                   else 'index refresh skipped')
+        return f'apt cache opened in {self.open_seconds:.2f}s, {refresh}'
+
+_apt_session = None
+
+# Return the AptSession shared by the whole process, creating it on first use.
+# build_config: a BuildConfig object whose apt_index_ttl is used if the session
+#   does not exist yet.
+def apt_session(build_config=DEFAULT_BUILD_CONFIG):
+    global _apt_session
+    if not isinstance(build_config, BuildConfig):
+        raise ValueError
+    if _apt_session is None:
+        _apt_session = AptSession(build_config.apt_index_ttl)
+    return _apt_session
+
 def add_deb_packages(package_names):
     if not (isinstance(package_names, list) and
             all(isinstance(name, str) for name in package_names)):
         raise ValueError
     print(f'[INFO] Adding all packages to the APT queue ({len(package_names)})')
-    cache = apt.cache.Cache()
-    cache.update()
-    cache.open()
+    cache = apt_session().cache()
     for name in package_names:
         print(f'adding {name}')
         try:
@@ -1216,6 +3492,7 @@ def add_deb_packages(package_names):
         cache.commit()
     except Exception as e:
         raise EnvironmentError('error installing package "' + name + '": ' + str(e))
+    apt_session().reopen()
 
 # create the directory for the state file, unless it already exists
 def create_state_directory(build_config):
@@ -1227,9 +3504,7 @@ def remove_deb_packages(package_names):
     if not (isinstance(package_names, list) and
             all(isinstance(name, str) for name in package_names)):
         raise ValueError
-    cache = apt.cache.Cache()
-    cache.update()
-    cache.open()
+    cache = apt_session().cache()
     for name in package_names:
         try:
             cache[name].mark_delete()
@@ -1239,24 +3514,1167 @@ def remove_deb_packages(package_names):
         cache.commit()
     except Exception as e:
         raise EnvironmentError('error removing package "' + name + '": ' + str(e))
+    apt_session().reopen()
+
+# Measured apt throughput on this host, kept in a small JSON file, to predict
+# how long a transaction will take. Downloads are measured in bytes fetched
+# per second, installs in bytes of disk space used per second of dpkg.
+class ThroughputHistory:
+    KINDS = ['download', 'install']
+
+    # path: pathlib.Path of the history file
+    # samples: number of measurements of each kind to keep
+    def __init__(self, path, samples=THROUGHPUT_SAMPLES):
+        if not (isinstance(path, pathlib.Path) and
+                isinstance(samples, int) and
+                samples > 0):
+            raise ValueError
+        self.path = path
+        self.samples = samples
+        self._history = None
+
+    def _load(self):
+        if self._history is None:
+            self._history = {kind: [] for kind in self.KINDS}
+            try:
+                with open(self.path) as f:
+                    document = json.load(f)
+                for kind in self.KINDS:
+                    if isinstance(document.get(kind), list):
+                        self._history[kind] = [[float(size), float(seconds)]
+                                               for size, seconds in document[kind]]
+            except (OSError, ValueError, TypeError, AttributeError):
+                pass
+        return self._history
+
+    # Add one measurement and save the history. Measurements too small to
+    # mean anything are ignored.
+    # kind: 'download' or 'install'
+    def record(self, kind, size, seconds):
+        if kind not in self.KINDS:
+            raise ValueError
+        if size <= 0 or seconds <= 0:
+            return
+        samples = self._load()[kind]
+        samples.append([size, seconds])
+        del samples[:-self.samples]
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix('.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(self._history, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+    # Measured bytes per second of kind, or None if nothing was measured.
+    def rate(self, kind):
+        samples = self._load()[kind]
+        if not samples:
+            return None
+        return sum(size for size, _ in samples) / sum(seconds for _, seconds in samples)
+
+    # Predict the seconds that downloading download_bytes and installing
+    # space_bytes take. Returns (seconds, measured), where measured is False
+    # if a default rate had to be used for either.
+    def predict(self, download_bytes, space_bytes):
+        seconds = 0.0
+        measured = True
+        for kind, size in [('download', download_bytes), ('install', abs(space_bytes))]:
+            rate = self.rate(kind)
+            if rate is None:
+                rate = THROUGHPUT_DEFAULTS[kind]
+                measured = measured and size == 0
+            seconds += size / rate
+        return seconds, measured
+
+# Check that the file systems apt downloads to and dpkg installs to have room
+# for a transaction, plus a margin. Returns a list of messages, one per file
+# system that is too full; empty if everything fits.
+def disk_shortfalls(download_bytes, space_bytes,
+                    archives_path=APT_ARCHIVES_PATH,
+                    install_path=INSTALL_ROOT_PATH):
+    # bytes needed per file system, which may be one and the same
+    needed = {}
+    for path, size in [(archives_path, download_bytes), (install_path, space_bytes)]:
+        try:
+            device = path.stat().st_dev
+        except OSError:
+            continue
+        entry = needed.setdefault(device, [path, 0])
+        entry[1] += max(size, 0)
+    shortfalls = []
+    for path, size in needed.values():
+        if size == 0:
+            continue
+        free = shutil.disk_usage(path).free
+        if size + DISK_SPACE_MARGIN > free:
+            shortfalls.append(f'{path} needs {size / 1e6:.1f} MB but only {free / 1e6:.1f} MB are free')
+    return shortfalls
+
+# Format a duration in seconds for people, e.g. '4m 12s'.
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f'{seconds}s'
+    if seconds < 3600:
+        return f'{seconds // 60}m {seconds % 60:02d}s'
+    return f'{seconds // 3600}h {seconds // 60 % 60:02d}m'
+
+# Format what Transaction.estimate returned for `tuffix plan`.
+# reports: the KeywordReport objects of the transaction
+# install: True if the transaction adds the keywords
+def format_estimate(reports, estimate, install):
+    space_verb = 'used' if install else 'freed'
+    lines = [f'tuffix: plan to {"add" if install else "remove"} '
+             f'{", ".join(report.keyword.name for report in reports)}']
+    for report in reports:
+        lines.append(f'  {report.keyword.name}: {len(report.planned)} planned, '
+                     f'{len(report.skipped)} {"already present" if install else "kept"}, '
+                     f'{report.download_bytes / 1e6:.1f} MB download, '
+                     f'{abs(report.space_bytes) / 1e6:.1f} MB {space_verb}')
+    lines.append(f'  total: {estimate["changes"]} package changes including dependencies, '
+                 f'{estimate["download_bytes"] / 1e6:.1f} MB download, '
+                 f'{abs(estimate["space_bytes"]) / 1e6:.1f} MB {space_verb}')
+    present = [name for report in reports for name in report.skipped]
+    if present:
+        lines.append(f'  {"already present" if install else "kept"}: {" ".join(present)}')
+    unknown = [name for report in reports for name in report.unknown]
+    if unknown:
+        lines.append(f'  not in the package indexes, e.g. from a repository added while installing: '
+                     f'{" ".join(unknown)}')
+    guess = '' if estimate['measured'] else ' (nothing measured on this host yet, a rough guess)'
+    lines.append(f'  predicted time: {format_duration(estimate["seconds"])}{guess}')
+    for shortfall in estimate['shortfalls']:
+        lines.append(f'  not enough disk space: {shortfall}')
+    return '\n'.join(lines)
+
+# What a Transaction did on behalf of one keyword.
+class KeywordReport:
+    # keyword: the AbstractKeyword this report describes
+    # requested: names of every package the keyword lists
+    # planned: names of the requested packages the transaction marked for
+    #   change, i.e. not already in the desired state
+    # skipped: names of the requested packages left alone, because they were
+    #   already installed (add) or another keyword still owns them (remove)
+    # changed: names of the requested packages whose installed state
+    #   actually changed once the transaction was committed
+    # failed: names of the keyword's steps that failed or were skipped
+    #   because a step they depend on failed
+    # unknown: names of the requested packages that are not in the package
+    #   indexes (yet), when planning without committing
+    # download_bytes, space_bytes: what the keyword's planned packages add
+    #   to the download and to the disk space used; a package that several
+    #   keywords need counts for the first of them
+    # satisfied: names of the keyword's steps that were not run because
+    #   they had nothing to do
+    def __init__(self, keyword):
+        if not isinstance(keyword, AbstractKeyword):
+            raise ValueError
+        self.keyword = keyword
+        self.requested = list(keyword.packages)
+        self.planned = []
+        self.skipped = []
+        self.changed = []
+        self.failed = []
+        self.unknown = []
+        self.download_bytes = 0
+        self.space_bytes = 0
+        self.satisfied = []
+
+    def summary(self):
+        summary = (f'{self.keyword.name}: {len(self.requested)} requested, '
+                   f'{len(self.planned)} planned, {len(self.skipped)} skipped, '
+                   f'{len(self.changed)} changed')
+        if self.satisfied:
+            summary += f', already satisfied: {" ".join(self.satisfied)}'
+        if self.failed:
+            summary += f', failed steps: {" ".join(self.failed)}'
+        return summary
+
+# One unit of work while adding keywords, e.g. adding a repository, cloning
+# a repository or configuring a tool. Steps form a dependency graph that a
+# StepRunner runs with as much concurrency as the graph allows.
+class Step:
+    # name: unique within the graph
+    # function: callable with no arguments; raising an exception fails the
+    #   step, and every step that depends on it is skipped
+    # requires: names of the steps that must succeed before this one starts
+    # before: names of the steps that must not start until this one succeeds
+    # resources: names of things only one step may use at a time, e.g.
+    #   DPKG_RESOURCE for anything that runs dpkg
+    # satisfied: cheap callable with no arguments that returns True if the
+    #   step has nothing left to do, e.g. its file is already in place; the
+    #   step is then not run. None to always run it.
+    # artifacts: Artifact objects that function downloads; a Transaction
+    #   starts downloading them early unless the step is satisfied
+    def __init__(self, name, function, requires=[], before=[], resources=[], satisfied=None, artifacts=[]):
+        if not (isinstance(name, str) and
+                callable(function) and
+                all(isinstance(names, list) and
+                    all(isinstance(item, str) for item in names)
+                    for names in [requires, before, resources]) and
+                (satisfied is None or callable(satisfied)) and
+                isinstance(artifacts, list) and
+                all(isinstance(artifact, Artifact) for artifact in artifacts)):
+            raise ValueError
+        self.name = name
+        self.function = function
+        self.requires = requires
+        self.before = before
+        self.resources = resources
+        self.satisfied = satisfied
+        self.artifacts = artifacts
+
+    # True if the satisfied check says there is nothing to do. A check that
+    # cannot tell, e.g. because a command it runs is missing, means the step
+    # runs.
+    def is_satisfied(self):
+        if self.satisfied is None:
+            return False
+        try:
+            return bool(self.satisfied())
+        except Exception:
+            return False
+
+# Runs a graph of Steps on a pool of worker threads. A step starts as soon as
+# everything it requires has succeeded and none of its resources are in use,
+# so independent branches, e.g. a git clone and an apt commit, overlap. A
+# step whose satisfied check passes is not run, which counts as success. A
+# failure only stops the steps downstream of it; the rest of the graph still
+# runs.
+class StepRunner:
+    # steps: list of Step objects; earlier steps start first when several
+    #   are ready
+    # workers: maximum number of steps running at once
+    def __init__(self, steps, workers=STEP_WORKERS):
+        if not (isinstance(steps, list) and
+                all(isinstance(step, Step) for step in steps) and
+                isinstance(workers, int) and
+                workers > 0):
+            raise ValueError
+        self.steps = {}
+        for step in steps:
+            if step.name in self.steps:
+                raise ValueError(f'step "{step.name}" declared twice')
+            self.steps[step.name] = step
+        self.workers = workers
+        # name -> set of names it waits for, combining requires and before
+        self.requirements = {name: set(step.requires) for name, step in self.steps.items()}
+        for step in steps:
+            for later in step.before:
+                if later in self.requirements:
+                    self.requirements[later].add(step.name)
+        for name, required in self.requirements.items():
+            unknown = required - set(self.steps)
+            if unknown:
+                raise ValueError(f'step "{name}" requires unknown steps {", ".join(sorted(unknown))}')
+        self._check_acyclic()
+        # name -> 'done', 'satisfied' (not run, nothing to do), 'failed' or
+        # 'skipped'
+        self.status = {}
+        # name -> exception raised by a failed step
+        self.errors = {}
+        # name -> wall-clock seconds a finished step took
+        self.seconds = {}
+
+    def _check_acyclic(self):
+        remaining = {name: set(required) for name, required in self.requirements.items()}
+        while remaining:
+            ready = [name for name, required in remaining.items() if not required]
+            if not ready:
+                raise ValueError(f'steps {", ".join(sorted(remaining))} depend on each other')
+            for name in ready:
+                del remaining[name]
+            for required in remaining.values():
+                required.difference_update(ready)
+
+    # Run step unless it is satisfied already. Returns True if it was.
+    def _run_step(self, step):
+        start = time.monotonic()
+        try:
+            with trace(step.name, 'step') as span:
+                if step.is_satisfied():
+                    span['satisfied'] = True
+                    return True
+                step.function()
+                return False
+        finally:
+            self.seconds[step.name] = time.monotonic() - start
+
+    # Run every step. Returns the status dict.
+    def run(self):
+        pending = list(self.steps.values())
+        running = {}
+        busy = set()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while pending or running:
+                for step in list(pending):
+                    states = [self.status.get(name) for name in self.requirements[step.name]]
+                    if 'failed' in states or 'skipped' in states:
+                        self.status[step.name] = 'skipped'
+                        pending.remove(step)
+                    elif (all(state in ['done', 'satisfied'] for state in states) and
+                          len(running) < self.workers and
+                          busy.isdisjoint(step.resources)):
+                        busy.update(step.resources)
+                        running[pool.submit(self._run_step, step)] = step
+                        pending.remove(step)
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    busy.difference_update(step.resources)
+                    try:
+                        self.status[step.name] = 'satisfied' if future.result() else 'done'
+                    except Exception as e:
+                        self.status[step.name] = 'failed'
+                        self.errors[step.name] = e
+        return self.status
+
+    # Names of the steps that failed, then the ones skipped because of them.
+    def failures(self):
+        return ([name for name in self.steps if self.status.get(name) == 'failed'] +
+                [name for name in self.steps if self.status.get(name) == 'skipped'])
+
+# Installs or removes the packages of several keywords at once. The package
+# sets of every keyword are marked in a single depcache, committed once and
+# autoremoved once, instead of once per keyword.
+class Transaction:
+    # keywords: list of AbstractKeyword objects to add or remove
+    # install: True to add the keywords, False to remove them
+    # session: the AptSession to use, by default the one shared by the process
+    # keep: names of packages that must not be removed because something
+    #   outside this transaction still owns them, see State.shared
+    # history: a ThroughputHistory that records how fast apt downloads and
+    #   installs, or None
+    def __init__(self, keywords, install, session=None, keep=[], history=None):
+        if not (isinstance(keywords, list) and
+                all(isinstance(keyword, AbstractKeyword) for keyword in keywords) and
+                isinstance(install, bool) and
+                (session is None or isinstance(session, AptSession)) and
+                isinstance(keep, list) and
+                all(isinstance(name, str) for name in keep) and
+                (history is None or isinstance(history, ThroughputHistory))):
+            raise ValueError
+        self.keywords = keywords
+        self.install = install
+        self.session = session if session else apt_session()
+        self.keep = keep
+        self.history = history
+        self.reports = [KeywordReport(keyword) for keyword in keywords]
+        # installed packages that plan unmarked as automatically installed
+        self.manual = []
+
+    # Every package requested by any keyword, without duplicates, in the
+    # order the keywords list them.
+    def package_names(self):
+        return list(dict.fromkeys(name for keyword in self.keywords for name in keyword.packages))
+
+    # Mark every package in cache that needs to change, and fill in the
+    # planned, skipped, unknown, download_bytes and space_bytes fields of each
+    # report. Packages that are already installed are not marked for install,
+    # but lose their automatically installed mark, since a keyword now asks
+    # for them by name; packages in keep are not marked for removal. Does
+    # not commit anything.
+    # cache: an open apt.cache.Cache
+    # strict: if False, packages missing from cache are recorded as unknown
+    #   instead of raising EnvironmentError
+    def plan(self, cache, strict=True):
+        with trace('apt: resolve', 'apt', packages=len(self.package_names())) as span:
+            self._plan(cache, strict)
+            span['changes'] = len(cache.get_changes())
+
+    def _plan(self, cache, strict):
+        seen = set()
+        skipped = set()
+        unknown = set()
+        self.manual = []
+        for report in self.reports:
+            download, space = cache.required_download, cache.required_space
+            with cache.actiongroup():
+                for name in report.requested:
+                    if name in seen:
+                        continue
+                    seen.add(name)
+                    try:
+                        package = cache[name]
+                    except KeyError:
+                        if strict:
+                            raise EnvironmentError('deb package "' + name + '" not found, is this Ubuntu?')
+                        unknown.add(name)
+                        continue
+                    if self.install:
+                        if package.is_installed:
+                            skipped.add(name)
+                            if package.is_auto_installed:
+                                package.mark_auto(False)
+                                self.manual.append(name)
+                        else:
+                            package.mark_install()
+                    elif name in self.keep:
+                        skipped.add(name)
+                    else:
+                        package.mark_delete()
+            report.download_bytes = cache.required_download - download
+            report.space_bytes = cache.required_space - space
+        for report in self.reports:
+            report.skipped = [name for name in report.requested if name in skipped]
+            report.unknown = [name for name in report.requested if name in unknown]
+            report.planned = [name for name in report.requested
+                              if name not in unknown and
+                                 (cache[name].marked_install or
+                                  cache[name].marked_upgrade or
+                                  cache[name].marked_delete)]
+
+    # Resolve the transaction in cache without committing it and predict
+    # what it costs. Fills in the reports like plan, and leaves cache with
+    # nothing marked. Returns a dict with the keys changes (number of
+    # packages changed, dependencies included), download_bytes, space_bytes,
+    # seconds, measured (False if seconds is a guess because nothing was
+    # measured on this host yet) and shortfalls (see disk_shortfalls).
+    # cache: an open apt.cache.Cache
+    # history: a ThroughputHistory
+    def estimate(self, cache, history):
+        try:
+            self.plan(cache, strict=False)
+            download, space = cache.required_download, cache.required_space
+            changes = len(cache.get_changes())
+        finally:
+            cache.clear()
+        seconds, measured = history.predict(download, space)
+        return {'changes': changes,
+                'download_bytes': download,
+                'space_bytes': space,
+                'seconds': seconds,
+                'measured': measured,
+                'shortfalls': disk_shortfalls(download, space)}
+
+    # Download the archives of every package the transaction will install
+    # into apt's archive directory, where the commit finds them. This is the
+    # APT_PREFETCH_STEP of the step graph, so apt's parallel download queues
+    # run while the keywords' other steps do. Packages that are not known
+    # yet, e.g. from a repository that a step is about to add, are left to
+    # the commit, and so is everything if prefetching fails.
+    def prefetch(self):
+        start = time.monotonic()
+        try:
+            cache = self.session.cache()
+        except Exception as e:
+            print(colored(f'[WARNING] not prefetching packages: {e}', 'yellow'))
+            return
+        try:
+            with cache.actiongroup():
+                for name in self.package_names():
+                    if name in cache and not cache[name].is_installed:
+                        cache[name].mark_install()
+            size = cache.required_download
+            fetch_start = time.monotonic()
+            with trace('apt: fetch archives', 'apt', bytes=size, prefetch=True):
+                cache.fetch_archives()
+            if self.history:
+                self.history.record('download', size, time.monotonic() - fetch_start)
+            print(f'[INFO] Prefetched {size / 1e6:.1f} MB of packages in {time.monotonic() - start:.2f}s')
+        except Exception as e:
+            print(colored(f'[WARNING] prefetching packages failed, the commit will download them: {e}', 'yellow'))
+        finally:
+            # the commit plans from scratch
+            cache.clear()
+
+    # True if every package is already as the transaction wants it, judged
+    # from dpkg's database without opening the apt cache; the satisfied
+    # check of the prefetch and the commit. Fills in the reports as plan
+    # would then.
+    def settled(self):
+        installed = installed_deb_packages(self.package_names())
+        if self.install:
+            settled = (all(name in installed for name in self.package_names()) and
+                       not auto_installed_packages(self.package_names(), APT_EXTENDED_STATES_PATH))
+        else:
+            settled = all(name not in installed or name in self.keep for name in self.package_names())
+        if settled:
+            for report in self.reports:
+                report.planned = []
+                report.skipped = [name for name in report.requested
+                                  if self.install or name in self.keep]
+        return settled
+
+    # Commit the package changes: one apt commit and one autoremove. This is
+    # the APT_STEP of the step graph.
+    def commit(self):
+        cache = self.session.cache()
+
+        names = self.package_names()
+        before = {name: cache[name].is_installed for name in names if name in cache}
+        self.plan(cache)
+        download, space = cache.required_download, cache.required_space
+        shortfalls = disk_shortfalls(download, space)
+        if shortfalls:
+            cache.clear()
+            raise EnvironmentError('not enough disk space: ' + '; '.join(shortfalls))
+
+        print(f'[INFO] Committing {len(cache.get_changes())} package changes for {len(self.keywords)} keyword(s)')
+        try:
+            # fetch first, so downloading and installing are timed apart
+            start = time.monotonic()
+            with trace('apt: fetch archives', 'apt', bytes=download):
+                cache.fetch_archives()
+            fetched = time.monotonic()
+            with trace('dpkg: unpack and configure', 'apt', changes=len(cache.get_changes()), bytes=space):
+                cache.commit()
+        except Exception as e:
+            raise EnvironmentError('error committing package changes: ' + str(e))
+        if self.history and self.install:
+            self.history.record('download', download, fetched - start)
+            self.history.record('install', space, time.monotonic() - fetched)
+        # apt only saves the marks along with package changes, and autoremove
+        # must see them
+        if self.manual and run_traced(['apt-mark', 'manual'] + self.manual).returncode != 0:
+            raise EnvironmentError(f'could not mark {" ".join(self.manual)} as manually installed')
+        with trace('apt: autoremove', 'apt') as span:
+            span['returncode'] = os.system("apt autoremove")
+
+        self.session.reopen()
+        print(f'[INFO] {self.session.report()}')
+        for report in self.reports:
+            report.changed = [name for name in report.requested
+                              if before.get(name) != cache[name].is_installed]
+
+    # The step graph of the transaction: the commit, plus the prefetch and the
+    # steps of every keyword when adding, with names prefixed by the keyword
+    # name.
+    def steps(self):
+        if not self.install:
+            return [Step(APT_STEP, self.commit, resources=[DPKG_RESOURCE], satisfied=self.settled)]
+        steps = [Step(APT_PREFETCH_STEP, self.prefetch, satisfied=self.settled),
+                 Step(APT_STEP, self.commit, requires=[APT_PREFETCH_STEP], resources=[DPKG_RESOURCE],
+                      satisfied=self.settled)]
+        def qualify(keyword, names):
+            return [name if name in (APT_STEP, APT_PREFETCH_STEP) else f'{keyword.name}:{name}'
+                    for name in names]
+        for keyword in self.keywords:
+            for step in keyword.steps():
+                steps.append(Step(qualify(keyword, [step.name])[0],
+                                  step.function,
+                                  qualify(keyword, step.requires),
+                                  qualify(keyword, step.before),
+                                  step.resources,
+                                  step.satisfied,
+                                  step.artifacts))
+        return steps
+
+    # Run the whole transaction: the steps of every keyword and one apt
+    # commit, each as soon as what it depends on is done. A failed keyword
+    # step is recorded in the reports and does not stop unrelated steps.
+    # Returns the list of KeywordReport objects.
+    # raises EnvironmentError if the packages could not be committed.
+    def execute(self):
+        steps = self.steps()
+        # start the downloads of the steps with work to do now, so they
+        # overlap with the apt work; a satisfied step downloads nothing
+        for step in steps:
+            if step.artifacts and not step.is_satisfied():
+                for artifact in step.artifacts:
+                    download_engine().submit(artifact)
+
+        runner = StepRunner(steps)
+        with trace('transaction', 'tuffix', keywords=[keyword.name for keyword in self.keywords],
+                   install=self.install) as span:
+            runner.run()
+            span['failed'] = runner.failures()
+
+        for name in runner.failures():
+            error = runner.errors.get(name)
+            if error is None:
+                print(colored(f'[ERROR] {name}: skipped, a step it depends on failed', 'red'))
+            else:
+                message = error.message if isinstance(error, MessageException) else str(error)
+                print(colored(f'[ERROR] {name}: {message}', 'red'))
+        for report in self.reports:
+            prefix = f'{report.keyword.name}:'
+            report.failed = [name[len(prefix):] for name in runner.failures()
+                             if name.startswith(prefix)]
+            report.satisfied = [name[len(prefix):] for name, status in runner.status.items()
+                                if status == 'satisfied' and name.startswith(prefix)]
+        if runner.status[APT_STEP] not in ['done', 'satisfied']:
+            raise EnvironmentError('package changes were not committed, see the errors above')
+
+        if self.install and download_engine().cache:
+            print(f'[INFO] {download_engine().cache.report()}')
+
+        return self.reports
+
+################################################################################
+# offline bundles (tuffix bundle)
+################################################################################
+
+# A bundle is an uncompressed tar file (.deb files are compressed already)
+# holding everything needed to add some keywords without a network:
+#
+#   bundle.json     manifest: keywords, packages, artifacts and their hashes
+#   Packages        apt index of debs/, so the unpacked bundle is a flat
+#                   apt repository
+#   debs/           every .deb in the dependency closure of the keywords
+#   artifacts/      the keywords' other downloads, named by SHA-256
+#   clones/         a tar of a shallow bare clone of each of the keywords'
+#                   git repositories, see AbstractKeyword.clones
+
+# Every package version that installing package_names on a bare system could
+# need: the candidate of each name plus, recursively, candidates satisfying
+# their BUNDLE_DEPENDENCY_TYPES. Of alternatives ("a | b") the first one with
+# a candidate is taken; virtual packages resolve to a provider the same way.
+# cache: an open apt.cache.Cache
+# Returns a dict mapping package name to apt.package.Version.
+# raises EnvironmentError if a package or a required dependency has no
+# installation candidate.
+def dependency_closure(cache, package_names):
+    def candidates(targets):
+        return [version for version in targets
+                if version == version.package.candidate]
+
+    closure = {}
+    stack = []
+    for name in package_names:
+        if name in cache and cache[name].candidate:
+            stack.append(cache[name].candidate)
+        elif cache.is_virtual_package(name):
+            providers = [package.candidate for package in cache.get_providing_packages(name)
+                         if package.candidate]
+            if not providers:
+                raise EnvironmentError(f'no package provides "{name}"')
+            stack.append(providers[0])
+        else:
+            raise EnvironmentError('deb package "' + name + '" not found, is this Ubuntu?')
+    while stack:
+        version = stack.pop()
+        if version.package.name in closure:
+            continue
+        closure[version.package.name] = version
+        for dependency in version.get_dependencies(*BUNDLE_DEPENDENCY_TYPES):
+            for alternative in dependency.or_dependencies:
+                targets = candidates(alternative.target_versions)
+                if targets:
+                    stack.append(targets[0])
+                    break
+            else:
+                if dependency.rawtype != 'Recommends':
+                    raise EnvironmentError(f'cannot satisfy "{dependency}" of {version.package.name}')
+    return closure
+
+# The Packages index stanza for a .deb.
+# control: text of the package's control file
+# filename: path of the .deb relative to the repository root
+def packages_stanza(control, filename, size, sha256):
+    return (control.rstrip('\n') +
+            f'\nFilename: {filename}\nSize: {size}\nSHA256: {sha256}\n\n')
+
+# URL -> local bare repository that git_clone clones instead, filled in
+# while a bundle is open
+_bundle_clones = {}
+
+# Clone the git repository at url into dest, the bundle's copy of it while a
+# bundle is open. origin points at url either way.
+# depth: number of commits to fetch, or None for the whole history
+# raises EnvironmentError if git fails.
+def git_clone(url, dest, depth=None):
+    source = _bundle_clones.get(url)
+    argv = ['git', 'clone']
+    if depth is not None and source is None:
+        argv += ['--depth', str(depth)]
+    argv += [str(source) if source else url, str(dest)]
+    if run_traced(argv).returncode != 0:
+        raise EnvironmentError(f'could not clone {url}')
+    if source and run_traced(['git', 'remote', 'set-url', 'origin', url], cwd=dest).returncode != 0:
+        raise EnvironmentError(f'could not point {dest} at {url}')
+
+# Names of the members of a bundle tar that may be extracted: regular files
+# and directories at relative paths that stay inside the target directory.
+# raises EnvironmentError for anything else.
+def bundle_members(tar):
+    members = []
+    for member in tar.getmembers():
+        parts = pathlib.PurePosixPath(member.name).parts
+        if (member.name.startswith('/') or
+            '..' in parts or
+            not (member.isfile() or member.isdir())):
+            raise EnvironmentError(f'bundle contains an unsafe entry "{member.name}"')
+        members.append(member)
+    return members
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Write a bundle for keywords to output.
+# keywords: list of AbstractKeyword objects
+# output: pathlib.Path of the tar file to create
+# Returns the manifest dict.
+def create_bundle(build_config, keywords, output):
+    import apt_inst
+    import apt_pkg
+    import tarfile
+
+    session = apt_session(build_config)
+    cache = session.cache()
+    names = []
+    for keyword in keywords:
+        names.extend(name for name in keyword.packages if name not in names)
+    closure = dependency_closure(cache, names)
+    print(f'[INFO] {len(names)} packages need {len(closure)} packages in all')
+
+    staging = build_config.cache_path / 'bundles' / f'staging-{os.getpid()}'
+    debs = staging / 'debs'
+    debs.mkdir(parents=True, exist_ok=True)
+    try:
+        # the .debs do not belong in the artifact cache, they would evict
+        # everything else
+        engine = DownloadEngine()
+        artifacts = []
+        for name, version in sorted(closure.items()):
+            if not version.uri:
+                raise EnvironmentError(f'{name} {version.version} is not available from any repository')
+            dest = debs / pathlib.PurePosixPath(version.filename).name
+            archived = APT_ARCHIVES_PATH / dest.name
+            if archived.is_file() and file_sha256(archived) == version.sha256:
+                shutil.copyfile(archived, dest)
+                engine.digests[dest] = version.sha256
+            else:
+                artifacts.append(Artifact(version.uri, dest, version.sha256))
+        print(f'[INFO] Downloading {len(artifacts)} packages, {len(closure) - len(artifacts)} found in {APT_ARCHIVES_PATH}')
+        engine.fetch_all(artifacts)
+        engine.shutdown()
+
+        extras = [artifact for keyword in keywords for artifact in keyword.artifacts]
+        download_engine(build_config).fetch_all(extras)
+
+        clones = list(dict.fromkeys(url for keyword in keywords for url in keyword.clones))
+        (staging / 'clones').mkdir()
+        for i, url in enumerate(clones):
+            repository = staging / 'clones' / f'{i}.git'
+            argv = ['git', 'clone', '--quiet', '--bare', '--depth', '1', url, str(repository)]
+            if run_traced(argv).returncode != 0:
+                raise EnvironmentError(f'could not clone {url}')
+            with tarfile.open(staging / 'clones' / f'{i}.tar', 'w') as tar:
+                tar.add(repository, repository.name)
+
+        manifest = {'format': BUNDLE_FORMAT,
+                    'tuffix': str(build_config.version),
+                    'created': datetime.now().isoformat(timespec='seconds'),
+                    'codename': distrib_codename(),
+                    'architecture': apt_pkg.get_architectures()[0],
+                    'keywords': [keyword.name for keyword in keywords],
+                    'packages': [],
+                    'artifacts': [],
+                    'clones': [{'url': url,
+                                'file': f'clones/{i}.tar',
+                                'sha256': file_sha256(staging / 'clones' / f'{i}.tar')}
+                               for i, url in enumerate(clones)]}
+        with open(staging / 'Packages', 'w') as index:
+            for name, version in sorted(closure.items()):
+                dest = debs / pathlib.PurePosixPath(version.filename).name
+                control = apt_inst.DebFile(str(dest)).control.extractdata('control').decode('utf-8')
+                filename = f'debs/{dest.name}'
+                size = dest.stat().st_size
+                index.write(packages_stanza(control, filename, size, engine.digests[dest]))
+                manifest['packages'].append({'name': name,
+                                             'version': version.version,
+                                             'file': filename,
+                                             'size': size,
+                                             'sha256': engine.digests[dest]})
+        for artifact in extras:
+            digest = download_engine(build_config).digests[artifact.dest]
+            manifest['artifacts'].append({'url': artifact.url,
+                                          'file': f'artifacts/{digest}',
+                                          'sha256': digest})
+
+        tmp_output = output.with_name(output.name + '.part')
+        with tarfile.open(tmp_output, 'w') as tar:
+            data = json.dumps(manifest, indent=1).encode('utf-8')
+            info = tarfile.TarInfo('bundle.json')
+            info.size = len(data)
+            info.mtime = time.time()
+            tar.addfile(info, io.BytesIO(data))
+            tar.add(staging / 'Packages', 'Packages')
+            for package in manifest['packages']:
+                tar.add(staging / package['file'], package['file'])
+            for artifact, entry in zip(extras, manifest['artifacts']):
+                tar.add(artifact.dest, entry['file'])
+            for entry in manifest['clones']:
+                tar.add(staging / entry['file'], entry['file'])
+        os.replace(tmp_output, output)
+        return manifest
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+# Unpack the bundle at path into the cache directory, check it, and switch
+# the process to offline mode until the with block ends: apt reads only the
+# bundle's index, the artifact cache is seeded with the bundle's artifacts
+# and never goes to the network, and git_clone clones the bundle's
+# repositories. Yields the manifest dict.
+@contextlib.contextmanager
+def open_bundle(build_config, path):
+    import tarfile
+
+    root = build_config.cache_path / 'bundles' / path.stem
+    try:
+        with tarfile.open(path) as tar:
+            manifest = json.load(tar.extractfile('bundle.json'))
+            if manifest.get('format') != BUNDLE_FORMAT:
+                raise EnvironmentError(f'{path} was made by an incompatible version of tuffix')
+            shutil.rmtree(root, ignore_errors=True)
+            tar.extractall(root, members=bundle_members(tar))
+    except (OSError, KeyError, ValueError, tarfile.TarError) as e:
+        raise EnvironmentError(f'cannot read bundle {path}: {e}')
+    if manifest['codename'] != distrib_codename():
+        raise EnvironmentError(f'{path} is for Ubuntu {manifest["codename"]}, this is {distrib_codename()}')
+    # bundles from before clones were bundled have none
+    clones = manifest.get('clones', [])
+    for entry in manifest['packages'] + manifest['artifacts'] + clones:
+        if file_sha256(root / entry['file']) != entry['sha256']:
+            raise EnvironmentError(f'{entry["file"]} in {path} is corrupted')
+    repositories = {}
+    for entry in clones:
+        try:
+            with tarfile.open(root / entry['file']) as tar:
+                tar.extractall(root / 'clones', members=bundle_members(tar))
+        except (OSError, tarfile.TarError) as e:
+            raise EnvironmentError(f'cannot read {entry["file"]} in {path}: {e}')
+        repositories[entry['url']] = (root / entry['file']).with_suffix('.git')
+
+    try:
+        os.remove(BUNDLE_SOURCES_PATH)
+    except FileNotFoundError:
+        pass
+    # Only this process reads the source; left in /etc/apt, every later apt
+    # update would trust the unsigned, aging repository.
+    sources_list = root / 'bundle.list'
+    engine = download_engine(build_config)
+    offline = engine.offline
+    try:
+        sources_list.write_text(f'deb [trusted=yes] file:{root} ./\n')
+        engine.offline = True
+        for entry in manifest['artifacts']:
+            engine.cache.insert(entry['url'], root / entry['file'], entry['sha256'])
+        _bundle_clones.update(repositories)
+        with apt_session(build_config).only_sources(sources_list, root / 'lists'):
+            yield manifest
+    finally:
+        _bundle_clones.clear()
+        engine.offline = offline
+        try:
+            os.remove(sources_list)
+        except FileNotFoundError:
+            pass
+
+################################################################################
+# running tuffix on many hosts (tuffix fleet)
+################################################################################
+
+# One lab host of a fleet inventory.
+class FleetHost:
+    # destination: what ssh connects to, host or user@host
+    # port: ssh port, or None for ssh's default
+    def __init__(self, destination, port=None):
+        if not (isinstance(destination, str) and destination and
+                (port is None or isinstance(port, int))):
+            raise ValueError
+        self.destination = destination
+        self.port = port
+
+    def __str__(self):
+        return self.destination if self.port is None else f'{self.destination}:{self.port}'
+
+    def __eq__(self, other):
+        return (isinstance(other, FleetHost) and
+                (self.destination, self.port) == (other.destination, other.port))
+
+    def __hash__(self):
+        return hash((self.destination, self.port))
+
+# Read a fleet inventory: one [user@]host[:port] per line. Blank lines and
+# everything after a # are ignored. Returns a list of FleetHost in file order.
+def read_inventory(path):
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except OSError as e:
+        raise EnvironmentError(f'cannot read inventory {path}: {e}')
+    hosts = []
+    for number, line in enumerate(lines, 1):
+        entry = line.split('#', 1)[0].strip()
+        if not entry:
+            continue
+        match = re.fullmatch(r'([\w.-]+@)?([\w.-]+)(?::(\d+))?', entry)
+        if not match:
+            raise EnvironmentError(f'{path}:{number}: "{entry}" is not [user@]host[:port]')
+        host = FleetHost((match.group(1) or '') + match.group(2),
+                         int(match.group(3)) if match.group(3) else None)
+        if host in hosts:
+            raise EnvironmentError(f'{path}:{number}: {host} is listed twice')
+        hosts.append(host)
+    if not hosts:
+        raise EnvironmentError(f'inventory {path} lists no hosts')
+    return hosts
+
+# What running a command on one host came to.
+class FleetResult:
+    # host: FleetHost
+    # status: 'ok', 'failed' (tuffix exited non-zero), 'unreachable' (ssh
+    #   failed), 'timeout', 'error' (its output could not be read),
+    #   'interrupted' (Ctrl-C) or 'skipped' (a canary failed, or it never
+    #   started)
+    # returncode: exit code, or None if the command did not finish
+    # seconds: how long the host took
+    # tail: the last FLEET_TAIL_LINES lines of its output
+    def __init__(self, host, status, returncode=None, seconds=0.0, tail=[]):
+        self.host = host
+        self.status = status
+        self.returncode = returncode
+        self.seconds = seconds
+        self.tail = list(tail)
+
+# Runs one command on many hosts through ssh subprocesses on an asyncio
+# event loop. At most concurrency hosts run at once and each gets timeout
+# seconds. The first canaries hosts go first; if any of them does not
+# succeed the others are skipped. A line is printed as each host finishes.
+class FleetRunner:
+    # hosts: list of FleetHost
+    # arguments: the tuffix command and its arguments, e.g. ['add', 'base']
+    # ssh: argv of the ssh client; the port, host and remote command are
+    #   appended
+    # remote: argv of tuffix on the hosts
+    # log_dir: pathlib.Path of a directory that gets each host's full output,
+    #   or None
+    def __init__(self, hosts, arguments, ssh=FLEET_SSH, remote=FLEET_REMOTE,
+                 concurrency=FLEET_CONCURRENCY, timeout=FLEET_TIMEOUT,
+                 canaries=FLEET_CANARIES, log_dir=None):
+        if not (isinstance(hosts, list) and all(isinstance(host, FleetHost) for host in hosts) and
+                isinstance(arguments, list) and all(isinstance(argument, str) for argument in arguments) and
+                isinstance(concurrency, int) and concurrency >= 1 and
+                isinstance(timeout, (int, float)) and timeout > 0 and
+                isinstance(canaries, int) and canaries >= 0):
+            raise ValueError
+        self.hosts = hosts
+        self.arguments = arguments
+        self.ssh = list(ssh)
+        self.remote = list(remote)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.canaries = canaries
+        self.log_dir = log_dir
+        self.finished = 0
+        self.seconds = 0.0
+        # one FleetResult per host, in the order of hosts, filled in as they
+        # finish; complete enough for a summary even after Ctrl-C
+        self.results = [FleetResult(host, 'skipped') for host in hosts]
+        # ssh processes that are still running
+        self._processes = set()
+
+    # argv of the ssh process for host
+    def ssh_argv(self, host):
+        port = [] if host.port is None else ['-p', str(host.port)]
+        return self.ssh + port + [host.destination, '--', shlex.join(self.remote + self.arguments)]
+
+    # Run the command on every host. Returns self.results. On Ctrl-C, every
+    # ssh process is killed before KeyboardInterrupt is passed on.
+    def run(self):
+        import asyncio
+        start = time.perf_counter()
+        try:
+            with trace('fleet', 'fleet', hosts=len(self.hosts)):
+                asyncio.run(self._run())
+        finally:
+            # normally done by _host; this catches an event loop that
+            # stopped before it got the chance
+            for process in list(self._processes):
+                self._killpg(process)
+            self.seconds = time.perf_counter() - start
+        return self.results
+
+    async def _run(self):
+        import asyncio
+        semaphore = asyncio.Semaphore(self.concurrency)
+        if self.log_dir is not None:
+            self.log_dir.mkdir(parents=True, exist_ok=True)
+        waves = [range(min(self.canaries, len(self.hosts))),
+                 range(min(self.canaries, len(self.hosts)), len(self.hosts))]
+        await asyncio.gather(*[self._host(index, semaphore) for index in waves[0]])
+        failed = [self.results[index] for index in waves[0] if self.results[index].status != 'ok']
+        if waves[1] and failed:
+            print(f'[INFO] Canary {", ".join(str(result.host) for result in failed)} '
+                  f'did not succeed; skipping the other {len(waves[1])} hosts', flush=True)
+            return
+        await asyncio.gather(*[self._host(index, semaphore) for index in waves[1]])
+
+    async def _host(self, index, semaphore):
+        import asyncio
+        host = self.hosts[index]
+        async with semaphore:
+            start = time.perf_counter()
+            tail = collections.deque(maxlen=FLEET_TAIL_LINES)
+            log = open(self.log_dir / f'{host}.log', 'wb') if self.log_dir is not None else None
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *self.ssh_argv(host), stdin=asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+                    start_new_session=True)
+            except OSError as e:
+                result = FleetResult(host, 'unreachable', tail=[str(e)])
+            else:
+                self._processes.add(process)
+                try:
+                    returncode = await asyncio.wait_for(self._collect(process, tail, log), self.timeout)
+                except asyncio.TimeoutError:
+                    await self._kill(process)
+                    tail.append(f'timed out after {format_duration(self.timeout)}')
+                    result = FleetResult(host, 'timeout', tail=tail)
+                except asyncio.CancelledError:
+                    # Ctrl-C; ssh runs in a session of its own and would not
+                    # see it. Recorded first: asyncio.run may cancel this
+                    # task again while it waits for ssh to die.
+                    tail.append('interrupted')
+                    self.results[index] = FleetResult(host, 'interrupted', tail=tail,
+                                                      seconds=time.perf_counter() - start)
+                    await self._kill(process)
+                    raise
+                except Exception as e:
+                    # e.g. the log cannot be written; this host only
+                    await self._kill(process)
+                    tail.append(f'cannot follow the output: {e}')
+                    result = FleetResult(host, 'error', tail=tail)
+                else:
+                    # ssh itself exits 255 when it cannot connect or log in
+                    status = 'ok' if returncode == 0 else 'unreachable' if returncode == 255 else 'failed'
+                    result = FleetResult(host, status, returncode, tail=tail)
+                finally:
+                    self._processes.discard(process)
+            finally:
+                if log is not None:
+                    log.close()
+            result.seconds = time.perf_counter() - start
+        self.results[index] = result
+        self.finished += 1
+        width = len(str(len(self.hosts)))
+        line = f'[{self.finished:>{width}}/{len(self.hosts)}] {result.status:<11} {host} ({format_duration(result.seconds)})'
+        if result.status != 'ok' and result.tail:
+            line += f': {result.tail[-1]}'
+        print(line, flush=True)
+
+    # Kill the whole process group of process, so that no child of ssh (e.g.
+    # a ProxyCommand) keeps the output pipe open.
+    @staticmethod
+    def _killpg(process):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    # Kill process and wait for it.
+    async def _kill(self, process):
+        self._killpg(process)
+        await process.wait()
+
+    # Read the output of process into tail and log until it exits; returns
+    # its exit code. The output is read in chunks and split into lines here,
+    # at \n and at the \r of progress bars, so that no line is too long to
+    # read; only the end of a very long line is kept for tail.
+    async def _collect(self, process, tail, log):
+        pending = b''
+        while True:
+            chunk = await process.stdout.read(DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            if log is not None:
+                log.write(chunk)
+            lines = re.split(rb'[\r\n]', pending + chunk)
+            pending = lines.pop()[-FLEET_LINE_LENGTH:]
+            for line in lines:
+                text = line[-FLEET_LINE_LENGTH:].decode(errors='replace').rstrip()
+                if text:
+                    tail.append(text)
+        text = pending.decode(errors='replace').rstrip()
+        if text:
+            tail.append(text)
+        return await process.wait()
+
+# Summary of a `tuffix fleet` run: counts per status, the hosts that did not
+# succeed with their last output lines, and the slowest hosts.
+# results: list of FleetResult
+# seconds: how long the whole run took
+def format_fleet_summary(results, seconds):
+    statuses = ['ok', 'failed', 'unreachable', 'timeout', 'skipped']
+    # the rarer statuses only when they happened
+    statuses += [status for status in ['error', 'interrupted']
+                 if any(result.status == status for result in results)]
+    counts = [f'{sum(result.status == status for result in results)} {status}' for status in statuses]
+    lines = [f'tuffix: fleet finished in {format_duration(seconds)}: {", ".join(counts)}']
+    for result in results:
+        if result.status in ['ok', 'skipped']:
+            continue
+        code = f', exit {result.returncode}' if result.returncode is not None else ''
+        lines.append(f'  {result.host}: {result.status}{code}')
+        lines.extend(f'    {text}' for text in result.tail)
+    ran = sorted((result for result in results if result.status != 'skipped'),
+                 key=lambda result: result.seconds, reverse=True)
+    if len(ran) > 1:
+        lines.append('  slowest: ' + ', '.join(f'{result.host} ({format_duration(result.seconds)})'
+                                              for result in ran[:3]))
+    return '\n'.join(lines)
 
 ################################################################################
 # miscellaneous utility functions
 ################################################################################
 
+# Name of the user who is logged in, even under sudo. os.getlogin() needs a
+# controlling terminal, so fall back to $SUDO_USER and then the effective user
+# when there is none (cron jobs, monitoring agents, ssh without a tty).
+def login_name():
+    try:
+        return os.getlogin()
+    except OSError:
+        return os.environ.get('SUDO_USER') or getpass.getuser()
+
 # Read and parse the release codename from /etc/lsb-release .
 def distrib_codename():
     with open('/etc/lsb-release') as f:
         return parse_distrib_codename(f)
 
-def is_deb_package_installed(package_name):
+# The installed versions of those of names that dpkg has installed, as a dict
+# mapping name to version; reads dpkg's database rather than opening the apt
+# cache.
+# names: list of package names
+def installed_deb_packages(names):
+    index = dpkg_status()
+    return {name: index.version(name) for name in names if index.is_installed(name)}
+
+# Those of names that apt marked as automatically installed, i.e. only as a
+# dependency, which autoremove removes once nothing depends on them. Returns
+# a set; without the file, no package is marked.
+# names: list of package names
+# path: pathlib.Path of apt's extended states file
+def auto_installed_packages(names, path=APT_EXTENDED_STATES_PATH):
+    wanted = set(names)
+    marked = set()
+    name = None
     try:
-        apt_pkg.init()
-        cache = apt_pkg.Cache()
-        package = cache[package_name]
-        return (package.current_state == apt_pkg.CURSTATE_INSTALLED)
-    except KeyError:
-        raise EnvironmentError('no such package "' + package_name + '"; is this Ubuntu?')
+        with open(path, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                if line.startswith('Package: '):
+                    name = line[9:].strip()
+                elif line.startswith('Auto-Installed: ') and line[16:].strip() == '1' and name in wanted:
+                    marked.add(name)
+    except FileNotFoundError:
+        pass
+    return marked
+
+# True if dpkg has package_name installed; a package dpkg has never seen is
+# not installed.
+def is_deb_package_installed(package_name):
+    return dpkg_status().is_installed(package_name)
     
 # Parse the DISTRIB_CODENAME from a file formatted like /etc/lsb-release .
 # This is factored out into its own function for unit testing.
@@ -1321,7 +4739,7 @@ def host() -> str:
     Goal: get the current user logged in and the computer they are logged into
     """
 
-    return "{}@{}".format(os.getlogin(), socket.gethostname())
+    return "{}@{}".format(login_name(), socket.gethostname())
 
 def current_operating_system() -> str:
     """
@@ -1418,7 +4836,7 @@ def graphics_information() -> str:
         elif(primary and secondary):
             break
 
-    return colored(primary, 'green'), colored("None" if not secondary else secondary, 'red')
+    return primary, "None" if not secondary else secondary
 
 
 def list_git_configuration() -> tuple:
@@ -1466,67 +4884,85 @@ def has_internet() -> bool:
             pass
     raise EnvironmentError('no connected network adapter, internet is down')
 
-def currently_installed_targets() -> list:
+def currently_installed_targets(build_config=DEFAULT_BUILD_CONFIG) -> list:
     """
     GOAL: list all installed codewords in a formatted list
     """
 
-    return [f'{"- ": >4} {element}' for element in read_state(DEFAULT_BUILD_CONFIG).installed]
+    return [f'{"- ": >4} {element}' for element in installed_keywords(build_config)]
+
+def installed_keywords(build_config=DEFAULT_BUILD_CONFIG) -> list:
+    """
+    GOAL: names of all installed codewords
+    """
+
+    return read_state(build_config).installed
 
 
-def status() -> str:
+def status(build_config=DEFAULT_BUILD_CONFIG) -> str:
     """
     GOAL: Driver code for all the components defined above
     """
-    try:
-        git_username, git_email = list_git_configuration()
-    except Exception as e:
-        print(e)
-        git_email, git_username = "None", "None"
-    list_git_configuration()
-    primary, secondary = graphics_information()
-    installed_targets = currently_installed_targets()
-
-    return """
-{}
------
-
-OS: {}
-Model: {}
-Kernel: {}
-Uptime: {}
-Shell: {}
-Terminal: {}
-CPU: {}
-GPU:
-  - Primary: {}
-  - Secondary: {}
-Memory: {} GB
-Current Time: {}
-Git Configuration:
-  - Email: {}
-  - Username: {}
-Installed keywords:
-  {}
-Connected to Internet: {}
-""".format(
-    host(),
-    current_operating_system(),
-    current_model(),
-    current_kernel_revision(),
-    current_uptime(),
-    system_shell(),
-    system_terminal_emulator(),
-    cpu_information(),
-    primary,
-    secondary,
-    memory_information(),
-    current_time(),
-    git_email,
-    git_username,
-    '\n'.join(installed_targets).strip() if (len(installed_targets) !=  0) else "None",
-    "Yes" if has_internet() else "No"
- )
+    return format_status(status_data(build_config))
+
+def status_data(build_config=DEFAULT_BUILD_CONFIG, fields=None) -> dict:
+    """
+    GOAL: run the probes behind the requested status fields, and return their
+    values as a JSON-serializable dict in probe order
+    fields: list of probe names, or None for all of them
+    """
+    if not (isinstance(build_config, BuildConfig) and
+            (fields is None or (isinstance(fields, list) and
+                                all(isinstance(field, str) for field in fields)))):
+        raise ValueError
+    probes = select_status_probes(fields)
+    cache = None
+    if any(probe.cache_ttl is not None for probe in probes):
+        cache = ProbeCache(probe_cache_path(build_config))
+    report = run_status_probes(probes, cache, build_config)
+    data = {}
+    for probe in probes:
+        value = report[probe.name]
+        if probe.keys:
+            value = dict(zip(probe.keys, value))
+        data[probe.name] = value
+    return data
+
+def format_status(data) -> str:
+    """
+    GOAL: render the dict from status_data as the human-readable report;
+    fields missing from data are left out
+    """
+    lines = ['']
+    if 'host' in data:
+        lines += [data['host'], '-----', '']
+    simple = [('os', 'OS'),
+              ('model', 'Model'),
+              ('kernel', 'Kernel'),
+              ('uptime', 'Uptime'),
+              ('shell', 'Shell'),
+              ('terminal', 'Terminal'),
+              ('cpu', 'CPU')]
+    lines += [f'{label}: {data[name]}' for name, label in simple if name in data]
+    if 'gpu' in data:
+        lines += ['GPU:',
+                  f'  - Primary: {colored(data["gpu"]["primary"], "green")}',
+                  f'  - Secondary: {colored(data["gpu"]["secondary"], "red")}']
+    if 'memory' in data:
+        lines.append(f'Memory: {data["memory"]} GB')
+    if 'time' in data:
+        lines.append(f'Current Time: {data["time"]}')
+    if 'git' in data:
+        lines += ['Git Configuration:',
+                  f'  - Email: {data["git"]["email"]}',
+                  f'  - Username: {data["git"]["username"]}']
+    if 'installed' in data:
+        targets = [f'{"- ": >4} {element}' for element in data['installed']]
+        lines += ['Installed keywords:',
+                  '  ' + ('\n'.join(targets).strip() if targets else "None")]
+    if 'internet' in data:
+        lines.append(f'Connected to Internet: {"Yes" if data["internet"] else "No"}')
+    return '\n'.join(lines) + '\n'
 
 def system_shell():
     """
@@ -1534,7 +4970,7 @@ def system_shell():
     """
 
     path = "/etc/passwd"
-    cu = os.getlogin()
+    cu = login_name()
     _r_shell = re.compile("^{}.*\:\/home\/{}\:(?P<path>.*)".format(cu, cu))
     shell_name = None
     with open(path, "r") as fp:
@@ -1562,6 +4998,198 @@ def system_terminal_emulator() -> str:
     except KeyError:
         raise EnvironmentError("Cannot find default terminal")
 
+# One piece of information reported by `tuffix status`.
+class StatusProbe:
+    # name: key of the probe's value in the status report, e.g. 'cpu'
+    # function: callable taking no arguments that returns the value
+    # timeout: seconds to wait for function before giving up on it
+    # degraded: value reported instead when function raises or times out
+    # cache_ttl: seconds a value may be reused from the ProbeCache,
+    #   UNTIL_REBOOT for hardware facts, or None to never cache it
+    # keys: for a probe whose value is a tuple, names for its parts in
+    #   structured (JSON) output
+    # configured: True if function takes the BuildConfig of the status
+    #   command, e.g. to find the state file
+    def __init__(self, name, function, timeout=STATUS_PROBE_TIMEOUT, degraded="Unknown", cache_ttl=None, keys=None,
+                 configured=False):
+        if not (isinstance(name, str) and
+                callable(function) and
+                isinstance(configured, bool) and
+                isinstance(timeout, (int, float)) and
+                timeout > 0 and
+                (cache_ttl is None or (isinstance(cache_ttl, (int, float)) and cache_ttl > 0)) and
+                (keys is None or (isinstance(keys, tuple) and
+                                  all(isinstance(key, str) for key in keys)))):
+            raise ValueError
+        self.name = name
+        self.function = function
+        self.timeout = timeout
+        self.degraded = degraded
+        self.cache_ttl = cache_ttl
+        self.keys = keys
+        self.configured = configured
+
+    # The probe's value, for build_config.
+    def run(self, build_config):
+        return self.function(build_config) if self.configured else self.function()
+
+# Return the id of the current boot, or None if the kernel does not say.
+def current_boot_id():
+    try:
+        return BOOT_ID_PATH.read_text().strip()
+    except OSError:
+        return None
+
+# Where the ProbeCache for the current user lives. Values such as the git
+# configuration are per-user, so the file name includes the uid, and the uid
+# of the user who logged in, whose git configuration the git probe reads
+# even under sudo.
+# build_config: a BuildConfig object
+def probe_cache_path(build_config):
+    if not isinstance(build_config, BuildConfig):
+        raise ValueError
+    try:
+        login_uid = lookup_user(login_name()).pw_uid
+    except UnknownUserException:
+        login_uid = os.getuid()
+    return cache_file_path(build_config, f'status-{os.getuid()}-{login_uid}.json')
+
+# Values of status probes saved between runs of `tuffix status`. Everything
+# in the file belongs to one boot; after a reboot it is thrown away, so facts
+# like the CPU model are only ever read once per boot.
+class ProbeCache:
+    # path: pathlib.Path of the JSON file
+    # boot_id: id of the current boot, by default read from the kernel
+    def __init__(self, path, boot_id=None):
+        if not (isinstance(path, pathlib.Path) and
+                (boot_id is None or isinstance(boot_id, str))):
+            raise ValueError
+        self.path = path
+        self.boot_id = boot_id if boot_id else current_boot_id()
+        self.values = {}
+        self.dirty = False
+        try:
+            with open(path) as f:
+                document = json.load(f)
+            if (self.boot_id is not None and
+                document['boot_id'] == self.boot_id and
+                isinstance(document['values'], dict)):
+                self.values = document['values']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    # Return (True, value) if probe has a cached value that has not expired,
+    # otherwise (False, None).
+    def get(self, probe):
+        entry = self.values.get(probe.name)
+        if (probe.cache_ttl is None or
+            entry is None or
+            time.time() - entry['time'] > probe.cache_ttl):
+            return False, None
+        return True, entry['value']
+
+    def put(self, probe, value):
+        if probe.cache_ttl is not None:
+            self.values[probe.name] = {'value': value, 'time': time.time()}
+            self.dirty = True
+
+    # Write the cache back to disk if anything changed. Failing to write is
+    # not an error; the next run just probes again.
+    def save(self):
+        if not self.dirty or self.boot_id is None:
+            return
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix('.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump({'boot_id': self.boot_id, 'values': self.values}, f)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+        except OSError:
+            pass
+
+# Every probe that `tuffix status` runs. The probes are independent of each
+# other, so they can run in any order or all at once.
+# Hardware, the OS release and the kernel cannot change without a reboot;
+# shell and git configuration can, but rarely, so they are reused for a minute.
+# Uptime, time, terminal and installed keywords are cheap and always read.
+STATUS_PROBES = [
+    StatusProbe('host', host),
+    StatusProbe('os', current_operating_system, cache_ttl=UNTIL_REBOOT),
+    StatusProbe('model', current_model, cache_ttl=UNTIL_REBOOT),
+    StatusProbe('kernel', current_kernel_revision, cache_ttl=UNTIL_REBOOT),
+    StatusProbe('uptime', current_uptime),
+    StatusProbe('shell', system_shell, cache_ttl=60),
+    StatusProbe('terminal', system_terminal_emulator),
+    StatusProbe('cpu', cpu_information, cache_ttl=UNTIL_REBOOT),
+    StatusProbe('gpu', graphics_information, degraded=("Unknown", "None"), cache_ttl=UNTIL_REBOOT,
+                keys=('primary', 'secondary')),
+    StatusProbe('memory', memory_information, cache_ttl=UNTIL_REBOOT),
+    StatusProbe('time', current_time),
+    StatusProbe('git', list_git_configuration, degraded=("None", "None"), cache_ttl=60,
+                keys=('username', 'email')),
+    StatusProbe('installed', installed_keywords, degraded=[], configured=True),
+    StatusProbe('internet', has_internet, degraded=False, cache_ttl=10)
+]
+
+# Return the probes behind the given status fields, in STATUS_PROBES order.
+# Raises UsageError for an unknown field.
+# fields: list of probe names, or None for every probe
+def select_status_probes(fields=None):
+    if fields is None:
+        return list(STATUS_PROBES)
+    names = [probe.name for probe in STATUS_PROBES]
+    for field in fields:
+        if field not in names:
+            raise UsageError(f'unknown status field "{field}"; valid fields are {",".join(names)}')
+    return [probe for probe in STATUS_PROBES if probe.name in fields]
+
+# Run probes concurrently and return a dict mapping each probe's name to its
+# value. Every probe starts at once on its own daemon thread, and each one is
+# waited for until its own timeout measured from that common start, so the
+# whole call takes about as long as the slowest probe rather than the sum of
+# all of them. A probe that is still running when we stop waiting is left
+# behind; being a daemon it does not keep tuffix from exiting.
+# probes: list of StatusProbe objects
+# cache: a ProbeCache; probes with an unexpired cached value are not run, and
+#   fresh values are saved back to it
+# build_config: BuildConfig passed to the configured probes
+def run_status_probes(probes, cache=None, build_config=DEFAULT_BUILD_CONFIG):
+    if not (isinstance(probes, list) and
+            all(isinstance(probe, StatusProbe) for probe in probes) and
+            (cache is None or isinstance(cache, ProbeCache)) and
+            isinstance(build_config, BuildConfig)):
+        raise ValueError
+    results = {}
+    if cache:
+        for probe in probes:
+            hit, value = cache.get(probe)
+            if hit:
+                results[probe.name] = value
+        probes_to_run = [probe for probe in probes if probe.name not in results]
+    else:
+        probes_to_run = probes
+
+    def run(probe):
+        try:
+            results[probe.name] = probe.run(build_config)
+        except Exception:
+            pass
+
+    threads = [threading.Thread(target=run, args=(probe,), daemon=True,
+                                name=f'tuffix-status-{probe.name}')
+               for probe in probes_to_run]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for probe, thread in zip(probes_to_run, threads):
+        thread.join(max(0, start + probe.timeout - time.monotonic()))
+        if cache and not thread.is_alive() and probe.name in results:
+            cache.put(probe, results[probe.name])
+    if cache:
+        cache.save()
+    return {probe.name: results.get(probe.name, probe.degraded) for probe in probes}
+
 ################################################################################
 # main, argument parsing, and usage errors
 ################################################################################
@@ -1573,7 +5201,9 @@ def print_usage(build_config):
     print(
         'tuffix ' + str(build_config.version) + '\n\n' +
         'usage:\n\n' +
-        '    tuffix <command> [argument...]\n\n' +
+        '    tuffix [--trace FILE] <command> [argument...]\n\n' +
+        '--trace FILE records how long each part of the command took, in a\n' +
+        'trace that Perfetto (ui.perfetto.dev) and chrome://tracing open.\n\n' +
         'where <command> and [argument...] match one of the following:\n'
     )
 
@@ -1598,27 +5228,37 @@ def main(build_config, argv):
             all([isinstance(arg, str) for arg in argv])):
             raise ValueError
     try :
+        # tuffix --trace FILE <command> ...
+        trace_path = None
+        if len(argv) > 1 and (argv[1] == '--trace' or argv[1].startswith('--trace=')):
+            if argv[1].startswith('--trace='):
+                trace_path, argv = argv[1][len('--trace='):], argv[:1] + argv[2:]
+            elif len(argv) > 2:
+                trace_path, argv = argv[2], argv[:1] + argv[3:]
+            if not trace_path:
+                raise UsageError('--trace needs a file name')
+            start_tracing()
+
         if len(argv) <= 1:
             raise UsageError('you must supply a command name')
         command_name = argv[1] # skip script name at index 0
 
         # find the AbstractCommand that the user specified
-        command_object = None
-        for cmd in all_commands(build_config):
-            if cmd.name == command_name:
-                command_object = cmd
-                break
-
-        # did we find a command?
-        if not command_object:
-            raise UsageError('unknown command "' + command_name + '"')
+        command_object = COMMANDS.create(build_config, command_name)
 
         # peel off the arguments
         arguments = argv[2:]
 
         # run the command...
         try:
-            return command_object.execute(arguments)
+            with trace(f'tuffix {command_name}', 'command', arguments=arguments) as span:
+                try:
+                    code = command_object.execute(arguments)
+                except MessageException:
+                    span['exit_code'] = 1
+                    raise
+                span['exit_code'] = code or 0
+                return code
         except MessageException as e:
             # general error message
             print('error: ' + e.message)
@@ -1628,3 +5268,11 @@ def main(build_config, argv):
     except UsageError as e:
         print('error: ' + e.message)
         print_usage(build_config)
+    finally:
+        tracer = stop_tracing()
+        if tracer:
+            try:
+                tracer.write(pathlib.Path(trace_path))
+                print(f'[INFO] Trace written to {trace_path}')
+            except OSError as e:
+                print(f'error: cannot write trace to {trace_path}: {e}')
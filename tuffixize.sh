@@ -61,6 +61,9 @@ test_dns_web
 REGEX='(https?)://[-A-Za-z0-9\+&@#/%?=~_|!:,.;]*[-A-Za-z0-9\+&@#/%=~_|]'
 
 # If TUFFIX_APT_SOURCES_HOST is defined, rewrite /etc/apt/sources.list
+# In a lab, this can point at a machine running `tuffix proxy serve`, e.g.
+# TUFFIX_APT_SOURCES_HOSTURL=http://proxyhost:3142/ubuntu, so that packages
+# are downloaded from the mirror once and then served from its cache.
 if [ ${TUFFIX_APT_SOURCES_HOSTURL}"x" != "x" ]; then
   echo "Overriding /etc/apt/sources.list with ${TUFFIX_APT_SOURCES_HOSTURL}"
   if [[ $TUFFIX_APT_SOURCES_HOSTURL =~ $REGEX ]]; then